@@ -0,0 +1,238 @@
+"""
+Headless batch merging: runs many independent merges across a process pool.
+
+    python pdf_batch.py scans/2024-* -o merged/ -j 8
+    python pdf_batch.py --manifest jobs.json --optimize
+
+Every directory (named directly or matched by a glob) is one job: its PDFs and images are
+merged in name order into <output-dir>/<directory name>.pdf. A manifest is a JSON list of
+{"output": "out.pdf", "inputs": ["a.pdf", {"file": "b.pdf", "pages": "1-3", "rotate": 90}],
+"optimize": bool, "linearize": bool}, with relative paths resolved against the manifest's
+directory. Exits with 1 if any job failed and 2 on invalid arguments.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from pdf_engine import (
+    merge_pdf_low_memory, optimize_pdf, linearize_pdf, parse_page_ranges, count_pages, QPDF_PATH
+)
+
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')
+
+def source_kind(path) -> str:
+    """"pdf" or "image" by file extension, None for files that aren't merged"""
+    suffix = Path(path).suffix.lower()
+    if suffix in PDF_EXTENSIONS:
+        return "pdf"
+    if suffix in IMAGE_EXTENSIONS:
+        return "image"
+    return None
+
+def jobs_from_paths(patterns: list, output_dir: Path) -> list:
+    """One job per directory named or matched by patterns"""
+    jobs = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise ValueError(f"No directories match {pattern}")
+        for match in matches:
+            directory = Path(match)
+            if not directory.is_dir():
+                raise ValueError(f"Not a directory: {match} (merge single files with --manifest)")
+            inputs = sorted(str(path) for path in directory.iterdir() if path.is_file() and source_kind(path))
+            jobs.append({"output": str(output_dir / f"{directory.resolve().name}.pdf"), "inputs": inputs})
+    return jobs
+
+def jobs_from_manifest(manifest_path: Path) -> list:
+    """Jobs listed in a manifest file (see the module docstring)"""
+    with open(manifest_path) as manifest_file:
+        jobs = json.load(manifest_file)
+    if not isinstance(jobs, list):
+        raise ValueError("The manifest must be a list of jobs")
+
+    base = manifest_path.parent
+    for job in jobs:
+        if not isinstance(job, dict) or not job.get("output") or not isinstance(job.get("inputs"), list):
+            raise ValueError(f"Manifest jobs need an output and a list of inputs: {job!r}")
+        job["output"] = str(base / job["output"])
+        job["inputs"] = [
+            {**entry, "file": str(base / entry.get("file", ""))} if isinstance(entry, dict) else str(base / entry)
+            for entry in job["inputs"]
+        ]
+    return jobs
+
+def build_sources(inputs: list) -> list:
+    """merge_pdf_low_memory sources for a job's inputs (paths or {"file", "pages", "rotate"})"""
+    sources = []
+    for entry in inputs:
+        selection = entry if isinstance(entry, dict) else {"file": entry}
+        path = selection["file"]
+        kind = source_kind(path)
+        if kind is None:
+            raise ValueError(f"Unsupported file type: {path}")
+        if not os.path.isfile(path):
+            raise ValueError(f"File not found: {path}")
+
+        rotate = selection.get("rotate", 0) or 0
+        if not isinstance(rotate, int) or rotate % 90:
+            raise ValueError(f"rotate must be a multiple of 90: {path}")
+
+        pages = selection.get("pages")
+        if pages is not None:
+            page_count = count_pages(path) if kind == "pdf" else 1
+            pages = [page - 1 for page in parse_page_ranges(pages, page_count, path)]
+        sources.append((path, kind, pages, rotate % 360, None))
+    return sources
+
+def run_job(job: dict, optimize: bool = False, linearize: bool = False) -> dict:
+    """Merge one job in a worker process; never raises, failures are reported in the result"""
+    started = time.time()
+    output_path = Path(job["output"])
+    temp_path = output_path.with_name(f"{output_path.name}.tmp")
+    result = {"output": str(output_path), "status": "failed", "pages": 0, "input_bytes": 0, "bytes_written": 0}
+    errors = []
+    try:
+        sources = build_sources(job["inputs"])
+        if not sources:
+            raise ValueError("No PDFs or images to merge")
+        result["input_bytes"] = sum(os.path.getsize(source[0]) for source in sources)
+
+        # Sources that fail to merge fail the job - a nightly run shouldn't ship a partial PDF
+        def on_error(path, error):
+            errors.append(f"{path}: {error}")
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(temp_path, 'wb') as output_file:
+            stats = merge_pdf_low_memory(sources, output_file, on_error=on_error)
+        if errors:
+            raise ValueError("; ".join(errors))
+        result["pages"] = stats["pages"]
+        result["peak_rss_mb"] = stats["peak_rss_mb"]
+
+        if job.get("optimize", optimize):
+            optimized_path = temp_path.with_suffix(".opt.tmp")
+            try:
+                with open(optimized_path, 'wb') as optimized_file:
+                    optimization = optimize_pdf(temp_path, optimized_file)
+                if optimization["bytes_saved"] > 0:
+                    os.replace(optimized_path, temp_path)
+            finally:
+                optimized_path.unlink(missing_ok=True)
+            result["bytes_saved"] = max(optimization["bytes_saved"], 0)
+
+        if job.get("linearize", linearize):
+            linearized_path = temp_path.with_suffix(".lin.tmp")
+            try:
+                result["linearized"] = linearize_pdf(temp_path, linearized_path)
+                if result["linearized"]:
+                    os.replace(linearized_path, temp_path)
+            finally:
+                linearized_path.unlink(missing_ok=True)
+
+        os.replace(temp_path, output_path)
+        result["bytes_written"] = output_path.stat().st_size
+        result["status"] = "completed"
+    except Exception as e:
+        result["error"] = str(e)
+        temp_path.unlink(missing_ok=True)
+    result["seconds"] = round(time.time() - started, 3)
+    return result
+
+def format_result(result: dict) -> str:
+    """One log line for a finished job, with its throughput"""
+    if result["status"] != "completed":
+        return f"❌ {result['output']}: {result['error']} ({result['seconds']}s)"
+
+    seconds = max(result["seconds"], 0.001)
+    input_mb = result["input_bytes"] / (1024 * 1024)
+    line = (f"✅ {result['output']}: {result['pages']} pages, {result['bytes_written'] / (1024 * 1024):.1f} MB "
+            f"in {result['seconds']}s ({result['pages'] / seconds:.0f} pages/s, {input_mb / seconds:.1f} MB/s read, "
+            f"peak {result['peak_rss_mb']} MB)")
+    if result.get("bytes_saved"):
+        line += f", optimized -{result['bytes_saved'] // 1024} KB"
+    if "linearized" in result:
+        line += ", linearized" if result["linearized"] else ", not linearized"
+    return line
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Merge PDFs and images in batch, one merged PDF per job.")
+    parser.add_argument("paths", nargs="*", help="directories or glob patterns matching directories")
+    parser.add_argument("-m", "--manifest", type=Path, help="JSON file listing jobs")
+    parser.add_argument("-o", "--output-dir", type=Path, default=Path("."),
+                        help="where directory jobs write <directory name>.pdf (default: .)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="merges to run in parallel (default: number of CPUs)")
+    parser.add_argument("--optimize", action="store_true", help="run the optimization stage on each output")
+    parser.add_argument("--linearize", action="store_true", help="linearize each output (needs qpdf)")
+    parser.add_argument("--skip-existing", action="store_true", help="skip jobs whose output already exists")
+    args = parser.parse_args(argv)
+
+    if not args.paths and args.manifest is None:
+        parser.error("give directories, glob patterns or --manifest")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    try:
+        jobs = jobs_from_paths(args.paths, args.output_dir)
+        if args.manifest is not None:
+            jobs += jobs_from_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    outputs = [os.path.abspath(job["output"]) for job in jobs]
+    duplicates = sorted({output for output in outputs if outputs.count(output) > 1})
+    if duplicates:
+        parser.error(f"Several jobs write {duplicates[0]}")
+    if args.linearize and QPDF_PATH is None:
+        print("⚠️ qpdf not found - outputs will not be linearized")
+
+    skipped = 0
+    if args.skip_existing:
+        pending = [job for job in jobs if not os.path.exists(job["output"])]
+        skipped = len(jobs) - len(pending)
+        jobs = pending
+
+    print(f"🚀 Merging {len(jobs)} jobs with {min(args.jobs, max(len(jobs), 1))} workers"
+          + (f" ({skipped} skipped, output exists)" if skipped else ""))
+    started = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=min(args.jobs, max(len(jobs), 1))) as pool:
+        futures = {pool.submit(run_job, job, args.optimize, args.linearize): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # run_job never raises, so this is the pool itself - e.g. a worker killed for
+                # running out of memory breaks the pool and fails every job still pending
+                output_path = Path(futures[future]["output"])
+                for suffix in (".tmp", ".opt.tmp", ".lin.tmp"):
+                    output_path.with_name(output_path.name + suffix).unlink(missing_ok=True)
+                result = {"output": futures[future]["output"], "status": "failed",
+                          "error": f"worker process failed: {e or type(e).__name__}",
+                          "seconds": 0, "pages": 0, "input_bytes": 0, "bytes_written": 0}
+            results.append(result)
+            print(format_result(result), flush=True)
+
+    elapsed = max(time.time() - started, 0.001)
+    completed = [result for result in results if result["status"] == "completed"]
+    failed = [result for result in results if result["status"] != "completed"]
+    pages = sum(result["pages"] for result in completed)
+    input_mb = sum(result["input_bytes"] for result in completed) / (1024 * 1024)
+    print(f"\n📊 {len(completed)}/{len(results)} jobs merged, {pages} pages in {elapsed:.1f}s "
+          f"({len(completed) / elapsed:.1f} jobs/s, {pages / elapsed:.0f} pages/s, {input_mb / elapsed:.1f} MB/s read)")
+    if failed:
+        print(f"❌ {len(failed)} jobs failed:")
+        for result in failed:
+            print(f"   {result['output']}: {result['error']}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,11 +2,12 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
 from pathlib import Path
-from pypdf import PdfWriter, PdfReader
 from PIL import Image, ImageTk
-import tempfile
 import threading
-from pdf2image import convert_from_path
+from pypdf import PdfWriter, PdfReader
+from pdf_engine import (
+    render_pdf_first_page_governed, merge_pdf_low_memory, use_low_memory_merge, add_image_page, image_thumbnail
+)
 
 class DragDropFrame(tk.Frame):
     def __init__(self, parent, **kwargs):
@@ -110,10 +111,10 @@ class FileItem(tk.Frame):
     
     def create_pdf_icon(self):
         try:
-            # Convert first page of PDF to image
-            pages = convert_from_path(self.file_path, first_page=1, last_page=1, dpi=50)
-            if pages:
-                img = pages[0]
+            # Render first page of PDF (embedded image fast path, poppler fallback
+            # through the shared governor so adding many PDFs doesn't fork a pdftoppm each)
+            img = render_pdf_first_page_governed(self.file_path, "desktop", dpi=50, max_size=80)
+            if img is not None:
                 img.thumbnail((80, 80), Image.Resampling.LANCZOS)
                 return ImageTk.PhotoImage(img)
         except:
@@ -121,9 +122,8 @@ class FileItem(tk.Frame):
         return self.create_default_pdf_icon()
     
     def create_image_icon(self):
-        with Image.open(self.file_path) as img:
-            img.thumbnail((80, 80), Image.Resampling.LANCZOS)
-            return ImageTk.PhotoImage(img)
+        # JPEGs decode at reduced scale, upright per EXIF
+        return ImageTk.PhotoImage(image_thumbnail(self.file_path, 80))
     
     def create_default_pdf_icon(self):
         # Create a simple PDF icon
@@ -307,21 +307,12 @@ class PDFEditor:
         # Refresh layout
         self.refresh_layout()
     
-    def image_to_pdf_page(self, image_path):
-        """Convert an image to a PDF page"""
-        try:
-            with Image.open(image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                temp_pdf.close()
-                
-                img.save(temp_pdf.name, "PDF", resolution=100.0)
-                return temp_pdf.name
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to convert image {image_path}: {str(e)}")
-            return None
+    def report_merge_error(self, file_path, error):
+        """Skip a file that can't be merged (unreadable PDFs are logged, failed images shown)"""
+        if str(file_path).lower().endswith('.pdf'):
+            print(f"Error reading PDF {file_path}: {error}")
+        else:
+            messagebox.showerror("Error", f"Failed to convert image {file_path}: {str(error)}")
     
     def combine_files(self):
         """Combine all files into a single PDF"""
@@ -354,46 +345,42 @@ class PDFEditor:
         
         def combine_in_background():
             try:
-                pdf_writer = PdfWriter()
-                temp_files = []
-                
-                for i, file_path in enumerate(self.files_list):
-                    progress_label.config(text=f"Processing file {i+1}/{len(self.files_list)}...")
-                    
+                sources = []
+                for file_path in self.files_list:
                     if file_path.lower().endswith('.pdf'):
-                        try:
-                            pdf_reader = PdfReader(file_path)
-                            for page in pdf_reader.pages:
-                                pdf_writer.add_page(page)
-                        except Exception as e:
-                            print(f"Error reading PDF {file_path}: {e}")
-                            continue
-                            
+                        sources.append((file_path, "pdf", None, 0, None))
                     elif file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff')):
-                        temp_pdf = self.image_to_pdf_page(file_path)
-                        if temp_pdf:
-                            temp_files.append(temp_pdf)
-                            try:
-                                pdf_reader = PdfReader(temp_pdf)
-                                for page in pdf_reader.pages:
-                                    pdf_writer.add_page(page)
-                            except Exception as e:
-                                print(f"Error processing image {file_path}: {e}")
-                                continue
+                        # JPEGs are passed through without re-encoding
+                        sources.append((file_path, "image", None, 0, None))
                 
-                with open(output_file, 'wb') as output_pdf:
-                    pdf_writer.write(output_pdf)
+                def show_progress(pages_processed, bytes_written):
+                    progress_label.config(text=f"Copied {pages_processed} pages ({bytes_written // (1024 * 1024)} MB)...")
                 
-                # Clean up
-                for temp_file in temp_files:
-                    try:
-                        os.unlink(temp_file)
-                    except:
-                        pass
+                if use_low_memory_merge(sum(os.path.getsize(source[0]) for source in sources)):
+                    # Pages are written out as they are copied, so files larger than RAM can be combined
+                    with open(output_file, 'wb') as output_pdf:
+                        stats = merge_pdf_low_memory(sources, output_pdf, progress=show_progress,
+                                                     on_error=self.report_merge_error)
+                    details = f"\nPeak memory: {stats['peak_rss_mb']} MB"
+                else:
+                    pdf_writer = PdfWriter()
+                    for i, (file_path, kind, _, _, _) in enumerate(sources):
+                        progress_label.config(text=f"Processing file {i+1}/{len(sources)}...")
+                        try:
+                            if kind == "pdf":
+                                for page in PdfReader(file_path).pages:
+                                    pdf_writer.add_page(page)
+                            else:
+                                add_image_page(pdf_writer, file_path)
+                        except Exception as e:
+                            self.report_merge_error(file_path, e)
+                    with open(output_file, 'wb') as output_pdf:
+                        pdf_writer.write(output_pdf)
+                    details = ""
                 
                 # Close progress window and show success
                 progress_window.destroy()
-                messagebox.showinfo("Success", f"PDF created successfully!\nSaved as: {output_file}")
+                messagebox.showinfo("Success", f"PDF created successfully!\nSaved as: {output_file}{details}")
                 
             except Exception as e:
                 progress_window.destroy()
@@ -0,0 +1,1227 @@
+"""
+Shared PDF rendering helpers used by both the desktop app (pdf_editor.py) and the web app (web_app.py).
+"""
+
+import gc
+import hashlib
+import mmap
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+import zlib
+from collections import ChainMap, OrderedDict, deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+
+from pypdf import PageObject, PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject, ContentStream, DecodedStreamObject, DictionaryObject, EncodedStreamObject,
+    FloatObject, IndirectObject, NameObject, NullObject, NumberObject, StreamObject
+)
+from PIL import Image, ImageOps, features
+from pdf2image import convert_from_path
+from pdf2image.exceptions import PDFPopplerTimeoutError
+
+# Render paths, fastest first
+RENDER_PATH_EMBEDDED_THUMB = "embedded_thumb"  # page carries a pre-rendered /Thumb image
+RENDER_PATH_SCANNED_IMAGE = "scanned_image"    # page is a single full-page image XObject
+RENDER_PATH_POPPLER = "poppler"                # pdftoppm subprocess (always works if installed)
+RENDER_PATH_FAILED = "failed"
+
+# Poppler rasterization limits
+RENDER_TIMEOUT = int(os.getenv("RENDER_TIMEOUT", 30))  # seconds before a pdftoppm process is killed
+RENDER_MEMORY_ESTIMATE = int(os.getenv("RENDER_MEMORY_ESTIMATE", 256 * 1024 * 1024))  # peak RSS of one render
+MAX_CONCURRENT_RENDERS = int(os.getenv("MAX_CONCURRENT_RENDERS", 0))  # 0 = derive from CPUs and memory
+
+# Merges of big inputs stream pages straight to disk instead of building the PDF in memory
+LOW_MEMORY_MERGE = os.getenv("LOW_MEMORY_MERGE", "auto")  # auto, always or never
+LOW_MEMORY_MERGE_BYTES = int(os.getenv("LOW_MEMORY_MERGE_BYTES", 256 * 1024 * 1024))  # auto: inputs above 256 MB
+
+# Low-memory merge: parsed objects are dropped whenever anonymous memory passes this target,
+# and again only once it has grown by MERGE_FLUSH_GROWTH since the last drop
+MERGE_RSS_TARGET = int(os.getenv("MERGE_RSS_TARGET", 512 * 1024 * 1024))
+MERGE_FLUSH_GROWTH = int(os.getenv("MERGE_FLUSH_GROWTH", 32 * 1024 * 1024))
+
+# Most pages one selection ("1-3,7") may pick, repeats included
+MAX_PAGE_SELECTION = int(os.getenv("MAX_PAGE_SELECTION", 10000))
+
+# Linearized ("fast web view") output is written by qpdf, when it is installed
+QPDF_PATH = shutil.which("qpdf")
+LINEARIZE_TIMEOUT = int(os.getenv("LINEARIZE_TIMEOUT", 300))  # seconds before qpdf is killed
+
+# Pixels per inch when an image becomes a page of its own
+IMAGE_PAGE_RESOLUTION = 100.0
+# Image pages are shrunk to fit this page size (a4, letter or none) and keep at most
+# IMAGE_PAGE_DPI pixels per inch; photos that have to be re-encoded use IMAGE_QUALITY
+IMAGE_PAGE_FIT = os.getenv("IMAGE_PAGE_FIT", "a4").lower()
+IMAGE_PAGE_DPI = float(os.getenv("IMAGE_PAGE_DPI", 150))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+_PAGE_SIZES = {"a4": (595.28, 841.89), "letter": (612.0, 792.0)}
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+# JPEG colour modes PDF viewers can decode straight from the original file
+_JPEG_COLOR_SPACES = {"RGB": "/DeviceRGB", "L": "/DeviceGray", "CMYK": "/DeviceCMYK"}
+
+# Web app thumbnails (see generate_thumbnail)
+THUMBNAIL_SIZE = 120  # max width/height in pixels
+THUMBNAIL_DPI = 50    # PDF first-page render resolution
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMBNAIL_QUALITY = 80
+
+# Page attributes a page can inherit from its ancestors in the page tree
+_INHERITABLE_PAGE_KEYS = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+# Content stream operators that can't paint anything on their own
+_NEUTRAL_OPERATORS = {
+    b"q", b"Q", b"cm", b"gs", b"w", b"re", b"W", b"W*", b"n", b"i", b"ri", b"M", b"j", b"J", b"d",
+    b"g", b"G", b"rg", b"RG", b"k", b"K", b"cs", b"CS", b"sc", b"SC", b"scn", b"SCN",
+    b"BMC", b"BDC", b"EMC", b"MP", b"DP"
+}
+# Text operators that paint glyphs (allowed only in invisible mode, i.e. an OCR layer)
+_TEXT_SHOW_OPERATORS = {b"Tj", b"TJ", b"'", b'"'}
+
+class RenderStats:
+    """Counts and timings per render path"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {}
+
+    def record(self, path: str, elapsed: float):
+        with self.lock:
+            entry = self.paths.setdefault(path, {"count": 0, "total_seconds": 0.0})
+            entry["count"] += 1
+            entry["total_seconds"] += elapsed
+
+    def merge(self, paths: dict):
+        """Add counters collected elsewhere (e.g. in a worker process)"""
+        with self.lock:
+            for path, other in paths.items():
+                entry = self.paths.setdefault(path, {"count": 0, "total_seconds": 0.0})
+                entry["count"] += other["count"]
+                entry["total_seconds"] += other["total_seconds"]
+
+    def drain(self) -> dict:
+        """Return the counters collected so far and reset them"""
+        with self.lock:
+            paths, self.paths = self.paths, {}
+        return paths
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = sum(entry["count"] for entry in self.paths.values())
+            return {
+                path: {
+                    "count": entry["count"],
+                    "share": round(entry["count"] / total, 3) if total else 0,
+                    "avg_ms": round(entry["total_seconds"] / entry["count"] * 1000, 1) if entry["count"] else 0
+                }
+                for path, entry in self.paths.items()
+            }
+
+render_stats = RenderStats()
+
+def _available_memory() -> int:
+    """Memory available for new processes in bytes, or 0 if unknown"""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def current_rss() -> int:
+    """Anonymous resident memory of this process in bytes: heap and other private pages, not
+    the page cache of memory-mapped inputs (the peak so far where that's all we can get)"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        # Resident minus file-backed (shared) pages
+        with open("/proc/self/statm") as statm:
+            fields = statm.read().split()
+            return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return 0
+
+def default_render_concurrency(memory_per_render: int = RENDER_MEMORY_ESTIMATE) -> int:
+    """How many rasterizations the host can run at once: one per CPU, fewer if memory is tight"""
+    if MAX_CONCURRENT_RENDERS > 0:
+        return MAX_CONCURRENT_RENDERS
+    limit = os.cpu_count() or 1
+    available = _available_memory()
+    if available:
+        limit = min(limit, available // memory_per_render)
+    return max(1, limit)
+
+class RenderGovernor:
+    """Caps concurrent poppler rasterizations and queues the excess fairly.
+
+    Work is queued per key (e.g. a session id) and started round-robin across keys,
+    so one client with a hundred PDFs can't starve everybody else.
+    """
+    def __init__(self, max_concurrent: int = None):
+        self.max_concurrent = max_concurrent or default_render_concurrency()
+        self.lock = threading.Lock()
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.running = 0
+        self.default_executor = None
+        self.started = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, key: str, executor, fn, *args) -> Future:
+        """Queue fn(*args) to run on executor (a thread of our own if None) once a slot is free"""
+        future = Future()
+        with self.lock:
+            self.queues.setdefault(key, deque()).append((future, executor, fn, args, time.monotonic()))
+            self.queued += 1
+        self._dispatch()
+        return future
+
+    def run(self, key: str, fn, *args):
+        """Blocking helper for threaded callers"""
+        return self.submit(key, None, fn, *args).result()
+
+    def set_limit(self, max_concurrent: int):
+        """Change the cap, e.g. to the size of the pool the work is submitted to"""
+        with self.lock:
+            self.max_concurrent = max(1, max_concurrent)
+        self._dispatch()
+
+    def _dispatch(self):
+        while True:
+            with self.lock:
+                if self.running >= self.max_concurrent or not self.queues:
+                    return
+                # Take the next job from the key at the front, then send that key to the back
+                key, queue = next(iter(self.queues.items()))
+                future, executor, fn, args, queued_at = queue.popleft()
+                if queue:
+                    self.queues.move_to_end(key)
+                else:
+                    del self.queues[key]
+                self.queued -= 1
+
+                if not future.set_running_or_notify_cancel():
+                    # Caller gave up while the job was queued
+                    continue
+
+                self.running += 1
+                self.started += 1
+                wait = time.monotonic() - queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+                if executor is None:
+                    if self.default_executor is None:
+                        self.default_executor = ThreadPoolExecutor(
+                            max_workers=self.max_concurrent, thread_name_prefix="render"
+                        )
+                    executor = self.default_executor
+
+            try:
+                inner = executor.submit(fn, *args)
+            except Exception as e:
+                self._finished(future, None, e)
+                continue
+            inner.add_done_callback(lambda inner, future=future: self._finished(future, inner))
+
+    def _finished(self, future: Future, inner: Future, error: Exception = None):
+        if inner is not None:
+            error = CancelledError() if inner.cancelled() else inner.exception()
+        with self.lock:
+            self.running -= 1
+            if isinstance(error, PDFPopplerTimeoutError):
+                self.timeouts += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(inner.result())
+        self._dispatch()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "running": self.running,
+                "queue_depth": self.queued,
+                "queued_keys": len(self.queues),
+                "started": self.started,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait / self.started * 1000, 1) if self.started else 0,
+                "max_wait_ms": round(self.max_wait * 1000, 1)
+            }
+
+render_governor = RenderGovernor()
+
+def render_pdf_first_page(file_path, dpi: int = 50, max_size: int = None,
+                          fast_path: bool = True, poppler: bool = True, timeout: int = RENDER_TIMEOUT):
+    """Render the first page of a PDF as a PIL image.
+
+    Uses an embedded /Thumb or a full-page scanned image when the page has one, and
+    falls back to poppler otherwise. Returns None if the page can't be rendered.
+    max_size lets the fast paths decode JPEGs at a reduced scale. With poppler=False
+    only the in-process fast paths are tried, so the caller can schedule the poppler
+    fallback itself (see render_governor).
+    """
+    start = time.perf_counter()
+    img = None
+    path = RENDER_PATH_FAILED
+
+    if fast_path:
+        try:
+            page = PdfReader(file_path).pages[0]
+            img = _embedded_thumbnail(page)
+            if img is not None:
+                path = RENDER_PATH_EMBEDDED_THUMB
+            else:
+                img = _scanned_page_image(page, max_size)
+                if img is not None:
+                    path = RENDER_PATH_SCANNED_IMAGE
+        except Exception as e:
+            print(f"Fast PDF thumbnail path failed for {file_path}: {e}")
+            img = None
+
+    if img is None:
+        if not poppler:
+            return None
+        try:
+            pages = convert_from_path(file_path, first_page=1, last_page=1, dpi=dpi, timeout=timeout)
+            if pages:
+                img = pages[0]
+                path = RENDER_PATH_POPPLER
+        finally:
+            render_stats.record(path, time.perf_counter() - start)
+        return img
+
+    # Honour the page's /Rotate, which the image XObject itself doesn't know about
+    rotation = int(page.get("/Rotate", 0) or 0) % 360
+    if rotation:
+        img = img.rotate(-rotation, expand=True)
+
+    render_stats.record(path, time.perf_counter() - start)
+    return img
+
+def render_pdf_first_page_governed(file_path, key: str = "default", dpi: int = 50, max_size: int = None):
+    """Blocking render for threaded callers: fast paths inline, poppler through the governor"""
+    img = render_pdf_first_page(file_path, dpi, max_size, poppler=False)
+    if img is None:
+        img = render_governor.run(key, render_pdf_first_page, file_path, dpi, max_size, False, True)
+    return img
+
+def _embedded_thumbnail(page):
+    """Decode the page's /Thumb image if it has one"""
+    thumb = page.get("/Thumb")
+    if thumb is None:
+        return None
+    return _decode_image_xobject(thumb.get_object())
+
+def _scanned_page_image(page, max_size: int = None):
+    """Decode the page's only image if the page is nothing but that image covering the page"""
+    resources = page.get("/Resources")
+    if resources is None:
+        return None
+    resources = resources.get_object()
+
+    xobjects = resources.get("/XObject")
+    if xobjects is None:
+        return None
+    xobjects = xobjects.get_object()
+    if len(xobjects) != 1:
+        return None
+
+    name, xobject = next(iter(xobjects.items()))
+    xobject = xobject.get_object()
+    if xobject.get("/Subtype") != "/Image" or xobject.get("/ImageMask") or "/SMask" in xobject or "/Mask" in xobject:
+        return None
+
+    matrix = _single_image_placement(page, name)
+    if matrix is None:
+        return None
+
+    # Image must cover (nearly) the whole page, upright and unflipped
+    a, b, c, d, e, f = matrix
+    if b or c or a <= 0 or d <= 0:
+        return None
+    box = page.mediabox
+    page_width, page_height = float(box.width), float(box.height)
+    left, bottom = e - float(box.left), f - float(box.bottom)
+    if left > page_width * 0.02 or bottom > page_height * 0.02:
+        return None
+    if a < page_width * 0.95 or d < page_height * 0.95:
+        return None
+
+    return _decode_image_xobject(xobject, max_size)
+
+def _single_image_placement(page, name: str):
+    """Return the CTM used to draw `name` if that Do is the only thing the page paints"""
+    contents = page.get_contents()
+    if contents is None:
+        return None
+    if not isinstance(contents, ContentStream):
+        contents = ContentStream(contents, page.pdf)
+
+    matrix_stack = []
+    matrix = [1.0, 0.0, 0.0, 1.0, 0.0, 0.0]
+    placement = None
+    invisible_text = False
+
+    for operands, operator in contents.operations:
+        if operator == b"q":
+            matrix_stack.append(list(matrix))
+        elif operator == b"Q":
+            if matrix_stack:
+                matrix = matrix_stack.pop()
+        elif operator == b"cm":
+            matrix = _multiply([float(x) for x in operands], matrix)
+        elif operator == b"Do":
+            if placement is not None or operands[0] != name:
+                return None
+            placement = list(matrix)
+        elif operator == b"Tr":
+            invisible_text = int(operands[0]) == 3
+        elif operator in _TEXT_SHOW_OPERATORS:
+            if not invisible_text:
+                return None
+        elif operator in _NEUTRAL_OPERATORS or operator.startswith(b"T") or operator in (b"BT", b"ET"):
+            continue
+        else:
+            # Any other painting operator (paths, inline images, shading...) - not a plain scan
+            return None
+
+    return placement
+
+def _multiply(m1, m2):
+    """Concatenate two PDF transformation matrices (m1 applied first)"""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return [
+        a1 * a2 + b1 * c2,
+        a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2,
+        c1 * b2 + d1 * d2,
+        e1 * a2 + f1 * c2 + e2,
+        e1 * b2 + f1 * d2 + f2
+    ]
+
+def _decode_image_xobject(xobject, max_size: int = None):
+    """Decode an image stream into a PIL image without going through poppler"""
+    filters = xobject.get("/Filter")
+    if isinstance(filters, list) and len(filters) == 1:
+        filters = filters[0]
+
+    if filters == "/DCTDecode":
+        # JPEG scans: let libjpeg decode at a reduced scale directly from the raw stream
+        img = Image.open(BytesIO(xobject._data))
+        if max_size:
+            img.draft("RGB", (max_size, max_size))
+        img.load()
+        return img
+
+    from pypdf.filters import _xobj_to_image
+    _, _, img = _xobj_to_image(xobject)
+    if img.mode == "1":
+        # Bilevel scans downsample badly; give the resampler grey levels to work with
+        img = img.convert("L")
+    return img
+
+def _image_target(width: int, height: int, resolution: float):
+    """Page size in points and the most pixels worth keeping for an image of width x height"""
+    page_width, page_height = width * 72.0 / resolution, height * 72.0 / resolution
+    if IMAGE_PAGE_FIT in _PAGE_SIZES:
+        # Fit the page box turned the same way as the image; small images aren't enlarged
+        box = sorted(_PAGE_SIZES[IMAGE_PAGE_FIT], reverse=width > height)
+        scale = min(1.0, box[0] / page_width, box[1] / page_height)
+        page_width, page_height = page_width * scale, page_height * scale
+    max_pixels = (max(1, round(page_width * IMAGE_PAGE_DPI / 72.0)), max(1, round(page_height * IMAGE_PAGE_DPI / 72.0)))
+    return page_width, page_height, max_pixels
+
+def prepare_image(image_path, resolution: float = IMAGE_PAGE_RESOLUTION, thumbnail_size: int = None):
+    """Build the image XObject for an image file (a path or binary file object), plus an
+    optional thumbnail from the same decode.
+
+    The page is sized from resolution, shrunk to fit IMAGE_PAGE_FIT, and the image keeps
+    at most IMAGE_PAGE_DPI pixels per inch of it, turned upright per its EXIF orientation.
+    JPEGs that already fit and are upright are embedded as they are (DCTDecode) - no decode
+    and no re-encode. Larger JPEGs are decoded at a reduced scale (draft mode) and
+    re-encoded at IMAGE_QUALITY; other formats are decoded once and stored losslessly with
+    Flate. Returns the XObject, the page size in points and the thumbnail (or None).
+    """
+    with Image.open(image_path) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        width, height = img.size
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        page_width, page_height, max_pixels = _image_target(width, height, resolution)
+
+        passthrough = (img.format == "JPEG" and img.mode in _JPEG_COLOR_SPACES and orientation == 1
+                       and width <= max_pixels[0] and height <= max_pixels[1])
+        if passthrough:
+            if hasattr(image_path, "read"):
+                image_path.seek(0)
+                data = image_path.read()
+            else:
+                with open(image_path, "rb") as jpeg_file:
+                    data = jpeg_file.read()
+            pixels = img.size
+            color_space = _JPEG_COLOR_SPACES[img.mode]
+            inverted = img.mode == "CMYK" and "adobe" in img.info
+            thumbnail = None
+            if thumbnail_size:
+                img.draft(img.mode, (thumbnail_size, thumbnail_size))
+                thumbnail = img.copy()
+                thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+        else:
+            is_jpeg = img.format == "JPEG"
+            # JPEG decoding can skip straight to 1/2, 1/4 or 1/8 scale (draft wants the stored orientation)
+            draft_size = max_pixels[::-1] if orientation in _TRANSPOSED_ORIENTATIONS else max_pixels
+            img.draft("RGB" if img.mode == "CMYK" else img.mode, draft_size)
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.thumbnail(max_pixels, Image.Resampling.LANCZOS, reducing_gap=3.0)
+            pixels = img.size
+            color_space = _JPEG_COLOR_SPACES[img.mode]
+            inverted = False
+            if is_jpeg:
+                buffer = BytesIO()
+                img.save(buffer, format="JPEG", quality=IMAGE_QUALITY, optimize=True)
+                data = buffer.getvalue()
+            else:
+                data = zlib.compress(img.tobytes())
+            thumbnail = None
+            if thumbnail_size:
+                thumbnail = img.copy()
+                thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+
+    xobject = EncodedStreamObject()
+    xobject.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(pixels[0]),
+        NameObject("/Height"): NumberObject(pixels[1]),
+        NameObject("/BitsPerComponent"): NumberObject(8),
+        NameObject("/ColorSpace"): NameObject(color_space),
+        NameObject("/Filter"): NameObject("/DCTDecode" if passthrough or is_jpeg else "/FlateDecode")
+    })
+    if inverted:
+        # Adobe CMYK JPEGs store inverted channels
+        xobject[NameObject("/Decode")] = ArrayObject([NumberObject(v) for v in (1, 0) * 4])
+    xobject._data = data
+    return xobject, page_width, page_height, thumbnail
+
+def image_thumbnail(image_path, size: int):
+    """Thumbnail of an image file, upright, decoded at the smallest JPEG scale that covers size"""
+    with Image.open(image_path) as img:
+        img.draft("RGB" if img.mode == "CMYK" else img.mode, (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size), Image.Resampling.LANCZOS)
+        return img
+
+def _image_xobject(image_path, resolution: float = IMAGE_PAGE_RESOLUTION):
+    """Image XObject and page size in points for an image file (see prepare_image)"""
+    xobject, page_width, page_height, _ = prepare_image(image_path, resolution)
+    return xobject, page_width, page_height
+
+def _image_page_parts(xobject_ref, page_width: float, page_height: float):
+    """Resources and content stream that draw image /Im0 over the whole page"""
+    grayscale = xobject_ref.get_object()["/ColorSpace"] == "/DeviceGray"
+    resources = DictionaryObject({
+        NameObject("/XObject"): DictionaryObject({NameObject("/Im0"): xobject_ref}),
+        NameObject("/ProcSet"): ArrayObject([NameObject("/PDF"), NameObject("/ImageB" if grayscale else "/ImageC")])
+    })
+    content = DecodedStreamObject()
+    content.set_data(f"q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q".encode())
+    return resources, content
+
+def add_image_page(pdf_writer, image_path, resolution: float = IMAGE_PAGE_RESOLUTION, prepared=None):
+    """Append an image to pdf_writer as a page of its own, in memory (see prepare_image)
+
+    prepared is a prepare_image result to use instead of decoding the image again.
+    """
+    xobject, page_width, page_height, _ = prepared or prepare_image(image_path, resolution)
+    resources, content = _image_page_parts(pdf_writer._add_object(xobject), page_width, page_height)
+
+    page = pdf_writer.add_blank_page(page_width, page_height)
+    page[NameObject("/Resources")] = resources
+    page[NameObject("/Contents")] = pdf_writer._add_object(content)
+    return page
+
+def index_pages(reader) -> list:
+    """Locate every page of a PDF in its page tree: [idnum, generation] per page.
+
+    Pages that inherit attributes from an ancestor get None, as do pages that aren't
+    separate objects; those have to be read through reader.pages, which flattens the
+    whole tree and copies inherited values in.
+    """
+    refs = []
+    visited = set()
+
+    def walk(node_ref, inherited: frozenset):
+        node = node_ref.get_object()
+        if isinstance(node_ref, IndirectObject):
+            if node_ref.idnum in visited:
+                raise ValueError("Page tree contains a cycle")
+            visited.add(node_ref.idnum)
+        if node.get("/Type") == "/Pages" or "/Kids" in node:
+            inherited = inherited | {key for key in _INHERITABLE_PAGE_KEYS if key in node}
+            for kid in node.get("/Kids", []):
+                walk(kid, inherited)
+        elif isinstance(node_ref, IndirectObject) and all(key in node for key in inherited):
+            refs.append([node_ref.idnum, node_ref.generation])
+        else:
+            refs.append(None)
+
+    walk(reader.trailer["/Root"].raw_get("/Pages"), frozenset())
+    return refs
+
+def get_indexed_page(reader, index: int, refs: list = None):
+    """Page index (0-based) of reader, looked up through index_pages refs when possible.
+
+    An indexed page is read on its own, so picking a few pages of a long PDF never
+    parses the rest of its page tree.
+    """
+    ref = refs[index] if refs and index < len(refs) else None
+    if ref is not None:
+        indirect = IndirectObject(ref[0], ref[1], reader)
+        node = indirect.get_object()
+        if isinstance(node, DictionaryObject) and node.get("/Type") == "/Page":
+            page = PageObject(reader, indirect)
+            page.update(node)
+            return page
+    return reader.pages[index]
+
+def encode_thumbnail(img: Image.Image) -> bytes:
+    """Encode a thumbnail as compact WebP (or JPEG when Pillow lacks WebP)"""
+    if THUMBNAIL_FORMAT == "JPEG" and img.mode != 'RGB':
+        img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    buffer = BytesIO()
+    img.save(buffer, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return buffer.getvalue()
+
+def generate_thumbnail(file_path, size: int = THUMBNAIL_SIZE, dpi: int = THUMBNAIL_DPI,
+                       fast_path: bool = True, poppler: bool = True) -> bytes:
+    """Encoded thumbnail of a PDF's first page or of an image
+
+    Failures give b"" (the default icon), except a poppler timeout, which is raised.
+    """
+    try:
+        if str(file_path).lower().endswith('.pdf'):
+            # PDF thumbnail - embedded image fast path or poppler, fallback to default icon
+            try:
+                img = render_pdf_first_page(file_path, dpi=dpi, max_size=size, fast_path=fast_path, poppler=poppler)
+                if img is not None:
+                    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                    return encode_thumbnail(img)
+            except PDFPopplerTimeoutError:
+                # Counted by the render governor the job ran under
+                raise
+            except Exception as pdf_error:
+                print(f"PDF thumbnail generation failed (poppler may not be installed): {pdf_error}")
+                # Return empty bytes to use default PDF icon
+                return b""
+        else:
+            # Image thumbnail - JPEGs decode at reduced scale, upright per EXIF
+            return encode_thumbnail(image_thumbnail(file_path, size))
+    except PDFPopplerTimeoutError:
+        raise
+    except Exception as e:
+        print(f"Error generating thumbnail: {e}")
+        return b""
+
+# Entry points of the web app's thumbnail worker processes. They live here rather than in
+# web_app.py so that a spawned worker imports the rendering code and nothing else.
+
+def thumbnail_job(file_path, fast_path: bool = True, poppler: bool = True):
+    """Thumbnail worker job: the thumbnail plus the render path stats it collected"""
+    thumbnail = generate_thumbnail(file_path, fast_path=fast_path, poppler=poppler)
+    return thumbnail, render_stats.drain()
+
+def normalize_job(file_path, file_type: str, fragment_path, thumbnail: bool = False) -> dict:
+    """Thumbnail worker job: make a ready-to-append PDF fragment and describe its pages
+
+    PDFs are appended as they are, so only images get a fragment file (a one-page PDF).
+    With thumbnail, an image's thumbnail comes out of the same decode as its page.
+    """
+    fragment_size = 0
+    thumbnail_bytes = None
+    if file_type != "pdf":
+        if not fragment_path.exists():
+            prepared = prepare_image(file_path, IMAGE_PAGE_RESOLUTION, THUMBNAIL_SIZE if thumbnail else None)
+            if thumbnail:
+                thumbnail_bytes = encode_thumbnail(prepared[3])
+            image_writer = PdfWriter()
+            add_image_page(image_writer, file_path, prepared=prepared)
+            fragment_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = fragment_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "wb") as fragment_file:
+                image_writer.write(fragment_file)
+            os.replace(tmp_path, fragment_path)
+            fragment_size = fragment_path.stat().st_size
+        elif thumbnail:
+            thumbnail_bytes = generate_thumbnail(file_path)
+        file_path = fragment_path
+
+    reader = PdfReader(file_path)
+    # Page index: where each page lives in the page tree, so combine can pick pages lazily
+    try:
+        page_refs = index_pages(reader)
+    except Exception as e:
+        print(f"Error indexing pages of {file_path}: {e}")
+        page_refs = None
+
+    page_sizes = []
+    for page in reader.pages:
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        if int(page.get("/Rotate", 0) or 0) % 180:
+            width, height = height, width
+        page_sizes.append([round(width, 2), round(height, 2)])
+    if page_refs is not None and len(page_refs) != len(page_sizes):
+        page_refs = None
+    return {"page_count": len(page_sizes), "page_sizes": page_sizes, "page_refs": page_refs,
+            "fragment_path": str(file_path), "fragment_size": fragment_size, "thumbnail": thumbnail_bytes}
+
+class StreamingPdfWriter:
+    """Writes a merged PDF incrementally.
+
+    Each added page is copied together with everything it references and written to
+    the output straight away, so nothing but the xref offsets stays in memory and the
+    output can be sent while later sources are still being read. The page tree,
+    catalog and xref table are written by close(). References that don't resolve are
+    written as null, as are numbers reserved for objects a failed source never wrote.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.offsets = [None]   # byte offset per object number (0 is the free list head)
+        self.page_numbers = []
+        self.source_maps = {}   # per source: (idnum, generation) -> object number in the output
+        self.pages_number = self._reserve()
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _reserve(self) -> int:
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def _write(self, data: bytes):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def _write_object(self, number: int, obj):
+        buffer = BytesIO()
+        buffer.write(f"{number} 0 obj\n".encode())
+        obj.write_to_stream(buffer)
+        buffer.write(b"\nendobj\n")
+        self.offsets[number] = self.position
+        self._write(buffer.getvalue())
+
+    def mark(self) -> int:
+        """State to roll back to if the next source fails part way (see rollback)"""
+        return len(self.page_numbers)
+
+    def rollback(self, mark: int):
+        """Drop the pages added since mark. What they already wrote stays in the file, unreferenced,
+        and references to objects they never got to write are forgotten so later pages copy them again."""
+        del self.page_numbers[mark:]
+        for mapping in self.source_maps.values():
+            for key in [key for key, number in mapping.items() if self.offsets[number] is None]:
+                del mapping[key]
+
+    def add_page(self, page, source_key, rotate: int = 0):
+        """Copy a page of a source PDF (source_key identifies that source) to the output"""
+        mapping = self.source_maps.setdefault(source_key, {})
+        number = None
+        if page.indirect_reference is not None:
+            key = (page.indirect_reference.idnum, page.indirect_reference.generation)
+            number = mapping.get(key)
+        pending = []
+        if number is None or self.offsets[number] is not None:
+            repeated = number is not None
+            # A page selected again is written as a copy of its own
+            number = self._reserve()
+            if page.indirect_reference is not None:
+                # Annotations point back at their page through /P
+                mapping.setdefault(key, number)
+            if repeated:
+                # ...and so are its annotations, which belong to one page: they are copied again
+                # with /P pointing at this copy, while everything else stays shared
+                mapping = ChainMap({key: number}, mapping)
+                annots = page.raw_get("/Annots") if "/Annots" in page else None
+                refs = [annots] if isinstance(annots, IndirectObject) else []
+                refs += [ref for ref in (page.get("/Annots") or []) if isinstance(ref, IndirectObject)]
+                for ref in refs:
+                    target = ref.get_object()
+                    if target is not None:
+                        mapping.maps[0][(ref.idnum, ref.generation)] = self._reserve()
+                        pending.append((mapping[(ref.idnum, ref.generation)], target))
+
+        copy = DictionaryObject()
+        for name, value in page.items():
+            if name == "/Parent":
+                continue
+            copy[NameObject(name)] = self._translate(value, mapping, pending)
+        copy[NameObject("/Parent")] = IndirectObject(self.pages_number, 0, None)
+        if rotate:
+            copy[NameObject("/Rotate")] = NumberObject((int(page.get("/Rotate", 0) or 0) + rotate) % 360)
+
+        self._write_object(number, copy)
+        self._flush_pending(mapping, pending)
+        self.page_numbers.append(number)
+
+    def add_image_page(self, image_path, resolution: float = IMAGE_PAGE_RESOLUTION, rotate: int = 0):
+        """Write an image as a page of its own (see _image_xobject)"""
+        xobject, page_width, page_height = _image_xobject(image_path, resolution)
+        xobject_number = self._reserve()
+        self._write_object(xobject_number, xobject)
+
+        resources, content = _image_page_parts(_LocalRef(xobject_number, xobject), page_width, page_height)
+        content_number = self._reserve()
+        self._write_object(content_number, content)
+
+        page = DictionaryObject({
+            NameObject("/Type"): NameObject("/Page"),
+            NameObject("/Parent"): IndirectObject(self.pages_number, 0, None),
+            NameObject("/MediaBox"): ArrayObject([NumberObject(0), NumberObject(0),
+                                                  FloatObject(round(page_width, 4)), FloatObject(round(page_height, 4))]),
+            NameObject("/Resources"): resources,
+            NameObject("/Contents"): IndirectObject(content_number, 0, None)
+        })
+        if rotate:
+            page[NameObject("/Rotate")] = NumberObject(rotate % 360)
+        page_number = self._reserve()
+        self._write_object(page_number, page)
+        self.page_numbers.append(page_number)
+
+    def _translate(self, obj, mapping: dict, pending: list):
+        """Copy a direct object, renumbering indirect references into the output"""
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in mapping:
+                return IndirectObject(mapping[key], 0, None)
+            target = obj.get_object()
+            if target is None or isinstance(target, NullObject):
+                # A dangling reference (the object isn't in the source) reads as null
+                return NullObject()
+            if isinstance(target, DictionaryObject) and target.get("/Type") in ("/Page", "/Pages"):
+                # Links into pages we haven't copied (yet) would drag in the whole source page tree
+                return NullObject()
+            number = self._reserve()
+            mapping[key] = number
+            pending.append((number, target))
+            return IndirectObject(number, 0, None)
+
+        if isinstance(obj, StreamObject):
+            copy = EncodedStreamObject() if "/Filter" in obj else DecodedStreamObject()
+            copy._data = obj._data
+            for name, value in obj.items():
+                if name != "/Length":
+                    copy[NameObject(name)] = self._translate(value, mapping, pending)
+            return copy
+
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for name, value in obj.items():
+                copy[NameObject(name)] = self._translate(value, mapping, pending)
+            return copy
+
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([self._translate(value, mapping, pending) for value in obj])
+
+        return obj
+
+    def _flush_pending(self, mapping: dict, pending: list):
+        """Write every object reached from the page that hasn't been written yet"""
+        while pending:
+            number, target = pending.pop()
+            self._write_object(number, self._translate(target, mapping, pending))
+
+    def close(self):
+        """Write the page tree, catalog, xref table and trailer"""
+        self._write_object(self.pages_number, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject([IndirectObject(n, 0, None) for n in self.page_numbers]),
+            NameObject("/Count"): NumberObject(len(self.page_numbers))
+        }))
+        catalog_number = self._reserve()
+        self._write_object(catalog_number, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.pages_number, 0, None)
+        }))
+        for number, offset in enumerate(self.offsets):
+            if number and offset is None:
+                self._write_object(number, NullObject())
+
+        xref_position = self.position
+        lines = [f"xref\n0 {len(self.offsets)}\n", "0000000000 65535 f \n"]
+        for offset in self.offsets[1:]:
+            lines.append(f"{offset:010d} 00000 n \n")
+        self._write("".join(lines).encode())
+        self._write(
+            f"trailer\n<< /Size {len(self.offsets)} /Root {catalog_number} 0 R >>\n"
+            f"startxref\n{xref_position}\n%%EOF\n".encode()
+        )
+
+class _LocalRef(IndirectObject):
+    """Reference to an object already written by a StreamingPdfWriter"""
+    def __init__(self, number: int, obj):
+        super().__init__(number, 0, None)
+        self.obj = obj
+
+    def get_object(self):
+        return self.obj
+
+def parse_page_ranges(pages, page_count: int = None, name: str = "the file",
+                      limit: int = MAX_PAGE_SELECTION) -> list:
+    """1-based page numbers from a list of numbers and "first-last" ranges, or one string
+    of them like "1-3,7". Raises ValueError.
+
+    Bounds are checked before a range is expanded: every page must lie within page_count
+    (when it is known) and the selection may hold at most limit pages.
+    """
+    parts = pages.split(",") if isinstance(pages, str) else pages
+    if not isinstance(parts, list):
+        raise ValueError("pages must be a list or a string of page ranges")
+    if len(parts) > limit:
+        raise ValueError(f"A page selection may hold at most {limit} pages")
+    numbers = []
+    for part in parts:
+        try:
+            if isinstance(part, str) and "-" in part.strip().lstrip("-"):
+                first, last = (int(bound) for bound in part.split("-", 1))
+                if first > last:
+                    raise ValueError()
+            else:
+                first = last = int(part)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid page selection: {part!r}")
+        for page in (first, last):
+            if page < 1 or (page_count is not None and page > page_count):
+                raise ValueError(f"Page {page} is out of range for {name}"
+                                 + (f" ({page_count} pages)" if page_count is not None else ""))
+        if len(numbers) + last - first + 1 > limit:
+            raise ValueError(f"A page selection may hold at most {limit} pages")
+        numbers.extend(range(first, last + 1))
+    return numbers
+
+def iter_merged_pdf(sources, chunk_size: int = 256 * 1024, on_error=None):
+    """Merge sources and yield the output PDF in chunks as it is produced.
+
+    sources is a list of (path, kind, pages, rotate, refs) with path a file path or a
+    seekable binary file object, kind "pdf" or "image", pages the 0-based page indexes to
+    copy (None for all), rotate a multiple of 90 added to each of them and refs the
+    index_pages result, if known. A source that fails is left out and passed to
+    on_error(path, error), which may raise to abort the merge instead.
+    """
+    buffer = BytesIO()
+    writer = StreamingPdfWriter(buffer)
+
+    def take():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    for _ in _copy_sources(writer, sources, _read_pdf, on_error):
+        if buffer.tell() >= chunk_size:
+            yield take()
+
+    writer.close()
+    yield take()
+
+@contextmanager
+def _read_pdf(path):
+    yield PdfReader(path)
+
+@contextmanager
+def _mapped_pdf(path):
+    """PdfReader over a memory map of the file: the OS pages the input in and out as needed"""
+    with open(path, "rb") as pdf_file:
+        mapped = mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = PdfReader(mapped)
+            yield reader
+            reader.resolved_objects.clear()
+        finally:
+            mapped.close()
+
+def count_pages(path) -> int:
+    """Page count of a PDF, read from its page tree root without loading the file"""
+    with _mapped_pdf(path) as reader:
+        return len(reader.pages)
+
+def _copy_sources(writer, sources, open_pdf, on_error=None):
+    """Copy sources (see iter_merged_pdf) into a StreamingPdfWriter, yielding the open reader
+    (None for images) after every page. Unreadable sources are reported to on_error and skipped."""
+    for path, kind, pages, rotate, refs in sources:
+        mark = writer.mark()
+        try:
+            if kind == "pdf":
+                with open_pdf(path) as reader:
+                    for index in (range(len(refs or reader.pages)) if pages is None else pages):
+                        # Objects are shared between selections of the same file, so key them by path
+                        writer.add_page(get_indexed_page(reader, index, refs), str(path), rotate)
+                        yield reader
+            elif pages is None or pages:
+                writer.add_image_page(path, rotate=rotate)
+                yield None
+        except Exception as e:
+            # Pages of the source copied before it failed are dropped with the rest of it
+            writer.rollback(mark)
+            if on_error is not None:
+                on_error(path, e)
+            else:
+                print(f"Error merging {path}: {e}")
+
+def use_low_memory_merge(input_bytes: int) -> bool:
+    """Whether inputs adding up to input_bytes should be merged with merge_pdf_low_memory"""
+    if LOW_MEMORY_MERGE in ("always", "never"):
+        return LOW_MEMORY_MERGE == "always"
+    return input_bytes > LOW_MEMORY_MERGE_BYTES
+
+def merge_pdf_low_memory(sources, output, rss_target: int = MERGE_RSS_TARGET, progress=None, on_error=None) -> dict:
+    """Merge sources (see iter_merged_pdf) into the binary file object output with bounded memory.
+
+    A PdfWriter holds every added document until write(); here inputs are memory-mapped,
+    each page is copied and written out straight away (StreamingPdfWriter), and the
+    reader's parsed objects are dropped whenever anonymous memory (current_rss, which leaves
+    out the mapped inputs) passes rss_target, so inputs larger than RAM can be merged.
+    progress(pages_processed, bytes_written) is called after each page and may raise to
+    abort. Returns what the merge took, including the peak anonymous memory sampled.
+    """
+    started = time.time()
+    writer = StreamingPdfWriter(output)
+    peak_rss = current_rss()
+    flushes = 0
+    flush_floor = 0
+    pages_processed = 0
+
+    copier = _copy_sources(writer, sources, _mapped_pdf, on_error)
+    try:
+        for reader in copier:
+            pages_processed += 1
+            rss = current_rss()
+            peak_rss = max(peak_rss, rss)
+            # Only flush once the cache has grown again since the last flush: memory the cache
+            # doesn't hold (a large baseline, an image being converted) is not freed by flushing
+            if (rss > rss_target and rss - flush_floor > MERGE_FLUSH_GROWTH
+                    and reader is not None and reader.resolved_objects):
+                # Everything copied so far is already on disk; later pages re-read what they need
+                reader.resolved_objects.clear()
+                gc.collect()
+                flushes += 1
+                flush_floor = current_rss()
+            if progress is not None:
+                progress(pages_processed, writer.position)
+    finally:
+        # Unmaps the current input if progress aborted the merge
+        copier.close()
+
+    writer.close()
+    return {
+        "pages": len(writer.page_numbers),
+        "bytes_written": writer.position,
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+        "rss_target_mb": round(rss_target / (1024 * 1024), 1),
+        "cache_flushes": flushes,
+        "seconds": round(time.time() - started, 3)
+    }
+
+# Objects the optimizer never merges: each occurrence is a distinct node of the document.
+# Annotations may leave out /Type but always have a /Rect; form fields and structure
+# elements are linked into their trees through /Parent, /Kids or /P.
+_UNIQUE_OBJECT_TYPES = ("/Page", "/Pages", "/Catalog", "/Annot", "/StructElem", "/StructTreeRoot")
+_UNIQUE_OBJECT_KEYS = ("/P", "/Parent", "/Kids", "/Rect", "/FT")
+
+def _is_unique_node(obj) -> bool:
+    return isinstance(obj, DictionaryObject) and (
+        obj.get("/Type") in _UNIQUE_OBJECT_TYPES or any(name in obj for name in _UNIQUE_OBJECT_KEYS)
+    )
+
+def optimize_pdf(input_path, output, checkpoint=None) -> dict:
+    """Rewrite a merged PDF smaller: the optimization stage after a combine.
+
+    - identical objects and streams (fonts, logos, ICC profiles repeated once per merged
+      source) are merged by hash, repeating until objects that only differed in which
+      copy they referenced are merged as well
+    - streams stored without a filter are Flate-compressed when that makes them smaller
+    - objects that nothing references any more are dropped
+    The result is written to the binary file object output. checkpoint(), if given, is
+    called now and then and may raise to abort. Returns the sizes and counts.
+    """
+    started = time.time()
+    with _mapped_pdf(input_path) as reader:
+        # Everything reachable from the trailer; the rest is dropped
+        roots = {name: reader.trailer.raw_get(name) for name in ("/Root", "/Info") if name in reader.trailer}
+        objects = {}
+        queue = [ref for ref in roots.values() if isinstance(ref, IndirectObject)]
+        while queue:
+            ref = queue.pop()
+            key = (ref.idnum, ref.generation)
+            if key in objects:
+                continue
+            obj = ref.get_object()
+            if obj is None or isinstance(obj, NullObject):
+                # Dangling reference - written as null
+                continue
+            objects[key] = obj
+            queue.extend(_references(obj))
+            if checkpoint is not None and len(objects) % 1000 == 0:
+                checkpoint()
+        total_objects = len(({idnum for table in reader.xref.values() for idnum in table}
+                             | set(reader.xref_objStm)) - {0})
+
+        # Stream data is hashed once; merging is repeated until no more objects fold together
+        digests = {key: hashlib.sha256(obj._data).digest() for key, obj in objects.items()
+                   if isinstance(obj, StreamObject)}
+        canonical = {key: key for key in objects}
+        while True:
+            if checkpoint is not None:
+                checkpoint()
+            groups = {}
+            merged = {}
+            for key in sorted(objects):
+                obj = objects[key]
+                if _is_unique_node(obj):
+                    merged[key] = key
+                    continue
+                signature = (_signature(obj, canonical), digests.get(key))
+                merged[key] = groups.setdefault(signature, key)
+            if merged == canonical:
+                break
+            canonical = merged
+
+        # Renumber the surviving objects densely, in their original order
+        survivors = sorted(set(canonical.values()))
+        numbers = {key: number for number, key in enumerate(survivors, start=1)}
+        renumber = {key: numbers[canonical[key]] for key in objects}
+
+        header = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+        output.write(header)
+        position = len(header)
+        offsets = []
+        compressed = 0
+        for key in survivors:
+            obj = _renumbered(objects[key], renumber)
+            if isinstance(obj, StreamObject) and "/Filter" not in obj:
+                packed = zlib.compress(obj._data, 6)
+                if len(packed) < len(obj._data):
+                    obj = _flate_stream(obj, packed)
+                    compressed += 1
+            buffer = BytesIO()
+            buffer.write(f"{numbers[key]} 0 obj\n".encode())
+            obj.write_to_stream(buffer)
+            buffer.write(b"\nendobj\n")
+            offsets.append(position)
+            output.write(buffer.getvalue())
+            position += buffer.tell()
+            if checkpoint is not None and len(offsets) % 1000 == 0:
+                checkpoint()
+
+        lines = [f"xref\n0 {len(offsets) + 1}\n", "0000000000 65535 f \n"]
+        lines += [f"{offset:010d} 00000 n \n" for offset in offsets]
+        trailer = "".join(f" {name} {renumber[(ref.idnum, ref.generation)]} 0 R" for name, ref in roots.items()
+                          if isinstance(ref, IndirectObject) and (ref.idnum, ref.generation) in renumber)
+        lines.append(f"trailer\n<< /Size {len(offsets) + 1}{trailer} >>\nstartxref\n{position}\n%%EOF\n")
+        output.write("".join(lines).encode())
+        position += len("".join(lines))
+
+    bytes_before = os.path.getsize(input_path)
+    return {
+        "bytes_before": bytes_before,
+        "bytes_after": position,
+        "bytes_saved": bytes_before - position,
+        "duplicates_merged": len(objects) - len(survivors),
+        "streams_compressed": compressed,
+        "unreferenced_dropped": max(total_objects - len(objects), 0),
+        "seconds": round(time.time() - started, 3)
+    }
+
+def _references(obj):
+    """Indirect references directly inside obj"""
+    if isinstance(obj, IndirectObject):
+        yield obj
+    elif isinstance(obj, DictionaryObject):
+        for value in obj.values():
+            yield from _references(value)
+    elif isinstance(obj, ArrayObject):
+        for value in obj:
+            yield from _references(value)
+
+def _signature(obj, canonical: dict):
+    """Hashable description of obj with references replaced by their canonical objects"""
+    if isinstance(obj, IndirectObject):
+        return ("R", canonical.get((obj.idnum, obj.generation)))
+    if isinstance(obj, DictionaryObject):
+        # /Length is implied by the stream data, which is compared by digest
+        return ("D", tuple(sorted((name, _signature(value, canonical)) for name, value in obj.items()
+                                  if not (name == "/Length" and isinstance(obj, StreamObject)))))
+    if isinstance(obj, ArrayObject):
+        return ("A", tuple(_signature(value, canonical) for value in obj))
+    return (type(obj).__name__, repr(obj))
+
+def _renumbered(obj, renumber: dict):
+    """Copy of a direct object with references pointing at the output object numbers"""
+    if isinstance(obj, IndirectObject):
+        number = renumber.get((obj.idnum, obj.generation))
+        return NullObject() if number is None else IndirectObject(number, 0, None)
+    if isinstance(obj, StreamObject):
+        copy = EncodedStreamObject() if "/Filter" in obj else DecodedStreamObject()
+        copy._data = obj._data
+        for name, value in obj.items():
+            if name != "/Length":
+                copy[NameObject(name)] = _renumbered(value, renumber)
+        return copy
+    if isinstance(obj, DictionaryObject):
+        return DictionaryObject({NameObject(name): _renumbered(value, renumber) for name, value in obj.items()})
+    if isinstance(obj, ArrayObject):
+        return ArrayObject([_renumbered(value, renumber) for value in obj])
+    return obj
+
+def _flate_stream(stream, data: bytes):
+    """Flate-encoded copy of an unfiltered stream"""
+    copy = EncodedStreamObject()
+    copy._data = data
+    copy.update(stream)
+    copy[NameObject("/Filter")] = NameObject("/FlateDecode")
+    return copy
+
+def linearize_pdf(input_path, output_path, timeout: int = LINEARIZE_TIMEOUT) -> bool:
+    """Write a linearized copy of a PDF with qpdf, so viewers can show page 1 before the rest arrives.
+
+    Returns False (and writes nothing usable) if qpdf isn't installed or fails.
+    """
+    if QPDF_PATH is None:
+        return False
+    try:
+        result = subprocess.run([QPDF_PATH, "--linearize", str(input_path), str(output_path)],
+                                capture_output=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"Error linearizing {input_path}: {e}")
+        return False
+    # Exit status 3 means qpdf succeeded with warnings
+    if result.returncode not in (0, 3):
+        print(f"Error linearizing {input_path}: {result.stderr.decode(errors='replace').strip()}")
+        return False
+    return True
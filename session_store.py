@@ -0,0 +1,743 @@
+"""
+Session state storage for the web app (web_app.py).
+
+A session is a plain JSON-compatible dict:
+    {"files": {file_id: file_info}, "order": [file_id, ...],
+     "created_at": ..., "last_accessed": ..., "downloaded": False, ...}
+
+An order entry is either a file id (the whole file) or a page selection
+{"file_id": ..., "pages": [1-based page numbers] or None, "rotate": degrees}.
+
+Every backend applies a mutation as one atomic read-modify-write of the whole session,
+so concurrent uploads, removals and reorders - from any worker process sharing the
+backend - never lose each other's updates. Combine job records are kept the same way,
+so any worker can report on (or cancel) a job another worker is running.
+
+Access bookkeeping - last_accessed and the downloaded flag - is kept beside the record
+rather than in it (a dict, columns or a hash and sorted set), so touching a session on
+every poll is one small write instead of a rewrite of the whole record. get() merges
+them back in. Each backend also keeps an expiry index of sessions ordered by the time
+they expire (a heap, an indexed column or a sorted set), updated with every touch, so a
+cleanup sweep only looks at sessions that actually expired.
+"""
+
+import copy
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Backend selection - several workers need a shared backend, so they default to SQLite.
+# WEB_CONCURRENCY is what uvicorn --workers and gunicorn default to.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", os.getenv("WEB_CONCURRENCY", 1)))
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite" if WEB_WORKERS > 1 else "memory")  # memory, sqlite or redis
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "cache/sessions.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+def entry_file_id(entry) -> str:
+    """File id of an order entry"""
+    return entry["file_id"] if isinstance(entry, dict) else entry
+
+def new_session() -> dict:
+    """Empty session record"""
+    now = time.time()
+    return {
+        "files": {},
+        "order": [],
+        "created_at": now,
+        "last_accessed": now,
+        "downloaded": False
+    }
+
+class SessionStore:
+    """Base class: backends provide record primitives, the session and job operations are shared
+
+    Records are JSON dicts of a kind ("session" or "job") addressed by id.
+    """
+    name = "base"
+    # Inactivity allowed before a session expires, and once it has been downloaded
+    session_timeout = 3600
+    downloaded_timeout = 600
+    # Seconds between two access writes for one session from this process (polls touch a lot)
+    touch_interval = 5.0
+
+    def __init__(self):
+        self.recent_touches = {}
+
+    def expires_at(self, session: dict) -> float:
+        """When a session expires if it isn't accessed again"""
+        return self._expiry(session["last_accessed"], session.get("downloaded"))
+
+    def _expiry(self, last_accessed: float, downloaded: bool) -> float:
+        timeout = self.session_timeout
+        if downloaded:
+            timeout = min(timeout, self.downloaded_timeout)
+        return last_accessed + timeout
+
+    def expired(self, now: float, limit: int = None) -> list:
+        """Ids of sessions whose expiry time has passed, soonest first"""
+        raise NotImplementedError
+
+    def downloaded_sessions(self, limit: int) -> list:
+        """Ids of up to limit downloaded sessions, least recently accessed first"""
+        raise NotImplementedError
+
+    def incr_counters(self, name: str, deltas: dict):
+        """Atomically add deltas to a group of integer counters"""
+        raise NotImplementedError
+
+    def get_counters(self, name: str) -> dict:
+        """Current values of a counter group"""
+        raise NotImplementedError
+
+    def set_counters(self, name: str, values: dict):
+        """Replace a counter group"""
+        raise NotImplementedError
+
+    def _get(self, kind: str, record_id: str):
+        """Snapshot of a record, or None"""
+        raise NotImplementedError
+
+    def _insert(self, kind: str, record_id: str, record: dict) -> bool:
+        """Store a record unless one with this id exists; True if it was stored"""
+        raise NotImplementedError
+
+    def _delete(self, kind: str, record_id: str):
+        """Remove a record and return its last state, or None"""
+        raise NotImplementedError
+
+    def _mutate(self, kind: str, record_id: str, mutate):
+        """Atomically apply mutate(record) and return its result (None if the record is gone)
+
+        Session records are mutated without their access fields, which only _set_access writes.
+        """
+        raise NotImplementedError
+
+    def _set_access(self, session_id: str, last_accessed: float, downloaded) -> bool:
+        """Store the access time (and the downloaded flag unless None) and re-index the expiry"""
+        raise NotImplementedError
+
+    def ids(self) -> list:
+        """All session ids"""
+        raise NotImplementedError
+
+    def get(self, session_id: str):
+        """Snapshot of a session, or None"""
+        return self._get("session", session_id)
+
+    def create(self, session_id: str) -> bool:
+        """Create an empty session unless it exists; True if it was created"""
+        return self._insert("session", session_id, new_session())
+
+    def delete(self, session_id: str):
+        """Remove a session and return its last state, or None"""
+        self.recent_touches.pop(session_id, None)
+        return self._delete("session", session_id)
+
+    def _update(self, session_id: str, mutate):
+        return self._mutate("session", session_id, mutate)
+
+    def exists(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def count(self) -> int:
+        return len(self.ids())
+
+    def items(self):
+        """(session_id, snapshot) for every session"""
+        for session_id in self.ids():
+            session = self.get(session_id)
+            if session is not None:
+                yield session_id, session
+
+    def touch(self, session_id: str, downloaded: bool = None) -> bool:
+        """Bump last_accessed (and optionally set the downloaded flag); False if the session is gone
+
+        A plain touch within touch_interval of the last one from this process is skipped.
+        """
+        now = time.time()
+        if downloaded is None:
+            touched_at = self.recent_touches.get(session_id)
+            if touched_at is not None and now - touched_at < self.touch_interval:
+                return True
+        if not self._set_access(session_id, now, downloaded):
+            self.recent_touches.pop(session_id, None)
+            return False
+        if len(self.recent_touches) > 10000:
+            self.recent_touches.clear()
+        self.recent_touches[session_id] = now
+        return True
+
+    def set_fields(self, session_id: str, **fields) -> bool:
+        """Set top-level session fields"""
+        def mutate(session):
+            session.update(fields)
+            return True
+        return bool(self._update(session_id, mutate))
+
+    def add_files(self, session_id: str, file_infos: list) -> bool:
+        """Append files to the session and to the end of its order"""
+        def mutate(session):
+            for file_info in file_infos:
+                session["files"][file_info["id"]] = file_info
+                session["order"].append(file_info["id"])
+            return True
+        return bool(self._update(session_id, mutate))
+
+    def remove_file(self, session_id: str, file_id: str):
+        """Remove a file from the session and its order; returns its file info or None"""
+        def mutate(session):
+            session["order"] = [entry for entry in session["order"] if entry_file_id(entry) != file_id]
+            return session["files"].pop(file_id, None)
+        return self._update(session_id, mutate)
+
+    def update_file(self, session_id: str, file_id: str, fields: dict) -> bool:
+        """Merge fields into a file's info; False if the file or session is gone"""
+        def mutate(session):
+            file_info = session["files"].get(file_id)
+            if file_info is None:
+                return False
+            file_info.update(fields)
+            return True
+        return bool(self._update(session_id, mutate))
+
+    def set_order(self, session_id: str, order: list) -> bool:
+        """Replace the file order
+
+        Unknown ids are dropped and files missing from order (e.g. uploaded while the client
+        was reordering) are kept at the end, so a stale order can't lose or resurrect files.
+        A file may appear in several page selections, but only once as a plain id.
+        """
+        def mutate(session):
+            files = session["files"]
+            new_order = []
+            listed = set()
+            plain = set()
+            for entry in order:
+                file_id = entry_file_id(entry)
+                if file_id not in files:
+                    continue
+                if not isinstance(entry, dict):
+                    if entry in plain:
+                        continue
+                    plain.add(entry)
+                new_order.append(entry)
+                listed.add(file_id)
+            new_order += [entry for entry in session["order"]
+                          if entry_file_id(entry) in files and entry_file_id(entry) not in listed]
+            session["order"] = new_order
+            return True
+        return bool(self._update(session_id, mutate))
+
+    def add_usage(self, session_id: str, deltas: dict):
+        """Add deltas to the session's disk usage counters; returns them (None if the session is gone)"""
+        def mutate(session):
+            usage = session.setdefault("usage", {})
+            for field, delta in deltas.items():
+                usage[field] = usage.get(field, 0) + delta
+            return dict(usage)
+        return self._update(session_id, mutate)
+
+    def add_job(self, session_id: str, job: dict) -> bool:
+        """Store a new job record and list it on its session"""
+        def mutate(session):
+            session.setdefault("jobs", []).append(job["id"])
+            return True
+        if not self._update(session_id, mutate):
+            return False
+        return self._insert("job", job["id"], job)
+
+    def get_job(self, job_id: str):
+        """Snapshot of a job record, or None"""
+        return self._get("job", job_id)
+
+    def update_job(self, job_id: str, fields: dict):
+        """Merge fields into a job record and return the result (None if it was deleted)"""
+        def mutate(job):
+            job.update(fields)
+            return dict(job)
+        return self._mutate("job", job_id, mutate)
+
+    def delete_job(self, job_id: str):
+        """Remove a job record"""
+        return self._delete("job", job_id)
+
+    def close(self):
+        pass
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict of this process - the default for a single worker"""
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self.records = {"session": {}, "job": {}}
+        self.sessions = self.records["session"]
+        self.access = {}  # session_id -> [last_accessed, downloaded]
+        self.downloaded = OrderedDict()  # downloaded sessions, least recently accessed first
+        self.lock = threading.RLock()
+        # Min-heap of (expires_at, session_id); entries superseded by a later write are skipped
+        self.expiry_heap = []
+        self.expiry = {}
+        self.counters = {}
+
+    def _index(self, session_id: str):
+        expires_at = self._expiry(*self.access[session_id])
+        if self.expiry.get(session_id) == expires_at:
+            return
+        self.expiry[session_id] = expires_at
+        heapq.heappush(self.expiry_heap, (expires_at, session_id))
+        if len(self.expiry_heap) > 2 * len(self.expiry) + 64:
+            # Mostly stale entries - rebuild from the live ones
+            self.expiry_heap = [(expires, sid) for sid, expires in self.expiry.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def expired(self, now: float, limit: int = None) -> list:
+        with self.lock:
+            due = []
+            while self.expiry_heap and self.expiry_heap[0][0] <= now and (limit is None or len(due) < limit):
+                entry = heapq.heappop(self.expiry_heap)
+                if self.expiry.get(entry[1]) == entry[0]:
+                    due.append(entry)
+            # Due sessions stay indexed until they are deleted; stale entries are dropped for good
+            for entry in due:
+                heapq.heappush(self.expiry_heap, entry)
+            return [session_id for _, session_id in due]
+
+    def _get(self, kind: str, record_id: str):
+        with self.lock:
+            record = self.records[kind].get(record_id)
+            if record is None:
+                return None
+            record = copy.deepcopy(record)
+            if kind == "session":
+                record["last_accessed"], record["downloaded"] = self.access[record_id]
+            return record
+
+    def _insert(self, kind: str, record_id: str, record: dict) -> bool:
+        with self.lock:
+            if record_id in self.records[kind]:
+                return False
+            record = copy.deepcopy(record)
+            if kind == "session":
+                self.access[record_id] = [record.pop("last_accessed"), record.pop("downloaded")]
+                self._index(record_id)
+            self.records[kind][record_id] = record
+            return True
+
+    def _delete(self, kind: str, record_id: str):
+        with self.lock:
+            record = self.records[kind].pop(record_id, None)
+            if kind == "session":
+                self.expiry.pop(record_id, None)
+                self.downloaded.pop(record_id, None)
+                access = self.access.pop(record_id, None)
+                if record is not None:
+                    record["last_accessed"], record["downloaded"] = access
+            return record
+
+    def _mutate(self, kind: str, record_id: str, mutate):
+        with self.lock:
+            record = self.records[kind].get(record_id)
+            if record is None:
+                return None
+            return mutate(record)
+
+    def _set_access(self, session_id: str, last_accessed: float, downloaded) -> bool:
+        with self.lock:
+            access = self.access.get(session_id)
+            if access is None:
+                return False
+            access[0] = last_accessed
+            if downloaded is not None:
+                access[1] = downloaded
+            self._index(session_id)
+            if access[1]:
+                self.downloaded[session_id] = True
+                self.downloaded.move_to_end(session_id)
+            else:
+                self.downloaded.pop(session_id, None)
+            return True
+
+    def downloaded_sessions(self, limit: int) -> list:
+        with self.lock:
+            return list(itertools.islice(self.downloaded, limit))
+
+    def exists(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    def incr_counters(self, name: str, deltas: dict):
+        with self.lock:
+            counters = self.counters.setdefault(name, {})
+            for field, delta in deltas.items():
+                counters[field] = counters.get(field, 0) + delta
+
+    def get_counters(self, name: str) -> dict:
+        with self.lock:
+            return dict(self.counters.get(name, {}))
+
+    def set_counters(self, name: str, values: dict):
+        with self.lock:
+            self.counters[name] = dict(values)
+
+    def ids(self) -> list:
+        with self.lock:
+            return list(self.sessions)
+
+    def count(self) -> int:
+        return len(self.sessions)
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in a SQLite database in WAL mode, shared by all workers on one host"""
+    name = "sqlite"
+    tables = {"session": "sessions", "job": "jobs"}
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        super().__init__()
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.local = threading.local()
+        db = self._connection()
+        for table in self.tables.values():
+            db.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        for column in ("expires_at REAL", "last_accessed REAL", "downloaded INTEGER NOT NULL DEFAULT 0"):
+            try:
+                db.execute(f"ALTER TABLE sessions ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass  # already there
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_downloaded ON sessions (downloaded, last_accessed)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS counters (name TEXT, field TEXT, value INTEGER NOT NULL, "
+            "PRIMARY KEY (name, field))"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; autocommit mode with explicit transactions
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _get(self, kind: str, record_id: str):
+        if kind == "session":
+            row = self._connection().execute(
+                "SELECT data, last_accessed, downloaded FROM sessions WHERE id = ?", (record_id,)
+            ).fetchone()
+            return self._session(*row) if row else None
+        row = self._connection().execute(
+            f"SELECT data FROM {self.tables[kind]} WHERE id = ?", (record_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _session(data: str, last_accessed, downloaded) -> dict:
+        session = json.loads(data)
+        # Rows written before the access columns existed keep theirs in the record
+        if last_accessed is not None:
+            session["last_accessed"] = last_accessed
+            session["downloaded"] = bool(downloaded)
+        return session
+
+    def _insert(self, kind: str, record_id: str, record: dict) -> bool:
+        if kind == "session":
+            record = dict(record)
+            last_accessed, downloaded = record.pop("last_accessed"), record.pop("downloaded")
+            cursor = self._connection().execute(
+                "INSERT OR IGNORE INTO sessions (id, data, expires_at, last_accessed, downloaded) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (record_id, json.dumps(record), self._expiry(last_accessed, downloaded), last_accessed,
+                 int(downloaded))
+            )
+        else:
+            cursor = self._connection().execute(
+                f"INSERT OR IGNORE INTO {self.tables[kind]} (id, data) VALUES (?, ?)", (record_id, json.dumps(record))
+            )
+        return cursor.rowcount == 1
+
+    def _delete(self, kind: str, record_id: str):
+        record = self._get(kind, record_id) if kind == "session" else None
+        deleted = self._transaction(kind, record_id, lambda record: record, delete=True)
+        return record if deleted is not None and record is not None else deleted
+
+    def _mutate(self, kind: str, record_id: str, mutate):
+        return self._transaction(kind, record_id, mutate)
+
+    def _transaction(self, kind: str, record_id: str, mutate, delete: bool = False):
+        table = self.tables[kind]
+        db = self._connection()
+        # IMMEDIATE takes the write lock up front, so the read-modify-write can't interleave
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(f"SELECT data FROM {table} WHERE id = ?", (record_id,)).fetchone()
+            if row is None:
+                db.execute("ROLLBACK")
+                return None
+            record = json.loads(row[0])
+            result = mutate(record)
+            if delete:
+                db.execute(f"DELETE FROM {table} WHERE id = ?", (record_id,))
+            else:
+                db.execute(f"UPDATE {table} SET data = ? WHERE id = ?", (json.dumps(record), record_id))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return result
+
+    def _set_access(self, session_id: str, last_accessed: float, downloaded) -> bool:
+        # One autocommit UPDATE of three columns - the record itself isn't read or rewritten
+        flag = None if downloaded is None else int(downloaded)
+        cursor = self._connection().execute(
+            "UPDATE sessions SET last_accessed = ?, downloaded = COALESCE(?, downloaded), "
+            "expires_at = ? + CASE WHEN COALESCE(?, downloaded) THEN ? ELSE ? END WHERE id = ?",
+            (last_accessed, flag, last_accessed, flag, min(self.session_timeout, self.downloaded_timeout),
+             self.session_timeout, session_id)
+        )
+        return cursor.rowcount == 1
+
+    def exists(self, session_id: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+    def ids(self) -> list:
+        return [row[0] for row in self._connection().execute("SELECT id FROM sessions")]
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def incr_counters(self, name: str, deltas: dict):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for field, delta in deltas.items():
+                db.execute(
+                    "INSERT INTO counters (name, field, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name, field) DO UPDATE SET value = value + excluded.value",
+                    (name, field, delta)
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def get_counters(self, name: str) -> dict:
+        rows = self._connection().execute("SELECT field, value FROM counters WHERE name = ?", (name,))
+        return {field: value for field, value in rows}
+
+    def set_counters(self, name: str, values: dict):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM counters WHERE name = ?", (name,))
+            db.executemany(
+                "INSERT INTO counters (name, field, value) VALUES (?, ?, ?)",
+                [(name, field, value) for field, value in values.items()]
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def expired(self, now: float, limit: int = None) -> list:
+        rows = self._connection().execute(
+            "SELECT id FROM sessions WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+            (now, -1 if limit is None else limit)
+        )
+        return [row[0] for row in rows]
+
+    def downloaded_sessions(self, limit: int) -> list:
+        rows = self._connection().execute(
+            "SELECT id FROM sessions WHERE downloaded = 1 ORDER BY last_accessed LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    def close(self):
+        db = getattr(self.local, "db", None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+class RedisSessionStore(SessionStore):
+    """Sessions in a Redis-compatible server, shared by workers on any host
+
+    Pass client= to use any redis-py compatible client (e.g. fakeredis in tests).
+    """
+    name = "redis"
+
+    def __init__(self, url: str = REDIS_URL, client=None, prefix: str = "pdf_editor:"):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("SESSION_STORE=redis requires the redis package (pip install redis)")
+            client = redis.Redis.from_url(url)
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.index_key = f"{prefix}sessions"
+        self.expiry_key = f"{prefix}expiry"
+        self.access_key = f"{prefix}last_accessed"   # hash: session id -> last access time
+        self.downloaded_key = f"{prefix}downloaded"  # sorted set of downloaded sessions by last access
+
+    def _key(self, kind: str, record_id: str) -> str:
+        return f"{self.prefix}{kind}:{record_id}"
+
+    def _get(self, kind: str, record_id: str):
+        if kind != "session":
+            data = self.client.get(self._key(kind, record_id))
+            return json.loads(data) if data else None
+        pipe = self.client.pipeline()
+        pipe.get(self._key(kind, record_id))
+        pipe.hget(self.access_key, record_id)
+        pipe.zscore(self.downloaded_key, record_id)
+        data, last_accessed, downloaded_at = pipe.execute()
+        return self._session(data, last_accessed, downloaded_at)
+
+    @staticmethod
+    def _session(data, last_accessed, downloaded_at):
+        if not data:
+            return None
+        session = json.loads(data)
+        if last_accessed is not None:
+            session["last_accessed"] = float(last_accessed)
+            session["downloaded"] = downloaded_at is not None
+        return session
+
+    def _insert(self, kind: str, record_id: str, record: dict) -> bool:
+        if kind != "session":
+            return bool(self.client.set(self._key(kind, record_id), json.dumps(record), nx=True))
+        record = dict(record)
+        last_accessed, downloaded = record.pop("last_accessed"), record.pop("downloaded")
+        if not self.client.set(self._key(kind, record_id), json.dumps(record), nx=True):
+            return False
+        pipe = self.client.pipeline()
+        pipe.sadd(self.index_key, record_id)
+        pipe.hset(self.access_key, record_id, last_accessed)
+        if downloaded:
+            pipe.zadd(self.downloaded_key, {record_id: last_accessed})
+        pipe.zadd(self.expiry_key, {record_id: self._expiry(last_accessed, downloaded)})
+        pipe.execute()
+        return True
+
+    def _delete(self, kind: str, record_id: str):
+        pipe = self.client.pipeline()
+        pipe.get(self._key(kind, record_id))
+        pipe.delete(self._key(kind, record_id))
+        if kind != "session":
+            data = pipe.execute()[0]
+            return json.loads(data) if data else None
+        pipe.hget(self.access_key, record_id)
+        pipe.zscore(self.downloaded_key, record_id)
+        pipe.srem(self.index_key, record_id)
+        pipe.zrem(self.expiry_key, record_id)
+        pipe.hdel(self.access_key, record_id)
+        pipe.zrem(self.downloaded_key, record_id)
+        data, _, last_accessed, downloaded_at = pipe.execute()[:4]
+        return self._session(data, last_accessed, downloaded_at)
+
+    def _mutate(self, kind: str, record_id: str, mutate):
+        key = self._key(kind, record_id)
+        outcome = {}
+
+        def transaction(pipe):
+            # WATCH/MULTI/EXEC - redis-py retries this if another client changes the key
+            data = pipe.get(key)
+            if not data:
+                outcome["result"] = None
+                return
+            record = json.loads(data)
+            outcome["result"] = mutate(record)
+            pipe.multi()
+            pipe.set(key, json.dumps(record))
+
+        self.client.transaction(transaction, key)
+        return outcome.get("result")
+
+    def _set_access(self, session_id: str, last_accessed: float, downloaded) -> bool:
+        key = self._key("session", session_id)
+        outcome = {}
+
+        def transaction(pipe):
+            # Watching the record keeps a concurrent delete from leaving index entries behind
+            outcome["exists"] = bool(pipe.exists(key))
+            if not outcome["exists"]:
+                return
+            flag = downloaded
+            if flag is None:
+                flag = pipe.zscore(self.downloaded_key, session_id) is not None
+            pipe.multi()
+            pipe.hset(self.access_key, session_id, last_accessed)
+            if flag:
+                pipe.zadd(self.downloaded_key, {session_id: last_accessed})
+            else:
+                pipe.zrem(self.downloaded_key, session_id)
+            pipe.zadd(self.expiry_key, {session_id: self._expiry(last_accessed, flag)})
+
+        self.client.transaction(transaction, key)
+        return outcome["exists"]
+
+    def exists(self, session_id: str) -> bool:
+        return bool(self.client.exists(self._key("session", session_id)))
+
+    def ids(self) -> list:
+        return [sid.decode() if isinstance(sid, bytes) else sid for sid in self.client.smembers(self.index_key)]
+
+    def count(self) -> int:
+        return self.client.scard(self.index_key)
+
+    def incr_counters(self, name: str, deltas: dict):
+        pipe = self.client.pipeline()
+        for field, delta in deltas.items():
+            pipe.hincrby(f"{self.prefix}counters:{name}", field, delta)
+        pipe.execute()
+
+    def get_counters(self, name: str) -> dict:
+        values = self.client.hgetall(f"{self.prefix}counters:{name}")
+        return {(field.decode() if isinstance(field, bytes) else field): int(value) for field, value in values.items()}
+
+    def set_counters(self, name: str, values: dict):
+        key = f"{self.prefix}counters:{name}"
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        if values:
+            pipe.hset(key, mapping=values)
+        pipe.execute()
+
+    def expired(self, now: float, limit: int = None) -> list:
+        if limit is None:
+            session_ids = self.client.zrangebyscore(self.expiry_key, "-inf", now)
+        else:
+            session_ids = self.client.zrangebyscore(self.expiry_key, "-inf", now, start=0, num=limit)
+        return [sid.decode() if isinstance(sid, bytes) else sid for sid in session_ids]
+
+    def downloaded_sessions(self, limit: int) -> list:
+        session_ids = self.client.zrange(self.downloaded_key, 0, limit - 1)
+        return [sid.decode() if isinstance(sid, bytes) else sid for sid in session_ids]
+
+    def close(self):
+        self.client.close()
+
+def create_session_store(backend: str = SESSION_STORE, session_timeout: float = None,
+                         downloaded_timeout: float = None) -> SessionStore:
+    """Build the configured session store"""
+    if backend == "memory":
+        store = MemorySessionStore()
+    elif backend == "sqlite":
+        store = SQLiteSessionStore(SESSION_DB_PATH)
+    elif backend == "redis":
+        store = RedisSessionStore(REDIS_URL)
+    else:
+        raise ValueError(f"Unknown SESSION_STORE backend: {backend}")
+    if session_timeout is not None:
+        store.session_timeout = session_timeout
+    if downloaded_timeout is not None:
+        store.downloaded_timeout = downloaded_timeout
+    return store
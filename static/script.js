@@ -26,6 +26,8 @@ class PDFEditorApp {
         this.progressText = document.getElementById('progress-text');
         this.downloadBtn = document.getElementById('download-btn');
         this.closeSuccessBtn = document.getElementById('close-success');
+        this.cancelBtn = document.getElementById('cancel-btn');
+        this.progressFill = document.querySelector('.progress-fill');
     }
     
     setupEventListeners() {
@@ -43,6 +45,7 @@ class PDFEditorApp {
         this.clearAllBtn.addEventListener('click', () => this.clearAllFiles());
         this.downloadBtn.addEventListener('click', () => this.downloadPDF());
         this.closeSuccessBtn.addEventListener('click', () => this.hideModal(this.successModal));
+        this.cancelBtn.addEventListener('click', () => this.cancelCombine());
         
         // Files grid drag and drop
         this.filesGrid.addEventListener('dragover', (e) => this.handleGridDragOver(e));
@@ -101,9 +104,10 @@ class PDFEditorApp {
         this.showModal(this.progressModal);
         this.progressText.textContent = 'Uploading files...';
         
+        // session_id first, so the server can check the session quota while the files stream in
         const formData = new FormData();
-        files.forEach(file => formData.append('files', file));
         formData.append('session_id', this.sessionId);
+        files.forEach(file => formData.append('files', file));
         
         try {
             const response = await fetch('/upload', {
@@ -117,6 +121,9 @@ class PDFEditorApp {
                 this.files.push(...data.files);
                 this.renderFiles();
                 this.updateUI();
+            } else if (data.detail) {
+                // Over a size limit or out of storage (413/429/507)
+                alert(data.detail);
             }
             
             this.hideModal(this.progressModal);
@@ -146,15 +153,21 @@ class PDFEditorApp {
         const thumbnail = document.createElement('div');
         thumbnail.className = 'file-thumbnail';
         
-        if (file.thumbnail) {
+        if (file.thumbnail_status === 'ready') {
+            // Served as a cacheable image - the browser reuses it across re-renders
             const img = document.createElement('img');
-            img.src = `data:image/png;base64,${file.thumbnail}`;
+            img.src = file.thumbnail_url;
             img.alt = file.filename;
             thumbnail.appendChild(img);
         } else {
             const icon = document.createElement('i');
             icon.className = file.type === 'pdf' ? 'fas fa-file-pdf' : 'fas fa-image';
             thumbnail.appendChild(icon);
+            
+            // Thumbnail is still rendering on the server
+            if (file.thumbnail_status === 'pending') {
+                this.loadThumbnail(file);
+            }
         }
         
         const fileName = document.createElement('div');
@@ -188,6 +201,46 @@ class PDFEditorApp {
         return div;
     }
     
+    async loadThumbnail(file) {
+        if (file.thumbnailLoading) return;
+        file.thumbnailLoading = true;
+        
+        // Poll until the thumbnail is ready, backing off up to 5 seconds
+        let delay = 500;
+        for (let attempt = 0; attempt < 30; attempt++) {
+            try {
+                const response = await fetch(file.thumbnail_url);
+                
+                if (response.status === 200) {
+                    file.thumbnail_status = 'ready';
+                    
+                    const container = this.filesGrid.querySelector(`[data-file-id="${file.id}"] .file-thumbnail`);
+                    if (container) {
+                        const img = document.createElement('img');
+                        img.src = file.thumbnail_url;
+                        img.alt = file.filename;
+                        container.innerHTML = '';
+                        container.appendChild(img);
+                    }
+                    break;
+                }
+                
+                if (response.status !== 202) {
+                    // Rendering failed or file was removed - keep the default icon
+                    file.thumbnail_status = 'failed';
+                    break;
+                }
+            } catch (error) {
+                console.error('Error loading thumbnail:', error);
+            }
+            
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 2, 5000);
+        }
+        
+        file.thumbnailLoading = false;
+    }
+    
     handleFileDragStart(e) {
         this.draggedElement = e.target;
         e.target.classList.add('dragging');
@@ -366,21 +419,75 @@ class PDFEditorApp {
             
             const data = await response.json();
             
+            if (!data.job_id) {
+                this.hideModal(this.progressModal);
+                alert('Error combining files: ' + (data.error || data.detail || 'Unknown error'));
+                return;
+            }
+            
+            // The merge runs as a background job - poll it until it finishes
+            this.combineJobId = data.job_id;
+            this.cancelBtn.style.display = 'inline-block';
+            const job = await this.waitForJob(data.status_url);
+            
+            this.combineJobId = null;
+            this.cancelBtn.style.display = 'none';
+            this.progressFill.style.width = '';
             this.hideModal(this.progressModal);
             
-            if (data.download_url) {
-                this.downloadUrl = data.download_url;
+            if (job.status === 'completed') {
+                this.downloadUrl = job.download_url;
                 this.showModal(this.successModal);
-            } else {
-                alert('Error combining files: ' + (data.error || 'Unknown error'));
+            } else if (job.status !== 'cancelled') {
+                alert('Error combining files: ' + (job.error || 'Unknown error'));
             }
         } catch (error) {
+            this.combineJobId = null;
+            this.cancelBtn.style.display = 'none';
             this.hideModal(this.progressModal);
             console.error('Error combining files:', error);
             alert('Error combining files. Please try again.');
         }
     }
     
+    async waitForJob(statusUrl) {
+        while (true) {
+            const response = await fetch(statusUrl);
+            const job = await response.json();
+            
+            if (job.error && !job.status) {
+                return { status: 'failed', error: job.error };
+            }
+            if (['completed', 'failed', 'cancelled'].includes(job.status)) {
+                return job;
+            }
+            
+            const percent = Math.round(job.progress * 100);
+            let text = `Combining files... ${percent}%`;
+            if (job.total_pages) {
+                text += ` (${job.pages_processed}/${job.total_pages} pages)`;
+            }
+            if (job.eta_seconds !== null) {
+                text += ` - about ${Math.ceil(job.eta_seconds)}s left`;
+            }
+            this.progressText.textContent = text;
+            this.progressFill.style.width = `${percent}%`;
+            
+            await new Promise(resolve => setTimeout(resolve, 500));
+        }
+    }
+    
+    async cancelCombine() {
+        if (!this.combineJobId) return;
+        
+        try {
+            await fetch(`/jobs/${this.combineJobId}/cancel`, { method: 'POST' });
+            this.progressText.textContent = 'Cancelling...';
+        } catch (error) {
+            console.error('Error cancelling combine:', error);
+        }
+    }
+    
     downloadPDF() {
         if (this.downloadUrl) {
             window.open(this.downloadUrl, '_blank');
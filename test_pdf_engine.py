@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Tests for the merge engine (pdf_engine.py): page selections and the streaming writer.
+Fixtures are generated with pypdf, so these need no server and no poppler or qpdf.
+"""
+
+from io import BytesIO
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    ArrayObject, DictionaryObject, FloatObject, IndirectObject, NameObject, NullObject, TextStringObject
+)
+
+from pdf_engine import StreamingPdfWriter, iter_merged_pdf, merge_pdf_low_memory, optimize_pdf, parse_page_ranges
+
+def make_pdf(path, widths, dangling: bool = False):
+    """A PDF with one blank page per width, optionally referencing an object it doesn't have"""
+    writer = PdfWriter()
+    for width in widths:
+        writer.add_blank_page(width, 100)
+    if dangling:
+        writer.pages[0][NameObject("/Dangling")] = IndirectObject(999, 0, writer)
+    writer.write(str(path))
+    return str(path)
+
+def read_back(data: bytes) -> PdfReader:
+    # strict: a malformed xref table fails the test rather than being repaired
+    return PdfReader(BytesIO(data), strict=True)
+
+def widths(reader: PdfReader) -> list:
+    return [int(page.mediabox.width) for page in reader.pages]
+
+def test_parse_page_ranges():
+    assert parse_page_ranges("1-3,7") == [1, 2, 3, 7]
+    assert parse_page_ranges([2, "4-5", 2], page_count=5) == [2, 4, 5, 2]
+
+@pytest.mark.parametrize("pages", ["0", "3-1", "a", "1-", [None], "6", "2-6"])
+def test_parse_page_ranges_rejects(pages):
+    with pytest.raises(ValueError):
+        parse_page_ranges(pages, page_count=5)
+
+def test_parse_page_ranges_limit_is_checked_before_expanding():
+    with pytest.raises(ValueError, match="at most 10 pages"):
+        parse_page_ranges("1-1000000000", limit=10)
+    with pytest.raises(ValueError, match="at most 10 pages"):
+        parse_page_ranges(["1"] * 11, limit=10)
+
+def test_merge_selections_and_rotation(tmp_path):
+    first = make_pdf(tmp_path / "first.pdf", [100, 101, 102])
+    second = make_pdf(tmp_path / "second.pdf", [200, 201])
+    data = b"".join(iter_merged_pdf([
+        (first, "pdf", [2, 0], 0, None),
+        (second, "pdf", None, 90, None),
+        (first, "pdf", [2], 0, None),
+    ]))
+
+    reader = read_back(data)
+    assert widths(reader) == [102, 100, 200, 201, 102]
+    assert [page.get("/Rotate", 0) for page in reader.pages] == [0, 0, 90, 90, 0]
+    # A page selected twice is written as two page objects
+    assert reader.pages[0].indirect_reference.idnum != reader.pages[4].indirect_reference.idnum
+
+def test_page_selected_twice_gets_annotations_of_its_own(tmp_path):
+    writer = PdfWriter()
+    page = writer.add_blank_page(100, 100)
+    page[NameObject("/Annots")] = ArrayObject([writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Text"),
+        NameObject("/Rect"): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(20), FloatObject(20)]),
+        NameObject("/P"): page.indirect_reference,
+    }))])
+    source = str(tmp_path / "annotated.pdf")
+    writer.write(source)
+
+    reader = read_back(b"".join(iter_merged_pdf([(source, "pdf", [0, 0], 0, None)])))
+    annots = [page["/Annots"][0] for page in reader.pages]
+    assert annots[0].idnum != annots[1].idnum
+    for page, annot in zip(reader.pages, annots):
+        assert annot.get_object().raw_get("/P").idnum == page.indirect_reference.idnum
+
+def test_dangling_reference_is_written_as_null(tmp_path):
+    source = make_pdf(tmp_path / "dangling.pdf", [100], dangling=True)
+    reader = read_back(b"".join(iter_merged_pdf([(source, "pdf", None, 0, None)])))
+    assert widths(reader) == [100]
+    assert isinstance(reader.pages[0]["/Dangling"], NullObject)
+
+    output = BytesIO()
+    stats = merge_pdf_low_memory([(source, "pdf", None, 0, None)], output)
+    assert stats["pages"] == 1
+    assert widths(read_back(output.getvalue())) == [100]
+
+def test_failed_source_is_rolled_back(tmp_path):
+    good = make_pdf(tmp_path / "good.pdf", [100, 101])
+    broken = tmp_path / "broken.pdf"
+    broken.write_bytes(b"not a pdf")
+    errors = []
+
+    output = BytesIO()
+    stats = merge_pdf_low_memory([
+        (good, "pdf", [0], 0, None),
+        (good, "pdf", [1, 5], 0, None),   # fails on its second page, after copying the first
+        (str(broken), "pdf", None, 0, None),
+        (good, "pdf", [1], 0, None),
+    ], output, on_error=lambda path, error: errors.append(path))
+
+    assert errors == [good, str(broken)]
+    assert stats["pages"] == 2
+    assert widths(read_back(output.getvalue())) == [100, 101]
+
+def test_reserved_but_unwritten_objects_are_closed_as_null(tmp_path):
+    source = PdfReader(make_pdf(tmp_path / "source.pdf", [100]))
+    output = BytesIO()
+    writer = StreamingPdfWriter(output)
+    mark = writer.mark()
+    writer.add_page(source.pages[0], "source")
+    writer._reserve()   # as if the source failed with objects still pending
+    writer.rollback(mark)
+    writer.add_page(source.pages[0], "source")
+    writer.close()
+
+    assert None not in writer.offsets[1:]
+    assert widths(read_back(output.getvalue())) == [100]
+
+def test_optimize_keeps_annotations_of_templated_pages_apart(tmp_path):
+    # Two files filled from one template: identical link annotations on both pages
+    writer = PdfWriter()
+    page = writer.add_blank_page(100, 100)
+    page[NameObject("/Annots")] = ArrayObject([writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject("/Link"),
+        NameObject("/Rect"): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(50), FloatObject(50)]),
+        NameObject("/Contents"): TextStringObject("template link"),
+    }))])
+    templates = [str(tmp_path / f"filled-{index}.pdf") for index in range(2)]
+    for template in templates:
+        writer.write(template)
+    merged = tmp_path / "merged.pdf"
+    merged.write_bytes(b"".join(iter_merged_pdf([(template, "pdf", None, 0, None) for template in templates])))
+
+    output = BytesIO()
+    optimize_pdf(merged, output)
+    reader = read_back(output.getvalue())
+    annots = [[ref.idnum for ref in page["/Annots"]] for page in reader.pages]
+    assert len(annots) == 2 and annots[0] != annots[1]
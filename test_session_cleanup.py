@@ -173,6 +173,16 @@ class PDFEditorTester:
         
         return debug_result and cleanup_result
     
+    def wait_for_job(self, status_url, timeout=60):
+        """Poll a combine job until it finishes and return its final status"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = requests.get(f"{self.base_url}{status_url}").json()
+            if job.get('status') in ('completed', 'failed', 'cancelled') or 'error' in job and 'status' not in job:
+                return job
+            time.sleep(0.5)
+        return {}
+    
     def test_download_and_cleanup(self):
         """Test download marking and subsequent cleanup"""
         print("\n📥 Testing download and cleanup...")
@@ -189,8 +199,9 @@ class PDFEditorTester:
             
             if response.status_code == 200:
                 result = response.json()
-                if 'download_url' in result:
-                    download_url = result['download_url']
+                job = self.wait_for_job(result['status_url']) if 'status_url' in result else {}
+                if 'download_url' in job:
+                    download_url = job['download_url']
                     print(f"✅ PDF combined, download URL: {download_url}")
                     
                     # Download the file
@@ -219,6 +230,42 @@ class PDFEditorTester:
         
         return False
     
+    def test_thumbnail_endpoint(self):
+        """Test that thumbnails render in the background and are served once ready"""
+        print("\n🖼️  Testing background thumbnails...")
+        
+        session_id = f"test_thumb_{int(time.time())}"
+        self.test_sessions.append(session_id)
+        test_image = self.create_test_image()
+        
+        try:
+            with open(test_image, 'rb') as f:
+                files = {'files': ('test.png', f, 'image/png')}
+                data = {'session_id': session_id}
+                response = requests.post(f"{self.base_url}/upload", files=files, data=data)
+            
+            file_info = response.json()['files'][0]
+            print(f"✅ Upload returned with thumbnail status: {file_info['thumbnail_status']}")
+            
+            # Poll until the worker pool has rendered it
+            for _ in range(20):
+                thumb_response = requests.get(f"{self.base_url}{file_info['thumbnail_url']}")
+                if thumb_response.status_code != 202:
+                    break
+                time.sleep(0.5)
+            
+            if thumb_response.status_code == 200 and thumb_response.headers['content-type'].startswith('image/'):
+                print(f"✅ Thumbnail served ({len(thumb_response.content)} bytes)")
+                return True
+            
+            print(f"❌ Thumbnail request failed with status {thumb_response.status_code}")
+            return False
+        finally:
+            try:
+                os.unlink(test_image)
+            except:
+                pass
+    
     def test_file_system_cleanup(self):
         """Test that files are actually deleted from filesystem"""
         print("\n🗂️  Testing filesystem cleanup...")
@@ -270,6 +317,7 @@ class PDFEditorTester:
             ("Session Creation", self.test_session_creation),
             ("Debug Info", self.test_session_debug_info),
             ("Manual Cleanup", self.test_manual_cleanup),
+            ("Background Thumbnails", self.test_thumbnail_endpoint),
             ("Download and Cleanup", self.test_download_and_cleanup),
             ("Filesystem Cleanup", self.test_file_system_cleanup),
             ("Timeout Simulation", self.test_session_timeout_simulation),
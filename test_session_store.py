@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Tests for the session store backends (session_store.py): memory, SQLite on a temp file
+and Redis through fakeredis. Unlike the other test scripts these need no running server.
+"""
+
+import threading
+import time
+
+import pytest
+
+from session_store import MemorySessionStore, SQLiteSessionStore, RedisSessionStore
+
+BACKENDS = ["memory", "sqlite", "redis"]
+
+def make_store(backend: str, tmp_path):
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    return RedisSessionStore(client=fakeredis.FakeRedis(server=fakeredis.FakeServer()))
+
+@pytest.fixture(params=BACKENDS)
+def store(request, tmp_path):
+    store = make_store(request.param, tmp_path)
+    store.touch_interval = 0
+    yield store
+    store.close()
+
+def file_info(file_id: str) -> dict:
+    return {"id": file_id, "filename": f"{file_id}.pdf", "type": "pdf", "page_count": 1}
+
+def test_add_files_is_atomic(store):
+    store.create("s1")
+    threads = [
+        threading.Thread(target=store.add_files, args=("s1", [file_info(f"t{thread}-{index}") for index in range(2)]))
+        for thread in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    session = store.get("s1")
+    assert len(session["files"]) == 16
+    assert sorted(session["order"]) == sorted(session["files"])
+
+def test_add_files_from_two_workers(tmp_path):
+    # Two SQLite stores on one file stand in for two worker processes
+    first = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    second = SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    first.create("s1")
+    threads = [threading.Thread(target=worker.add_files, args=("s1", [file_info(f"{name}-{index}")]))
+               for name, worker in (("a", first), ("b", second)) for index in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(second.get("s1")["files"]) == 20
+
+def test_set_order(store):
+    store.create("s1")
+    store.add_files("s1", [file_info("a"), file_info("b"), file_info("c")])
+
+    store.set_order("s1", ["c", "unknown", "a", "a", {"file_id": "a", "pages": [1], "rotate": 90}])
+    assert store.get("s1")["order"] == ["c", "a", {"file_id": "a", "pages": [1], "rotate": 90}, "b"]
+
+    store.remove_file("s1", "a")
+    assert store.get("s1")["order"] == ["c", "b"]
+
+def test_expired(store):
+    store.session_timeout = 100
+    store.downloaded_timeout = 10
+    for session_id in ("old", "downloaded", "fresh"):
+        store.create(session_id)
+    store.touch("downloaded", downloaded=True)
+    now = time.time()
+
+    assert store.expired(now + 50) == ["downloaded"]
+    assert store.expired(now + 200)[0] == "downloaded"
+    assert set(store.expired(now + 200)) == {"downloaded", "old", "fresh"}
+    assert store.expired(now + 200, limit=1) == ["downloaded"]
+
+    store.delete("downloaded")
+    assert store.expired(now + 50) == []
+    assert store.touch("downloaded") is False
+
+def test_touch_keeps_access_out_of_the_record(store):
+    store.create("s1")
+    store.add_files("s1", [file_info("a")])
+    before = store.get("s1")["last_accessed"]
+    time.sleep(0.01)
+
+    assert store.touch("s1", downloaded=True)
+    session = store.get("s1")
+    assert session["last_accessed"] > before
+    assert session["downloaded"] is True
+    assert session["files"]["a"]["filename"] == "a.pdf"
+
+    # Mutations leave the access fields alone
+    store.set_order("s1", ["a"])
+    assert store.get("s1")["downloaded"] is True
+    assert store.expires_at(store.get("s1")) == pytest.approx(session["last_accessed"] + store.downloaded_timeout)
+
+def test_touch_interval_skips_repeated_touches(store):
+    store.touch_interval = 60
+    store.create("s1")
+    store.touch("s1")
+    touched = store.get("s1")["last_accessed"]
+    time.sleep(0.01)
+    store.touch("s1")
+    assert store.get("s1")["last_accessed"] == touched
+    # Setting the downloaded flag is never skipped
+    store.touch("s1", downloaded=True)
+    assert store.get("s1")["downloaded"] is True
+
+def test_downloaded_sessions(store):
+    for session_id in ("a", "b", "c"):
+        store.create(session_id)
+    store.touch("b", downloaded=True)
+    time.sleep(0.01)
+    store.touch("a", downloaded=True)
+    assert store.downloaded_sessions(limit=10) == ["b", "a"]
+
+    time.sleep(0.01)
+    store.touch("b")
+    assert store.downloaded_sessions(limit=1) == ["a"]
+    store.delete("a")
+    store.touch("b", downloaded=False)
+    assert store.downloaded_sessions(limit=10) == []
@@ -1,10 +1,10 @@
 from fastapi import FastAPI, File, UploadFile, Request, Form, HTTPException, Depends
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from starlette.formparsers import MultiPartParser, MultiPartException
 import os
-import tempfile
 import shutil
 from pathlib import Path
 from typing import List
@@ -13,31 +13,83 @@ from pypdf import PdfWriter, PdfReader
 from PIL import Image
 import json
 import asyncio
-from pdf2image import convert_from_path
-import base64
+from pdf_engine import (
+    render_stats, render_governor, add_image_page, iter_merged_pdf, get_indexed_page, merge_pdf_low_memory,
+    count_pages, optimize_pdf, linearize_pdf, parse_page_ranges, use_low_memory_merge, thumbnail_job,
+    normalize_job, QPDF_PATH, IMAGE_PAGE_RESOLUTION, IMAGE_PAGE_FIT, IMAGE_PAGE_DPI, IMAGE_QUALITY,
+    THUMBNAIL_SIZE, THUMBNAIL_DPI, THUMBNAIL_FORMAT
+)
 from io import BytesIO
 import time
 import threading
 from datetime import datetime, timedelta
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import hashlib
+import unicodedata
+from urllib.parse import quote
+from collections import OrderedDict
+import aiofiles
+from session_store import create_session_store, entry_file_id, SESSION_STORE, WEB_WORKERS
+import fcntl
 
 # Create directories
 os.makedirs("static", exist_ok=True)
 os.makedirs("templates", exist_ok=True)
 os.makedirs("uploads", exist_ok=True)
 os.makedirs("temp", exist_ok=True)
+os.makedirs("cache/thumbnails", exist_ok=True)
 
 # Mount static files will be done after app creation
 
 # Templates
 templates = Jinja2Templates(directory="templates")
 
-# In-memory storage for sessions (in production, use Redis or database)
-sessions = {}
-
 # Session cleanup configuration
 SESSION_TIMEOUT = 60  # 1 minute for testing (change to 3600 for production)
 CLEANUP_INTERVAL = 30   # 30 seconds for testing (change to 300 for production)
+DOWNLOADED_SESSION_TIMEOUT = 600  # downloaded sessions go after 10 minutes
+ORPHAN_SCAN_INTERVAL = int(os.getenv("ORPHAN_SCAN_INTERVAL", 10 * CLEANUP_INTERVAL))  # full disk scan for leftovers
+LEDGER_RECONCILE_INTERVAL = int(os.getenv("LEDGER_RECONCILE_INTERVAL", 3600))  # rescan disk usage to correct drift
+
+# Session state: in-memory by default, SQLite or Redis to share it between workers (SESSION_STORE)
+session_store = create_session_store(SESSION_STORE, SESSION_TIMEOUT, DOWNLOADED_SESSION_TIMEOUT)
+
+# Upload limits (enforced while the upload is streamed to disk)
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 200 * 1024 * 1024))  # 200 MB per file
+MAX_REQUEST_SIZE = int(os.getenv("MAX_REQUEST_SIZE", 500 * 1024 * 1024))  # 500 MB per request
+MAX_UPLOAD_FILES = int(os.getenv("MAX_UPLOAD_FILES", 1000))  # files per upload request
+MULTIPART_OVERHEAD = 64 * 1024  # Content-Length allowance for multipart boundaries and headers
+
+# Disk budget for uploads/ and temp/ (0 disables a limit); uploads past it get 507, past the quota 429
+DISK_BUDGET_BYTES = int(os.getenv("DISK_BUDGET_BYTES", 10 * 1024 * 1024 * 1024))  # 10 GB in total
+SESSION_QUOTA_BYTES = int(os.getenv("SESSION_QUOTA_BYTES", 1024 * 1024 * 1024))  # 1 GB per session
+DISK_PRESSURE_RATIO = float(os.getenv("DISK_PRESSURE_RATIO", 0.9))  # evict downloaded sessions above this share
+
+# Thumbnail rendering (poppler + PIL) runs in a bounded pool of worker processes
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", min(4, max(1, (os.cpu_count() or 1) // WEB_WORKERS))))
+THUMBNAIL_CACHE_CONTROL = "private, max-age=31536000, immutable"  # thumbnail bytes never change for a URL
+
+# Combine jobs run in a pool of worker threads so merges never block the event loop
+COMBINE_WORKERS = int(os.getenv("COMBINE_WORKERS", 2))
+JOB_SYNC_INTERVAL = 0.5  # seconds between job progress writes to the session store
+
+# Deduplicated upload storage: one blob per unique file content, hardlinked into session directories
+BLOB_DIR = Path("uploads/_blobs")
+
+# Thumbnail cache shared by all sessions, keyed by file content + render parameters
+THUMBNAIL_CACHE_MEMORY_ITEMS = int(os.getenv("THUMBNAIL_CACHE_MEMORY_ITEMS", 1024))
+THUMBNAIL_CACHE_DISK_BYTES = int(os.getenv("THUMBNAIL_CACHE_DISK_BYTES", 256 * 1024 * 1024))  # 256 MB
+
+# Parsed combine sources kept in memory between combines, keyed by file content
+COMBINE_CACHE_BYTES = int(os.getenv("COMBINE_CACHE_BYTES", 256 * 1024 * 1024))  # 256 MB
+
+# Post-merge optimization (dedupe repeated fonts/images, compress streams) unless /combine says otherwise
+OPTIMIZE_OUTPUT = os.getenv("OPTIMIZE_OUTPUT", "false").lower() == "true"
+# Linearized ("fast web view") output via qpdf unless /combine says otherwise
+LINEARIZE_OUTPUT = os.getenv("LINEARIZE_OUTPUT", "false").lower() == "true"
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # bytes per read when serving /download
 
 # Security configuration
 DEBUG_MODE = os.getenv("DEBUG_MODE", "false").lower() == "true"
@@ -56,14 +108,89 @@ def verify_debug_access(credentials: HTTPAuthorizationCredentials = Depends(secu
     
     return credentials
 
+class CleanupLeader:
+    """File-lock leader election: only the worker holding the lock runs cleanup
+    
+    The lock is released by the OS when its holder exits, and the other workers keep
+    trying to take it over on every cleanup tick.
+    """
+    def __init__(self, lock_path: str):
+        self.lock_path = lock_path
+        self.lock_file = None
+    
+    def acquire(self) -> bool:
+        """Try to become (or stay) the leader without blocking"""
+        if self.lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        print(f"👑 Worker {os.getpid()} is now running cleanup")
+        return True
+    
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+cleanup_leader = CleanupLeader("cache/cleanup.lock")
+
+class WorkerRegistry:
+    """Web server processes running from this directory, however they were started
+    
+    Each process holds an exclusive lock on its own file in lock_dir while it runs, so a
+    file nobody holds a lock on belongs to a process that has exited. Sessions in the
+    memory store and the files under uploads/ are only consistent with one process.
+    """
+    def __init__(self, lock_dir: str):
+        self.lock_dir = Path(lock_dir)
+        self.lock_file = None
+    
+    def register(self):
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.lock_dir / f"{os.getpid()}-{uuid.uuid4().hex[:8]}.lock", "x")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.lock_file = lock_file
+    
+    def peers(self) -> list:
+        """PIDs of the other live processes; files left by exited ones are removed"""
+        live = []
+        for path in self.lock_dir.glob("*.lock"):
+            if self.lock_file is not None and path.name == Path(self.lock_file.name).name:
+                continue
+            try:
+                with open(path, "a") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        live.append(int(path.name.split("-")[0]))
+                        continue
+                    path.unlink(missing_ok=True)
+            except (OSError, ValueError):
+                continue
+        return live
+    
+    def release(self):
+        if self.lock_file is not None:
+            Path(self.lock_file.name).unlink(missing_ok=True)
+            self.lock_file.close()
+            self.lock_file = None
+
+worker_registry = WorkerRegistry("cache/workers")
+
 # Background cleanup task
 def cleanup_background_task():
-    """Background task that runs cleanup periodically"""
+    """Background task that runs cleanup periodically (on the leader worker only)"""
     print("🧹 Background cleanup task started")
     while True:
         try:
-            print(f"🔍 Running cleanup check... (Sessions: {len(sessions)})")
-            SessionManager.cleanup_expired_sessions()
+            if cleanup_leader.acquire():
+                print(f"🔍 Running cleanup check... (Sessions: {session_store.count()})")
+                SessionManager.cleanup_expired_sessions()
             time.sleep(CLEANUP_INTERVAL)
         except Exception as e:
             print(f"❌ Error in cleanup background task: {e}")
@@ -75,23 +202,49 @@ async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Starting PDF Editor Web App...")
     
-    # Run initial cleanup of orphaned files from previous sessions
-    print("🧹 Running initial cleanup of orphaned files...")
-    orphaned_count = SessionManager.cleanup_orphaned_files()
-    if orphaned_count > 0:
-        print(f"🗑️  Cleaned up {orphaned_count} orphaned files from previous sessions")
-    else:
-        print("✅ No orphaned files found")
+    # Each worker keeps its memory-store sessions to itself, and the cleanup leader would
+    # delete the uploads of every session it can't see - refuse rather than lose files
+    worker_registry.register()
+    peers = worker_registry.peers()
+    if peers and session_store.name == "memory":
+        worker_registry.release()
+        raise RuntimeError(
+            f"SESSION_STORE=memory can't be shared with the other web workers running here "
+            f"(PIDs {', '.join(map(str, peers))}) - set SESSION_STORE=sqlite or redis, or run one worker"
+        )
+    
+    # Run initial cleanup of orphaned files from previous sessions (one worker does it)
+    if cleanup_leader.acquire():
+        print("🧹 Running initial cleanup of orphaned files...")
+        orphaned_count = SessionManager.cleanup_orphaned_files()
+        SessionManager.last_orphan_scan = time.time()
+        disk_ledger.reconcile()
+        if orphaned_count > 0:
+            print(f"🗑️  Cleaned up {orphaned_count} orphaned files from previous sessions")
+        else:
+            print("✅ No orphaned files found")
     
     # Start background cleanup task
     cleanup_thread = threading.Thread(target=cleanup_background_task, daemon=True)
     cleanup_thread.start()
     print(f"✅ Started background cleanup task (interval: {CLEANUP_INTERVAL}s, timeout: {SESSION_TIMEOUT}s)")
     
+    if LINEARIZE_OUTPUT and QPDF_PATH is None:
+        print("⚠️  LINEARIZE_OUTPUT is set but qpdf isn't installed - combined PDFs won't be linearized")
+    
+    # Start thumbnail worker processes
+    thumbnail_jobs.start()
+    print(f"✅ Started thumbnail workers (processes: {THUMBNAIL_WORKERS})")
+    
     yield
     
     # Shutdown
     print("🛑 Shutting down PDF Editor...")
+    fragment_jobs.shutdown()
+    thumbnail_jobs.shutdown()
+    combine_jobs.shutdown()
+    cleanup_leader.release()
+    worker_registry.release()
 
 # Create FastAPI app with lifespan
 app = FastAPI(title="PDF Editor Web App", lifespan=lifespan)
@@ -99,73 +252,621 @@ app = FastAPI(title="PDF Editor Web App", lifespan=lifespan)
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+class SessionLocks:
+    """Per-session locks, created on demand and dropped once nobody holds or waits for them
+    
+    Serializes multi-step changes to one session (upload, remove, combine output, cleanup)
+    while unrelated sessions never contend. Single store updates are atomic on their own.
+    With several worker processes a session's lock is also an flock on one of STRIPES files
+    in lock_dir, so the cleanup leader and the other workers take turns too. The files are
+    never deleted; sessions sharing a stripe only ever wait a little longer for each other.
+    """
+    WAIT_THREADS = 32
+    STRIPES = 256
+    
+    def __init__(self, lock_dir: str):
+        self.lock_dir = Path(lock_dir)
+        self.lock_dir.mkdir(parents=True, exist_ok=True)
+        self.locks = {}
+        self.lock = threading.Lock()
+        # Handlers waiting for a lock held by a thread park a thread here - never in the
+        # default executor, which the handler holding the lock may need for its file I/O
+        self.wait_executor = ThreadPoolExecutor(max_workers=self.WAIT_THREADS, thread_name_prefix="session-lock")
+    
+    def _checkout(self, session_id: str) -> list:
+        with self.lock:
+            entry = self.locks.setdefault(session_id, [threading.Lock(), asyncio.Lock(), 0])
+            entry[2] += 1
+            return entry
+    
+    def _checkin(self, session_id: str):
+        with self.lock:
+            entry = self.locks[session_id]
+            entry[2] -= 1
+            if entry[2] == 0:
+                del self.locks[session_id]
+    
+    def _lock_file(self, session_id: str, blocking: bool = True):
+        """Take the session's stripe file lock; returns the open file, or None if busy"""
+        stripe = int(hashlib.sha256(session_id.encode()).hexdigest(), 16) % self.STRIPES
+        lock_file = open(self.lock_dir / f"{stripe:03d}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+    
+    def _acquire(self, lock: threading.Lock, session_id: str, blocking: bool = True):
+        """Take the thread lock, then the file lock; returns the open lock file, or None if busy"""
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            lock_file = self._lock_file(session_id, blocking)
+        except BaseException:
+            lock.release()
+            raise
+        if lock_file is None:
+            lock.release()
+        return lock_file
+    
+    @staticmethod
+    def _release(lock: threading.Lock, lock_file):
+        lock_file.close()   # drops the flock
+        lock.release()
+    
+    @contextmanager
+    def hold(self, session_id: str, blocking: bool = True):
+        """Hold the session's lock (threads); yields False if not blocking and it is busy
+        
+        Never called on the event loop: a handler holding the lock through hold_async may be
+        suspended in an await, and a loop thread waiting here would keep it from resuming.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("session_locks.hold() on the event loop - use hold_async() or a thread")
+        lock, _, _ = self._checkout(session_id)
+        try:
+            lock_file = self._acquire(lock, session_id, blocking)
+            try:
+                yield lock_file is not None
+            finally:
+                if lock_file is not None:
+                    self._release(lock, lock_file)
+        finally:
+            self._checkin(session_id)
+    
+    @asynccontextmanager
+    async def hold_async(self, session_id: str):
+        """Hold the session's lock from a handler
+        
+        Handlers queue on an asyncio.Lock first, so however many requests pile up on one
+        session, at most one of them has a thread waiting for the lock itself.
+        """
+        lock, handler_lock, _ = self._checkout(session_id)
+        try:
+            async with handler_lock:
+                lock_file = self._acquire(lock, session_id, blocking=False)
+                if lock_file is None:
+                    waiter = asyncio.get_running_loop().run_in_executor(
+                        self.wait_executor, self._acquire, lock, session_id
+                    )
+                    try:
+                        lock_file = await asyncio.shield(waiter)
+                    except asyncio.CancelledError:
+                        # The thread still gets the lock - hand it straight back
+                        waiter.add_done_callback(
+                            lambda done: done.exception() is None and self._release(lock, done.result())
+                        )
+                        raise
+                try:
+                    yield
+                finally:
+                    self._release(lock, lock_file)
+        finally:
+            self._checkin(session_id)
+
+session_locks = SessionLocks("cache/session_locks")
+
+class DiskLedger:
+    """Running totals of bytes and files on disk, per session and overall
+    
+    Updated on every save, combine, remove and cleanup, so stats never walk the tree.
+    The totals live in the session store (shared by workers); reconcile() rescans the
+    disk now and then to correct drift from crashes or files removed by hand.
+    """
+    FIELDS = ("upload_bytes", "upload_files", "output_bytes", "output_files",
+              "blob_bytes", "blob_files", "fragment_bytes")
+    SESSION_FIELDS = ("upload_bytes", "upload_files", "output_bytes", "output_files")
+    
+    def __init__(self):
+        self.last_reconcile = None
+        self.last_scan = {}
+    
+    def record(self, session_id: str = None, **deltas):
+        """Add deltas to the totals (and to the session's usage when given)"""
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        session_deltas = {field: delta for field, delta in deltas.items() if field in self.SESSION_FIELDS}
+        if session_id and session_deltas:
+            session_store.add_usage(session_id, session_deltas)
+        session_store.incr_counters("disk", deltas)
+    
+    @staticmethod
+    def file_size(path: Path):
+        """Size of a file, or None if it doesn't exist"""
+        try:
+            return path.stat().st_size
+        except OSError:
+            return None
+    
+    def record_output(self, session_id: str, size_before, size_after):
+        """Account for a combined PDF that was created, replaced or removed"""
+        self.record(
+            session_id,
+            output_bytes=(size_after or 0) - (size_before or 0),
+            output_files=(size_after is not None) - (size_before is not None)
+        )
+    
+    def release_session(self, session: dict):
+        """Drop everything a cleaned up session accounted for"""
+        usage = session.get("usage", {})
+        self.record(None, **{field: -usage.get(field, 0) for field in self.SESSION_FIELDS})
+    
+    def totals(self) -> dict:
+        counters = session_store.get_counters("disk")
+        return {field: counters.get(field, 0) for field in self.FIELDS}
+    
+    def reconcile(self) -> dict:
+        """Rescan uploads/ and temp/, reset the totals and return how far they had drifted"""
+        actual = {field: 0 for field in self.FIELDS}
+        usage = {}
+        orphaned_uploads = 0
+        orphaned_pdfs = 0
+        
+        for session_dir in Path("uploads").iterdir():
+            if not session_dir.is_dir() or session_dir == BLOB_DIR:
+                continue
+            session_usage = usage.setdefault(session_dir.name, {field: 0 for field in self.SESSION_FIELDS})
+            for file_path in session_dir.iterdir():
+                size = self.file_size(file_path)
+                if size is not None:
+                    session_usage["upload_bytes"] += size
+                    session_usage["upload_files"] += 1
+        
+        for pdf_file in Path("temp").glob("combined_*.pdf"):
+            size = self.file_size(pdf_file)
+            if size is not None:
+                session_usage = usage.setdefault(pdf_file.name[9:-4], {field: 0 for field in self.SESSION_FIELDS})
+                session_usage["output_bytes"] += size
+                session_usage["output_files"] += 1
+        
+        for blob in BLOB_DIR.rglob("*"):
+            if blob.is_file() and blob.parent != blob_store.tmp_dir and blob != blob_store.lock_path:
+                size = self.file_size(blob) or 0
+                if blob_store.fragment_dir in blob.parents:
+                    actual["fragment_bytes"] += size
+                else:
+                    actual["blob_bytes"] += size
+                    actual["blob_files"] += 1
+        
+        for session_id, session_usage in usage.items():
+            for field in self.SESSION_FIELDS:
+                actual[field] += session_usage[field]
+            if session_store.exists(session_id):
+                session_store.set_fields(session_id, usage=session_usage)
+            else:
+                orphaned_uploads += session_usage["upload_files"] > 0
+                orphaned_pdfs += session_usage["output_files"]
+        
+        recorded = self.totals()
+        drift = {field: actual[field] - recorded[field] for field in self.FIELDS if actual[field] != recorded[field]}
+        session_store.set_counters("disk", actual)
+        
+        self.last_reconcile = time.time()
+        self.last_scan = {"orphaned_uploads": orphaned_uploads, "orphaned_pdfs": orphaned_pdfs, "drift": drift}
+        if drift:
+            print(f"📒 Disk ledger corrected by reconciliation: {drift}")
+        return drift
+
+disk_ledger = DiskLedger()
+
+class StorageBudget:
+    """Admission control for disk space: a global byte budget plus a per-session quota
+    
+    Uploads reserve space chunk by chunk as they stream in. When the budget is under
+    pressure, downloaded sessions are evicted least-recently-used first; what still
+    doesn't fit is refused with 507 (429 for a session over its quota) and Retry-After.
+    Eviction deletes files and waits for session locks, so it only ever runs in threads
+    (see UploadBudget.consume).
+    """
+    USAGE_TTL = 1.0  # seconds the ledger totals are reused between chunks
+    EVICT_BATCH = 100  # downloaded sessions one eviction looks at
+    
+    def __init__(self, budget_bytes: int, session_quota_bytes: int, pressure_ratio: float):
+        self.budget_bytes = budget_bytes
+        self.session_quota_bytes = session_quota_bytes
+        self.pressure_ratio = pressure_ratio
+        self.reserved = 0
+        self.lock = threading.Lock()
+        self.usage_cache = (0, 0)
+        self.evictions = 0
+        self.rejections = 0
+    
+    def disk_usage(self, fresh: bool = False) -> int:
+        """Bytes actually stored: unique blobs, fragments and combined PDFs"""
+        read_at, usage = self.usage_cache
+        if fresh or time.time() - read_at > self.USAGE_TTL:
+            totals = disk_ledger.totals()
+            usage = totals["blob_bytes"] + totals["fragment_bytes"] + totals["output_bytes"]
+            self.usage_cache = (time.time(), usage)
+        return usage
+    
+    @staticmethod
+    def session_usage(session_id: str) -> int:
+        usage = (session_store.get(session_id) or {}).get("usage", {})
+        return usage.get("upload_bytes", 0) + usage.get("output_bytes", 0)
+    
+    def check_quota(self, session_used: int, size: int):
+        """Refuse a chunk that takes the session over its quota (session_used includes this request)"""
+        if self.session_quota_bytes and session_used + size > self.session_quota_bytes:
+            self.rejections += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"Session storage quota of {round(self.session_quota_bytes / (1024 * 1024), 1)} MB exceeded",
+                headers={"Retry-After": str(CLEANUP_INTERVAL)}
+            )
+    
+    def try_reserve(self, size: int, fresh: bool = False) -> bool:
+        """Claim space for a chunk if it fits the budget as it is (no eviction)"""
+        if not self.budget_bytes:
+            return True
+        with self.lock:
+            if self.disk_usage(fresh) + self.reserved + size > self.budget_bytes:
+                return False
+            self.reserved += size
+            return True
+    
+    def reserve(self, session_id: str, session_used: int, size: int):
+        """Claim space for a chunk, evicting downloaded sessions if needed - call from a thread"""
+        self.check_quota(session_used, size)
+        if self.try_reserve(size):
+            return
+        self.evict(self.budget_bytes - size)
+        if not self.try_reserve(size, fresh=True):
+            self.rejections += 1
+            raise HTTPException(
+                status_code=507,
+                detail="Server storage is full, please try again later",
+                headers={"Retry-After": str(CLEANUP_INTERVAL)}
+            )
+    
+    def release(self, size: int):
+        """Hand back reserved space once the upload is stored (the ledger counts it now) or failed"""
+        with self.lock:
+            self.reserved = max(0, self.reserved - size)
+            self.usage_cache = (0, 0)
+    
+    def check_available(self):
+        """Refuse new work that writes to disk while the budget is exhausted - call from a thread"""
+        if self.budget_bytes and self.disk_usage() + self.reserved >= self.budget_bytes:
+            self.evict(self.budget_bytes * self.pressure_ratio)
+            if self.disk_usage(fresh=True) + self.reserved >= self.budget_bytes:
+                self.rejections += 1
+                raise HTTPException(
+                    status_code=507,
+                    detail="Server storage is full, please try again later",
+                    headers={"Retry-After": str(CLEANUP_INTERVAL)}
+                )
+    
+    def under_pressure(self) -> bool:
+        return bool(self.budget_bytes) and self.disk_usage(fresh=True) > self.budget_bytes * self.pressure_ratio
+    
+    def evict(self, target_bytes: float) -> int:
+        """Clean up downloaded sessions, least recently used first, until usage is below target_bytes"""
+        evicted = 0
+        if self.disk_usage(fresh=True) + self.reserved <= target_bytes:
+            return evicted
+        
+        # The store's downloaded-session index hands them out least recently accessed first
+        for session_id in session_store.downloaded_sessions(limit=self.EVICT_BATCH):
+            if SessionManager.cleanup_session(session_id, only_if_downloaded=True):
+                evicted += 1
+            if self.disk_usage(fresh=True) + self.reserved <= target_bytes:
+                break
+        
+        if evicted:
+            with self.lock:
+                self.evictions += evicted
+            print(f"💾 Evicted {evicted} downloaded sessions to free disk space")
+        return evicted
+    
+    def get_stats(self) -> dict:
+        usage = self.disk_usage(fresh=True)
+        return {
+            "budget_mb": round(self.budget_bytes / (1024 * 1024), 2),
+            "used_mb": round(usage / (1024 * 1024), 2),
+            "reserved_mb": round(self.reserved / (1024 * 1024), 2),
+            "session_quota_mb": round(self.session_quota_bytes / (1024 * 1024), 2),
+            "under_pressure": self.under_pressure(),
+            "evictions": self.evictions,
+            "rejections": self.rejections
+        }
+
+storage_budget = StorageBudget(DISK_BUDGET_BYTES, SESSION_QUOTA_BYTES, DISK_PRESSURE_RATIO)
+
+class BlobStore:
+    """Content-addressed upload storage shared by all sessions.
+    
+    Each unique file content is stored once as uploads/_blobs/<hash>; session files are
+    hardlinks to it, so the blob's link count is its reference count. Normalized PDF
+    fragments derived from a blob live under fragments/ and are dropped with it.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.tmp_dir = self.root / "tmp"
+        self.fragment_dir = self.root / "fragments"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.fragment_dir.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.lock_path = self.root / ".lock"
+    
+    @contextmanager
+    def locked(self):
+        """Serialize link/unlink decisions across threads and worker processes"""
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+    
+    def blob_path(self, content_hash: str) -> Path:
+        return self.root / content_hash[:2] / content_hash
+    
+    def fragment_path(self, content_hash: str) -> Path:
+        """Where the ready-to-append PDF fragment of an image blob is stored"""
+        return self.fragment_dir / content_hash[:2] / f"{content_hash}.pdf"
+    
+    def new_temp_path(self) -> Path:
+        """Path to stream a new upload to before its hash is known"""
+        return self.tmp_dir / f"{uuid.uuid4().hex}.tmp"
+    
+    def commit(self, temp_path: Path, content_hash: str, link_path: Path) -> bool:
+        """Move a finished upload into the store and link it into a session.
+        
+        Returns True if the content was already stored (the upload was deduplicated).
+        """
+        blob = self.blob_path(content_hash)
+        blob.parent.mkdir(exist_ok=True)
+        
+        with self.locked():
+            if blob.exists():
+                try:
+                    self._link(blob, link_path)
+                    temp_path.unlink(missing_ok=True)
+                    return True
+                except FileNotFoundError:
+                    # Blob was garbage collected by another process in the meantime
+                    pass
+            os.replace(temp_path, blob)
+            self._link(blob, link_path)
+            disk_ledger.record(blob_bytes=blob.stat().st_size, blob_files=1)
+            return False
+    
+    def _link(self, blob: Path, link_path: Path):
+        try:
+            os.link(blob, link_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # Filesystem without hardlinks - fall back to a private copy
+            shutil.copyfile(blob, link_path)
+    
+    def remove_fragment(self, fragment: Path):
+        size = DiskLedger.file_size(fragment)
+        if size is not None:
+            fragment.unlink(missing_ok=True)
+            disk_ledger.record(fragment_bytes=-size)
+    
+    def release(self, content_hash: str) -> bool:
+        """Drop a blob once no session file links to it any more"""
+        blob = self.blob_path(content_hash)
+        with self.locked():
+            try:
+                stat = blob.stat()
+                if stat.st_nlink <= 1:
+                    blob.unlink()
+                    disk_ledger.record(blob_bytes=-stat.st_size, blob_files=-1)
+                    self.remove_fragment(self.fragment_path(content_hash))
+                    return True
+            except FileNotFoundError:
+                pass
+        return False
+    
+    def collect_garbage(self) -> int:
+        """Remove unreferenced blobs and stale partial uploads"""
+        removed = 0
+        current_time = time.time()
+        
+        for blob_dir in self.root.iterdir():
+            if not blob_dir.is_dir():
+                continue
+            
+            if blob_dir == self.tmp_dir:
+                # Partial uploads left behind by a crash
+                for temp_file in blob_dir.iterdir():
+                    try:
+                        if current_time - temp_file.stat().st_mtime > SESSION_TIMEOUT:
+                            temp_file.unlink()
+                            removed += 1
+                    except OSError:
+                        pass
+                continue
+            
+            if blob_dir == self.fragment_dir:
+                # Fragments whose blob is already gone
+                for fragment in blob_dir.rglob("*.pdf"):
+                    if not self.blob_path(fragment.stem).exists():
+                        self.remove_fragment(fragment)
+                        removed += 1
+                continue
+            
+            for blob in blob_dir.iterdir():
+                if self.release(blob.name):
+                    removed += 1
+        
+        return removed
+
+blob_store = BlobStore(BLOB_DIR)
+
 class SessionManager:
     @staticmethod
     def create_session(session_id: str):
         """Create a new session with timestamp"""
-        sessions[session_id] = {
-            "files": {},
-            "order": [],
-            "created_at": time.time(),
-            "last_accessed": time.time(),
-            "downloaded": False
-        }
+        session_store.create(session_id)
     
     @staticmethod
     def update_session_access(session_id: str):
         """Update last accessed time for session"""
-        if session_id in sessions:
-            sessions[session_id]["last_accessed"] = time.time()
+        session_store.touch(session_id)
     
     @staticmethod
-    def cleanup_session(session_id: str):
-        """Clean up all files and data for a session"""
-        if session_id not in sessions:
-            return
+    def parse_order(order: list, files: dict) -> list:
+        """Validate an order from /reorder or /combine
+        
+        Entries are file ids or {"file_id", "pages", "rotate"} selections. pages lists 1-based
+        page numbers and "first-last" ranges, or is one string like "1-3,7"; it defaults to all
+        pages. rotate (a multiple of 90) is added to every selected page. Entries that select
+        nothing special stay plain file ids.
+        """
+        if not isinstance(order, list):
+            raise ValueError("Order must be a list")
         
+        entries = []
+        for entry in order:
+            if isinstance(entry, str):
+                entries.append(entry)
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get("file_id"), str):
+                raise ValueError("Order entries must be file ids or objects with a file_id")
+            
+            pages = entry.get("pages")
+            if pages is not None:
+                file_info = files.get(entry["file_id"])
+                if file_info is None:
+                    raise ValueError(f"Unknown file: {entry['file_id']}")
+                page_count = file_info.get("page_count") or (1 if file_info.get("type") == "image" else None)
+                if page_count is None:
+                    # Without the page count the selection can't be bounded
+                    raise PageSelectionError(f"{file_info['filename']} is still being processed, "
+                                             f"select its pages once its page count is known")
+                pages = parse_page_ranges(pages, page_count, file_info["filename"])
+            
+            rotate = entry.get("rotate", 0) or 0
+            if not isinstance(rotate, int) or rotate % 90:
+                raise ValueError("rotate must be a multiple of 90")
+            rotate %= 360
+            
+            if pages is None and not rotate:
+                entries.append(entry["file_id"])
+            else:
+                entries.append({"file_id": entry["file_id"], "pages": pages, "rotate": rotate})
+        return entries
+    
+    @staticmethod
+    def check_pages(file_info: dict, pages: list, page_count: int = None):
+        """Raise PageSelectionError unless every page exists (page_count None checks only the lower bound)"""
+        for page in pages:
+            if page < 1 or (page_count is not None and page > page_count):
+                raise PageSelectionError(
+                    f"Page {page} is out of range for {file_info['filename']}"
+                    + (f" ({page_count} pages)" if page_count is not None else "")
+                )
+    
+    @staticmethod
+    def cleanup_session(session_id: str, expired_at: float = None, only_if_downloaded: bool = False):
+        """Clean up all files and data for a session
+        
+        With expired_at, the session is only cleaned up if it is still expired at that
+        time once its lock is held (it may have been used in the meantime). Eviction
+        passes only_if_downloaded, which also skips sessions that are busy right now.
+        """
+        with session_locks.hold(session_id, blocking=not only_if_downloaded) as acquired:
+            if not acquired:
+                return False
+            session = session_store.get(session_id)
+            if session is None:
+                return False
+            if expired_at is not None and session_store.expires_at(session) > expired_at:
+                return False
+            if only_if_downloaded and not session.get("downloaded"):
+                return False
+            SessionManager._remove_session(session_id, session)
+            return True
+    
+    @staticmethod
+    def _remove_session(session_id: str, session: dict):
         try:
-            # Delete all uploaded files
+            # Delete all uploaded files, then drop blobs no other session references
             upload_dir = Path(f"uploads/{session_id}")
             if upload_dir.exists():
                 shutil.rmtree(upload_dir)
+            for file_info in session["files"].values():
+                if file_info.get("sha256"):
+                    blob_store.release(file_info["sha256"])
             
             # Delete combined PDF
             combined_pdf = Path(f"temp/combined_{session_id}.pdf")
             if combined_pdf.exists():
                 combined_pdf.unlink()
             
-            # Remove from sessions
-            del sessions[session_id]
+            # Stop and forget its combine jobs
+            combine_jobs.purge_session(session_id, session.get("jobs", []))
+            
+            # Remove from the session store and the disk totals
+            session_store.delete(session_id)
+            disk_ledger.release_session(session)
             print(f"Cleaned up session: {session_id}")
             
         except Exception as e:
             print(f"Error cleaning up session {session_id}: {e}")
     
+    last_orphan_scan = 0
+    
     @staticmethod
     def cleanup_expired_sessions():
-        """Clean up expired sessions in memory and orphaned files on disk"""
+        """Clean up expired sessions and, every ORPHAN_SCAN_INTERVAL, orphaned files on disk"""
         current_time = time.time()
-        expired_sessions = []
+        cleaned = 0
         
-        # Clean up expired sessions in memory
-        for session_id, session_data in sessions.items():
-            # Check if session has expired (1 hour of inactivity)
-            if current_time - session_data["last_accessed"] > SESSION_TIMEOUT:
-                expired_sessions.append(session_id)
-            # Also clean up downloaded sessions after 10 minutes
-            elif session_data.get("downloaded") and current_time - session_data["last_accessed"] > 600:
-                expired_sessions.append(session_id)
+        # Only sessions the expiry index reports as due (timeout, or 10 minutes after download)
+        for session_id in session_store.expired(current_time):
+            # Re-checked under the session lock: it may have been accessed since the index was read
+            if SessionManager.cleanup_session(session_id, expired_at=current_time):
+                cleaned += 1
         
-        for session_id in expired_sessions:
-            SessionManager.cleanup_session(session_id)
+        if cleaned:
+            print(f"Cleaned up {cleaned} expired sessions")
         
-        if expired_sessions:
-            print(f"Cleaned up {len(expired_sessions)} expired sessions from memory")
+        # Timeouts alone don't bound disk use - under pressure evict downloaded sessions early
+        if storage_budget.under_pressure():
+            storage_budget.evict(storage_budget.budget_bytes * storage_budget.pressure_ratio)
         
-        # Clean up orphaned files on disk
-        orphaned_count = SessionManager.cleanup_orphaned_files()
-        if orphaned_count > 0:
-            print(f"Cleaned up {orphaned_count} orphaned files from disk")
+        # Clean up orphaned files on disk - a full walk of uploads/ and temp/, so not every tick
+        if current_time - SessionManager.last_orphan_scan >= ORPHAN_SCAN_INTERVAL:
+            SessionManager.last_orphan_scan = current_time
+            orphaned_count = SessionManager.cleanup_orphaned_files()
+            if orphaned_count > 0:
+                print(f"Cleaned up {orphaned_count} orphaned files from disk")
+        
+        # Correct drift in the disk ledger - another full walk, so rarer still
+        if current_time - (disk_ledger.last_reconcile or 0) >= LEDGER_RECONCILE_INTERVAL:
+            disk_ledger.reconcile()
     
     @staticmethod
     def cleanup_orphaned_files():
@@ -173,16 +874,21 @@ class SessionManager:
         orphaned_count = 0
         current_time = time.time()
         
+        # A worker that started before the others registered can't see their sessions
+        if session_store.name == "memory" and worker_registry.peers():
+            print("⚠️  Skipping orphaned file cleanup - other workers keep their own memory sessions")
+            return 0
+        
         try:
             # Clean up orphaned upload directories
             uploads_dir = Path("uploads")
             if uploads_dir.exists():
                 for session_dir in uploads_dir.iterdir():
-                    if session_dir.is_dir():
+                    if session_dir.is_dir() and session_dir != BLOB_DIR:
                         session_id = session_dir.name
                         
                         # If session is not in memory, check if directory is old
-                        if session_id not in sessions:
+                        if not session_store.exists(session_id):
                             # Check directory modification time
                             dir_mtime = session_dir.stat().st_mtime
                             age = current_time - dir_mtime
@@ -196,9 +902,24 @@ class SessionManager:
                                 except Exception as e:
                                     print(f"❌ Error removing orphaned directory {session_id}: {e}")
             
+            # Drop blobs whose last session reference is gone
+            removed_blobs = blob_store.collect_garbage()
+            if removed_blobs > 0:
+                orphaned_count += removed_blobs
+                print(f"🗑️  Removed {removed_blobs} unreferenced blobs")
+            
             # Clean up orphaned combined PDFs
             temp_dir = Path("temp")
             if temp_dir.exists():
+                # Partial outputs of combines interrupted by a crash
+                for tmp_file in [*temp_dir.glob("combined_*.tmp"), *temp_dir.glob("batch_*.tmp")]:
+                    try:
+                        if current_time - tmp_file.stat().st_mtime > SESSION_TIMEOUT:
+                            tmp_file.unlink()
+                            orphaned_count += 1
+                    except OSError:
+                        pass
+                
                 for pdf_file in temp_dir.glob("combined_*.pdf"):
                     # Extract session ID from filename
                     filename = pdf_file.name
@@ -206,7 +927,7 @@ class SessionManager:
                         session_id = filename[9:-4]  # Remove "combined_" and ".pdf"
                         
                         # If session is not in memory, check if file is old
-                        if session_id not in sessions:
+                        if not session_store.exists(session_id):
                             file_mtime = pdf_file.stat().st_mtime
                             age = current_time - file_mtime
                             
@@ -226,65 +947,161 @@ class SessionManager:
     
     @staticmethod
     def get_filesystem_stats():
-        """Get statistics about files on disk vs in memory"""
-        stats = {
-            "memory_sessions": len(sessions),
-            "upload_directories": 0,
-            "combined_pdfs": 0,
-            "orphaned_uploads": 0,
-            "orphaned_pdfs": 0,
-            "total_upload_size_mb": 0,
-            "total_pdf_size_mb": 0
+        """Get statistics about files on disk vs in memory (from the disk ledger, no scan)"""
+        totals = disk_ledger.totals()
+        return {
+            "memory_sessions": session_store.count(),
+            "upload_files": totals["upload_files"],
+            "combined_pdfs": totals["output_files"],
+            "orphaned_uploads": disk_ledger.last_scan.get("orphaned_uploads", 0),
+            "orphaned_pdfs": disk_ledger.last_scan.get("orphaned_pdfs", 0),
+            "total_upload_size_mb": round(totals["upload_bytes"] / (1024 * 1024), 2),
+            "total_pdf_size_mb": round(totals["output_bytes"] / (1024 * 1024), 2),
+            "blobs": totals["blob_files"],
+            "blob_size_mb": round(totals["blob_bytes"] / (1024 * 1024), 2),
+            "fragment_size_mb": round(totals["fragment_bytes"] / (1024 * 1024), 2),
+            "last_reconcile": disk_ledger.last_reconcile,
+            "last_reconcile_drift": disk_ledger.last_scan.get("drift", {})
         }
+
+class UploadBudget:
+    """Tracks bytes received across all files of a single upload request
+    
+    Each chunk is also reserved against the disk budget and the session quota; call
+    release() when the request is done. The session may only become known part way
+    through the request (see bind()).
+    """
+    def __init__(self, session_id: str = None, max_request_size: int = MAX_REQUEST_SIZE):
+        self.session_id = None
+        self.max_request_size = max_request_size
+        self.received = 0
+        self.session_used = 0
+        if session_id is not None:
+            self.bind(session_id)
+    
+    def bind(self, session_id: str):
+        """Charge the request to a session, checking what was received so far against its quota"""
+        self.session_id = session_id
+        self.session_used = StorageBudget.session_usage(session_id)
+        storage_budget.check_quota(self.session_used, self.received)
+    
+    def consume(self, size: int):
+        """Account for a received chunk, rejecting the request once it is over budget
         
-        try:
-            # Count upload directories
-            uploads_dir = Path("uploads")
-            if uploads_dir.exists():
-                upload_dirs = [d for d in uploads_dir.iterdir() if d.is_dir()]
-                stats["upload_directories"] = len(upload_dirs)
-                
-                # Count orphaned upload directories
-                for session_dir in upload_dirs:
-                    session_id = session_dir.name
-                    if session_id not in sessions:
-                        stats["orphaned_uploads"] += 1
-                    
-                    # Calculate total size
-                    try:
-                        for file_path in session_dir.rglob("*"):
-                            if file_path.is_file():
-                                stats["total_upload_size_mb"] += file_path.stat().st_size
-                    except:
-                        pass
-            
-            # Count combined PDFs
-            temp_dir = Path("temp")
-            if temp_dir.exists():
-                pdf_files = list(temp_dir.glob("combined_*.pdf"))
-                stats["combined_pdfs"] = len(pdf_files)
-                
-                # Count orphaned PDFs and calculate size
-                for pdf_file in pdf_files:
-                    filename = pdf_file.name
-                    if filename.startswith("combined_") and filename.endswith(".pdf"):
-                        session_id = filename[9:-4]
-                        if session_id not in sessions:
-                            stats["orphaned_pdfs"] += 1
-                    
-                    try:
-                        stats["total_pdf_size_mb"] += pdf_file.stat().st_size
-                    except:
-                        pass
-            
-            # Convert bytes to MB
-            stats["total_upload_size_mb"] = round(stats["total_upload_size_mb"] / (1024 * 1024), 2)
-            stats["total_pdf_size_mb"] = round(stats["total_pdf_size_mb"] / (1024 * 1024), 2)
-        
-        except Exception as e:
-            print(f"❌ Error getting filesystem stats: {e}")
-        
-        return stats
+        Runs in the upload's writer thread: reserving may evict sessions (see StorageBudget).
+        """
+        if self.received + size > self.max_request_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Upload exceeds the {self.max_request_size // (1024 * 1024)} MB request limit"
+            )
+        storage_budget.reserve(self.session_id, self.session_used + self.received, size)
+        self.received += size
+    
+    def release(self):
+        storage_budget.release(self.received)
+        self.received = 0
+
+class UploadSink:
+    """Where one file of an upload request is written while the request body streams in
+    
+    Starlette calls write() in its threadpool (this isn't an in-memory spool), so hashing,
+    the size limits, the disk budget and the disk write all stay off the event loop.
+    """
+    def __init__(self, filename: str, budget: UploadBudget):
+        self.filename = filename
+        self.budget = budget
+        self.path = blob_store.new_temp_path()
+        self.file = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+    
+    def write(self, data: bytes) -> int:
+        if self.size + len(data) > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{self.filename} exceeds the {MAX_FILE_SIZE // (1024 * 1024)} MB file limit"
+            )
+        self.budget.consume(len(data))
+        self.size += len(data)
+        self.sha256.update(data)
+        if self.file is None:
+            self.file = open(self.path, "wb")
+        return self.file.write(data)
+    
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # The parser rewinds a file once its part is complete - nothing is read back from here
+        self.close()
+        return 0
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def discard(self):
+        """Drop the partial file (a limit was hit, the client went away or storing failed)"""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+class UploadParser(MultiPartParser):
+    """Multipart parser for /upload and /batch that writes each file to disk as its bytes arrive
+    
+    FastAPI's File(...) parameters spool the whole body before the handler runs, so limits
+    could only be checked afterwards. Here every file part goes to an UploadSink instead
+    of a spooled temp file, and a session_id field sent before the files binds the quota
+    while they are still streaming.
+    """
+    def __init__(self, request: Request, budget: UploadBudget):
+        super().__init__(request.headers, request.stream(), max_files=MAX_UPLOAD_FILES)
+        self.budget = budget
+        self.sinks = []
+    
+    def on_headers_finished(self):
+        super().on_headers_finished()
+        upload = self._current_part.file
+        if upload is not None:
+            upload.file.close()
+            upload.file = UploadSink(upload.filename, self.budget)
+            self.sinks.append(upload.file)
+    
+    def on_part_end(self):
+        super().on_part_end()
+        name, value = self.items[-1]
+        if name == "session_id" and isinstance(value, str) and self.budget.session_id is None:
+            self.budget.bind(value)
+    
+    def discard(self):
+        for sink in self.sinks:
+            sink.discard()
+
+class CombineCancelled(Exception):
+    """Raised inside a combine when its job has been cancelled"""
+
+class PageSelectionError(ValueError):
+    """Raised when an order entry selects pages a file doesn't have"""
+
+class ProgressWriter:
+    """Output file wrapper that reports bytes written and aborts a cancelled combine"""
+    def __init__(self, stream, report, cancel_event: threading.Event = None):
+        self.stream = stream
+        self.report = report
+        self.cancel_event = cancel_event
+        self.bytes_written = 0
+    
+    def write(self, data: bytes) -> int:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise CombineCancelled()
+        written = self.stream.write(data)
+        self.bytes_written += len(data)
+        self.report(bytes_written=self.bytes_written)
+        return written
+    
+    def tell(self) -> int:
+        return self.stream.tell()
+    
+    def flush(self):
+        self.stream.flush()
 
 class FileManager:
     def __init__(self, session_id: str):
@@ -292,150 +1109,879 @@ class FileManager:
         self.upload_dir = Path(f"uploads/{session_id}")
         self.upload_dir.mkdir(exist_ok=True)
         
-    def save_file(self, file: UploadFile) -> dict:
-        """Save uploaded file and return file info"""
+    # Server-side bookkeeping on a file record, left out of what /upload and /files return
+    INTERNAL_FIELDS = ("path", "sha256", "fragment_path", "page_refs", "page_sizes", "thumbnail_key")
+    
+    @staticmethod
+    def public_info(file_info: dict) -> dict:
+        """A file record as sent to the client"""
+        return {name: value for name, value in file_info.items() if name not in FileManager.INTERNAL_FIELDS}
+    
+    def store_file(self, sink: UploadSink) -> dict:
+        """Move a received upload into the blob store, link it into the session and return its file info"""
         file_id = str(uuid.uuid4())
-        file_path = self.upload_dir / f"{file_id}_{file.filename}"
+        file_path = self.upload_dir / f"{file_id}_{sink.filename}"
+        content_hash = sink.sha256.hexdigest()
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        # Generate thumbnail
-        thumbnail = self.generate_thumbnail(file_path)
+        # Store the content once and hardlink it into the session
+        blob_store.commit(sink.path, content_hash, file_path)
         
         return {
             "id": file_id,
-            "filename": file.filename,
+            "filename": sink.filename,
             "path": str(file_path),
-            "type": "pdf" if file.filename.lower().endswith('.pdf') else "image",
-            "thumbnail": thumbnail
+            "type": "pdf" if sink.filename.lower().endswith('.pdf') else "image",
+            "sha256": content_hash,
+            "size": sink.size,
+            # Rendered later by the thumbnail workers and served by /thumbnail
+            "thumbnail_status": "pending",
+            "thumbnail_url": f"/thumbnail/{self.session_id}/{file_id}",
+            # Filled in by the background normalization (see FragmentJobs)
+            "fragment_status": "pending",
+            "page_count": None,
+            "page_sizes": None,
+            "page_refs": None
         }
     
-    def generate_thumbnail(self, file_path: Path) -> str:
-        """Generate base64 thumbnail for file"""
-        try:
-            if str(file_path).lower().endswith('.pdf'):
-                # PDF thumbnail - try with poppler, fallback to default icon
-                try:
-                    pages = convert_from_path(file_path, first_page=1, last_page=1, dpi=50)
-                    if pages:
-                        img = pages[0]
-                        img.thumbnail((120, 120), Image.Resampling.LANCZOS)
-                        buffer = BytesIO()
-                        img.save(buffer, format='PNG')
-                        return base64.b64encode(buffer.getvalue()).decode()
-                except Exception as pdf_error:
-                    print(f"PDF thumbnail generation failed (poppler may not be installed): {pdf_error}")
-                    # Return empty string to use default PDF icon
-                    return ""
-            else:
-                # Image thumbnail
-                with Image.open(file_path) as img:
-                    img.thumbnail((120, 120), Image.Resampling.LANCZOS)
-                    buffer = BytesIO()
-                    img.save(buffer, format='PNG')
-                    return base64.b64encode(buffer.getvalue()).decode()
-        except Exception as e:
-            print(f"Error generating thumbnail: {e}")
-            return ""
-    
-    def combine_files(self, file_order: List[str]) -> str:
-        """Combine files in specified order"""
+    def combine_files(self, file_order: list, progress=None, cancel_event: threading.Event = None,
+                      optimize: bool = False, linearize: bool = False) -> str:
+        """Combine files in specified order
+        
+        progress(**fields) is called with total_pages, pages_processed and bytes_written as the
+        merge advances; setting cancel_event aborts it with CombineCancelled. Re-combining the
+        same content in the same order returns the existing output without merging again.
+        With optimize, the merged PDF goes through optimize_pdf before it is swapped in; with
+        linearize it is then rewritten linearized by qpdf, if installed.
+        """
         output_path = Path(f"temp/combined_{self.session_id}.pdf")
+        report = progress or (lambda **fields: None)
+        session = session_store.get(self.session_id) or {"files": {}}
         
-        pdf_writer = PdfWriter()
-        temp_files = []
+        def check_cancelled():
+            if cancel_event is not None and cancel_event.is_set():
+                raise CombineCancelled()
+        
+        # (file info, 1-based pages or None for all, rotation) per order entry
+        selections = []
+        for entry in file_order:
+            file_info = session["files"].get(entry_file_id(entry))
+            if file_info is not None:
+                selection = entry if isinstance(entry, dict) else {}
+                selections.append((file_info, selection.get("pages"), selection.get("rotate", 0)))
+        combine_key = combine_cache.make_key(
+            [(file_info["sha256"], file_info["type"], pages, rotate) for file_info, pages, rotate in selections],
+            image_resolution=IMAGE_PAGE_RESOLUTION,
+            image_page=[IMAGE_PAGE_FIT, IMAGE_PAGE_DPI, IMAGE_QUALITY],
+            optimize=optimize,
+            linearize=linearize
+        )
+        if combine_cache.get_output(self.session_id, combine_key):
+            report(cached=True)
+            return str(output_path)
+        
+        # Written next to the output and renamed over it when complete
+        temp_path = output_path.with_name(f"combined_{self.session_id}.{uuid.uuid4().hex}.tmp")
         
         try:
-            for file_id in file_order:
-                file_info = sessions[self.session_id]["files"].get(file_id)
-                if not file_info:
-                    continue
-                    
-                file_path = Path(file_info["path"])
-                
-                if file_info["type"] == "pdf":
-                    # Handle PDF
-                    pdf_reader = PdfReader(file_path)
-                    for page in pdf_reader.pages:
-                        pdf_writer.add_page(page)
-                else:
-                    # Handle image - convert to PDF first
-                    temp_pdf = self.image_to_pdf(file_path)
-                    if temp_pdf:
-                        temp_files.append(temp_pdf)
-                        pdf_reader = PdfReader(temp_pdf)
-                        for page in pdf_reader.pages:
-                            pdf_writer.add_page(page)
-            
-            # Write combined PDF
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-            
-            # Clean up temp files
-            for temp_file in temp_files:
-                try:
-                    os.unlink(temp_file)
-                except:
-                    pass
+            if self.use_low_memory_merge(selections):
+                self.merge_low_memory(selections, temp_path, report, check_cancelled)
+                if optimize:
+                    # The optimizer holds the whole object graph - not for inputs this size
+                    report(optimization={"skipped": "input too large for optimization"})
+            else:
+                self.merge_in_memory(selections, temp_path, report, check_cancelled, cancel_event)
+                if optimize:
+                    self.optimize_output(temp_path, report, check_cancelled)
+            if linearize:
+                check_cancelled()
+                self.linearize_output(temp_path, report)
             
+            # Swap it in atomically: downloads see the old or the new PDF, never a partial one
+            with session_locks.hold(self.session_id):
+                if not session_store.exists(self.session_id):
+                    print(f"Session {self.session_id} was removed during combine")
+                    return None
+                output_size_before = DiskLedger.file_size(output_path)
+                os.replace(temp_path, output_path)
+                combine_cache.put_output(self.session_id, combine_key)
+                disk_ledger.record_output(self.session_id, output_size_before, DiskLedger.file_size(output_path))
             return str(output_path)
             
+        except (CombineCancelled, PageSelectionError):
+            raise
         except Exception as e:
             print(f"Error combining files: {e}")
             return None
+        finally:
+            temp_path.unlink(missing_ok=True)
+    
+    def merge_in_memory(self, selections: list, temp_path: Path, report, check_cancelled, cancel_event):
+        """Merge with pypdf's PdfWriter from cached parsed sources, then write the PDF out"""
+        pdf_writer = PdfWriter()
+        # Open every source first so progress has a page total to work against
+        sources = []
+        estimated_bytes = 0
+        for file_info, pages, rotate in selections:
+            check_cancelled()
+            file_path = Path(file_info["path"])
+            try:
+                # Parsed PDF or converted image page, shared with earlier combines of the same file
+                source = combine_cache.get_source(
+                    file_info["sha256"], file_path, file_info["type"], file_info.get("fragment_path")
+                )
+            except Exception as e:
+                if file_info["type"] == "pdf":
+                    raise
+                print(f"Error converting image to PDF: {e}")
+                continue
+        
+            # The page index gives the count without walking the page tree
+            page_count = file_info.get("page_count")
+            if page_count is None:
+                with source["lock"]:
+                    page_count = len(source["reader"].pages)
+            if pages is None:
+                indexes = range(page_count)
+            else:
+                SessionManager.check_pages(file_info, pages, page_count)
+                indexes = [page - 1 for page in pages]
+            sources.append((source, file_info.get("page_refs"), indexes, rotate))
+            estimated_bytes += os.path.getsize(file_path) * len(indexes) // max(page_count, 1)
+        
+        total_pages = sum(len(indexes) for _, _, indexes, _ in sources)
+        report(total_pages=total_pages, estimated_bytes=estimated_bytes)
+        
+        pages_processed = 0
+        for source, page_refs, indexes, rotate in sources:
+            # Readers are shared between combine jobs but aren't thread-safe
+            with source["lock"]:
+                for index in indexes:
+                    check_cancelled()
+                    # Only the selected pages are resolved - the rest of the file is never parsed
+                    page = pdf_writer.add_page(get_indexed_page(source["reader"], index, page_refs))
+                    if rotate:
+                        # Rotate the output copy; the cached source page stays as it is
+                        page.rotate(rotate)
+                    pages_processed += 1
+                    report(pages_processed=pages_processed)
+        
+        # Write combined PDF
+        with open(temp_path, 'wb') as output_file:
+            pdf_writer.write(ProgressWriter(output_file, report, cancel_event))
     
-    def image_to_pdf(self, image_path: Path) -> str:
-        """Convert image to PDF"""
+    @staticmethod
+    def optimize_output(temp_path: Path, report, check_cancelled):
+        """Replace the merged PDF with its optimized rewrite, if that is smaller"""
+        optimized_path = temp_path.with_suffix(".opt.tmp")
         try:
-            with Image.open(image_path) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-                temp_pdf.close()
-                
-                img.save(temp_pdf.name, "PDF", resolution=100.0)
-                return temp_pdf.name
-        except Exception as e:
-            print(f"Error converting image to PDF: {e}")
+            with open(optimized_path, 'wb') as optimized_file:
+                stats = optimize_pdf(temp_path, optimized_file, checkpoint=check_cancelled)
+            if stats["bytes_saved"] > 0:
+                os.replace(optimized_path, temp_path)
+        finally:
+            optimized_path.unlink(missing_ok=True)
+        
+        report(optimization=stats, bytes_written=min(stats["bytes_before"], stats["bytes_after"]))
+        print(f"🗜️ Optimized combined PDF: {stats['bytes_saved'] // 1024} KB saved "
+              f"({stats['duplicates_merged']} duplicates merged) in {stats['seconds']}s")
+    
+    @staticmethod
+    def linearize_output(temp_path: Path, report):
+        """Replace the merged PDF with a linearized copy (left as it is without qpdf)"""
+        linearized_path = temp_path.with_suffix(".lin.tmp")
+        try:
+            linearized = linearize_pdf(temp_path, linearized_path)
+            if linearized:
+                os.replace(linearized_path, temp_path)
+                report(bytes_written=temp_path.stat().st_size)
+        finally:
+            linearized_path.unlink(missing_ok=True)
+        report(linearized=linearized)
+    
+    @staticmethod
+    def use_low_memory_merge(selections: list) -> bool:
+        """Whether a combine should use the low-memory merge (see LOW_MEMORY_MERGE)"""
+        return use_low_memory_merge(sum(file_info.get("size", 0) for file_info, _, _ in selections))
+    
+    def merge_low_memory(self, selections: list, temp_path: Path, report, check_cancelled):
+        """Merge with bounded memory (see merge_pdf_low_memory), for inputs too big to hold in RAM"""
+        sources = []
+        kinds = {}
+        total_pages = 0
+        estimated_bytes = 0
+        for file_info, pages, rotate in selections:
+            check_cancelled()
+            path, kind, page_refs = file_info["path"], file_info["type"], file_info.get("page_refs")
+            if kind != "pdf":
+                # Normalized images are read from their one-page PDF fragment
+                fragment_path = file_info.get("fragment_path")
+                if fragment_path and Path(fragment_path).exists():
+                    path, kind = fragment_path, "pdf"
+                else:
+                    page_refs = None
+            page_count = file_info.get("page_count") or (count_pages(path) if kind == "pdf" else 1)
+            if pages is None:
+                indexes, selected = None, page_count
+            else:
+                SessionManager.check_pages(file_info, pages, page_count)
+                indexes, selected = [page - 1 for page in pages], len(pages)
+            sources.append((path, kind, indexes, rotate, page_refs))
+            kinds[str(path)] = file_info["type"]
+            total_pages += selected
+            estimated_bytes += file_info.get("size", 0) * selected // max(page_count, 1)
+        report(total_pages=total_pages, estimated_bytes=estimated_bytes, low_memory=True)
+        
+        def progress(pages_processed: int, bytes_written: int):
+            check_cancelled()
+            report(pages_processed=pages_processed, bytes_written=bytes_written)
+        
+        def on_error(path, error: Exception):
+            # Like the in-memory merge: a broken PDF fails the combine, a broken image is skipped
+            if kinds.get(str(path)) == "pdf":
+                raise error
+            print(f"Error converting image to PDF: {error}")
+        
+        with open(temp_path, 'wb') as output_file:
+            stats = merge_pdf_low_memory(sources, output_file, progress=progress, on_error=on_error)
+        report(peak_rss_mb=stats["peak_rss_mb"])
+        print(f"🧮 Low-memory merge of {stats['pages']} pages: peak anonymous RSS {stats['peak_rss_mb']} MB "
+              f"(target {stats['rss_target_mb']} MB, {stats['cache_flushes']} cache flushes)")
+
+class CombineCache:
+    """Memoizes combine outputs and the parsed sources they are built from
+    
+    A session's output is reused while the ordered source hashes and options are unchanged.
+    Sources (parsed PDFs and images converted to one-page PDFs) live in a byte-bounded LRU
+    keyed by content hash, so a reorder only re-assembles pages.
+    """
+    def __init__(self, max_source_bytes: int):
+        self.max_source_bytes = max_source_bytes
+        self.sources = OrderedDict()
+        self.source_bytes = 0
+        self.lock = threading.Lock()
+        self.output_hits = 0
+        self.output_misses = 0
+        self.source_hits = 0
+        self.source_misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+    
+    @staticmethod
+    def make_key(sources: list, **options) -> str:
+        """Cache key for a combine of the given (content hash, type) list in order"""
+        payload = json.dumps({"sources": sources, "options": options}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    def get_output(self, session_id: str, key: str):
+        """Path of the session's combined PDF if it was built for this key, else None"""
+        output_path = Path(f"temp/combined_{session_id}.pdf")
+        session = session_store.get(session_id) or {}
+        with self.lock:
+            if session.get("combined_key") == key and output_path.exists():
+                self.output_hits += 1
+                self.bytes_saved += output_path.stat().st_size
+                return output_path
+            self.output_misses += 1
+        return None
+    
+    def put_output(self, session_id: str, key: str):
+        """Record the key the session's combined PDF was just built for"""
+        session_store.set_fields(session_id, combined_key=key)
+    
+    def get_source(self, content_hash: str, file_path: Path, file_type: str, fragment_path: str = None) -> dict:
+        """Parsed source as {"reader", "lock", "size"}, loaded on a miss
+        
+        fragment_path is the normalized fragment of the file when it is ready; without it
+        images are converted on the spot.
+        """
+        key = f"{content_hash}_{file_type}"
+        with self.lock:
+            source = self.sources.get(key)
+            if source is not None:
+                self.sources.move_to_end(key)
+                self.source_hits += 1
+                self.bytes_saved += source["size"]
+                return source
+            self.source_misses += 1
+        
+        if fragment_path:
+            source = self.load_source(fragment_path, "pdf")
+        else:
+            source = self.load_source(file_path, file_type)
+        with self.lock:
+            if key in self.sources:
+                # Loaded concurrently by another job
+                return self.sources[key]
+            self.sources[key] = source
+            self.source_bytes += source["size"]
+            while self.source_bytes > self.max_source_bytes and len(self.sources) > 1:
+                _, evicted = self.sources.popitem(last=False)
+                self.source_bytes -= evicted["size"]
+                self.evictions += 1
+        return source
+    
+    @staticmethod
+    def load_source(file_path: Path, file_type: str) -> dict:
+        """Parse a PDF, or convert an image to a one-page PDF (JPEGs are passed through)"""
+        if file_type == "pdf":
+            data = Path(file_path).read_bytes()
+        else:
+            image_writer = PdfWriter()
+            add_image_page(image_writer, file_path)
+            buffer = BytesIO()
+            image_writer.write(buffer)
+            data = buffer.getvalue()
+        
+        reader = PdfReader(BytesIO(data))
+        # Pages are resolved on demand (see get_indexed_page), not when the source is loaded
+        return {"reader": reader, "lock": threading.Lock(), "size": len(data)}
+    
+    def get_stats(self) -> dict:
+        """Hit/miss counters, bytes saved and source tier size"""
+        with self.lock:
+            output_lookups = self.output_hits + self.output_misses
+            source_lookups = self.source_hits + self.source_misses
+            return {
+                "output_hits": self.output_hits,
+                "output_misses": self.output_misses,
+                "output_hit_rate": round(self.output_hits / output_lookups, 3) if output_lookups else 0,
+                "source_hits": self.source_hits,
+                "source_misses": self.source_misses,
+                "source_hit_rate": round(self.source_hits / source_lookups, 3) if source_lookups else 0,
+                "bytes_saved_mb": round(self.bytes_saved / (1024 * 1024), 2),
+                "cached_sources": len(self.sources),
+                "source_size_mb": round(self.source_bytes / (1024 * 1024), 2),
+                "max_source_size_mb": round(self.max_source_bytes / (1024 * 1024), 2),
+                "source_evictions": self.evictions
+            }
+
+combine_cache = CombineCache(COMBINE_CACHE_BYTES)
+
+class ThumbnailCache:
+    """Content-addressed thumbnail cache with an in-memory LRU tier and a size-bounded disk tier"""
+    def __init__(self, cache_dir: str, max_memory_items: int, max_disk_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        # Size the disk tier once at startup, then track it incrementally
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.disk_bytes = sum(f.stat().st_size for f in self.cache_dir.rglob("*.thumb") if f.is_file())
+    
+    @staticmethod
+    def make_key(content_hash: str, size: int = THUMBNAIL_SIZE, dpi: int = THUMBNAIL_DPI,
+                 image_format: str = THUMBNAIL_FORMAT) -> str:
+        """Cache key for a file's content rendered with the given parameters"""
+        return f"{content_hash}_{size}_{dpi}_{image_format.lower()}"
+    
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.thumb"
+    
+    def get(self, key: str):
+        """Return cached thumbnail bytes or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+        
+        disk_path = self._disk_path(key)
+        try:
+            data = disk_path.read_bytes()
+            # Bump mtime so disk eviction is least-recently-used
+            os.utime(disk_path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
             return None
+        
+        with self.lock:
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+    
+    def put(self, key: str, data: bytes):
+        """Store thumbnail bytes in both tiers"""
+        with self.lock:
+            self._remember(key, data)
+        
+        disk_path = self._disk_path(key)
+        try:
+            if disk_path.exists():
+                return
+            disk_path.parent.mkdir(exist_ok=True)
+            tmp_path = disk_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, disk_path)
+        except OSError as e:
+            print(f"❌ Error writing thumbnail cache entry: {e}")
+            return
+        
+        with self.lock:
+            self.disk_bytes += len(data)
+            over_budget = self.disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self.evict_disk()
+    
+    def _remember(self, key: str, data: bytes):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+    
+    def evict_disk(self):
+        """Remove least-recently-used disk entries until the tier is at 90% of its budget"""
+        entries = []
+        for entry in self.cache_dir.rglob("*.thumb"):
+            try:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry))
+            except OSError:
+                pass
+        entries.sort()
+        
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9
+        evicted = 0
+        for _, size, entry in entries:
+            if total <= target:
+                break
+            try:
+                entry.unlink()
+                total -= size
+                evicted += 1
+            except OSError:
+                pass
+        
+        with self.lock:
+            self.disk_bytes = total
+            self.evictions += evicted
+        if evicted:
+            print(f"🗑️  Evicted {evicted} thumbnail cache entries from disk")
+    
+    def get_stats(self) -> dict:
+        """Hit/miss counters and tier sizes"""
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0,
+                "memory_items": len(self.memory),
+                "max_memory_items": self.max_memory_items,
+                "disk_size_mb": round(self.disk_bytes / (1024 * 1024), 2),
+                "max_disk_size_mb": round(self.max_disk_bytes / (1024 * 1024), 2),
+                "disk_evictions": self.evictions
+            }
+
+thumbnail_cache = ThumbnailCache("cache/thumbnails", THUMBNAIL_CACHE_MEMORY_ITEMS, THUMBNAIL_CACHE_DISK_BYTES)
+
+class ThumbnailJobs:
+    """Background queue that renders upload thumbnails in a bounded process pool"""
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = None
+        self.tasks = set()
+    
+    def start(self):
+        """Start the worker processes"""
+        if self.executor is None:
+            # spawn: never fork the server process with its threads and event loop
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+    
+    def shutdown(self):
+        """Drop queued renders and stop the worker processes"""
+        for task in list(self.tasks):
+            task.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    def submit(self, session_id: str, file_info: dict):
+        """Queue a thumbnail render for an uploaded file, unless it is already cached"""
+        cache_key = ThumbnailCache.make_key(file_info["sha256"])
+        if thumbnail_cache.get(cache_key) is not None:
+            file_info["thumbnail_key"] = cache_key
+            file_info["thumbnail_status"] = "ready"
+            return
+        if file_info["type"] != "pdf":
+            # Comes out of the same decode as the image's page (see FragmentJobs)
+            return
+        
+        self.start()
+        task = asyncio.create_task(self._render(session_id, file_info["id"], file_info["path"], cache_key))
+        # Keep a reference so the task isn't garbage collected while running
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def render(self, file_path: str, cache_key: str, session_id: str) -> bytes:
+        """Render a thumbnail in the worker pool and cache it"""
+        self.start()
+        loop = asyncio.get_running_loop()
+        is_pdf = file_path.lower().endswith('.pdf')
+        
+        # Images and PDFs with an embedded page image render in one job...
+        thumbnail, paths = await asyncio.wrap_future(render_governor.submit(
+            session_id, self.executor, thumbnail_job, Path(file_path), True, not is_pdf
+        ))
+        render_stats.merge(paths)
+        
+        # ...everything else needs a second one for poppler
+        if not thumbnail and is_pdf:
+            thumbnail, paths = await asyncio.wrap_future(render_governor.submit(
+                session_id, self.executor, thumbnail_job, Path(file_path), False, True
+            ))
+            render_stats.merge(paths)
+        
+        if thumbnail:
+            await loop.run_in_executor(None, thumbnail_cache.put, cache_key, thumbnail)
+        return thumbnail
+    
+    async def _render(self, session_id: str, file_id: str, file_path: str, cache_key: str):
+        try:
+            thumbnail = await self.render(file_path, cache_key, session_id)
+        except Exception as e:
+            print(f"❌ Thumbnail job failed for {file_id}: {e}")
+            thumbnail = b""
+        
+        # A no-op if the file or the whole session was removed while rendering
+        fields = {"thumbnail_status": "ready" if thumbnail else "failed"}
+        if thumbnail:
+            fields["thumbnail_key"] = cache_key
+        session_store.update_file(session_id, file_id, fields)
+
+thumbnail_jobs = ThumbnailJobs(THUMBNAIL_WORKERS)
+
+# Every job sent to the pool (thumbnails, normalization) queues in the render governor, so
+# sessions take turns for the processes; a cap above the pool size would just queue in the pool
+render_governor.set_limit(min(THUMBNAIL_WORKERS, render_governor.max_concurrent))
+
+class FragmentJobs:
+    """Normalizes uploads into ready-to-append PDF fragments while the user arranges files
+    
+    Runs in the thumbnail worker processes, so /combine only has to concatenate.
+    """
+    def __init__(self):
+        self.tasks = set()
+    
+    def submit(self, session_id: str, file_info: dict):
+        """Queue normalization of an uploaded file (and the thumbnail of an image still without one)"""
+        thumbnail_key = None
+        if file_info["type"] != "pdf" and file_info["thumbnail_status"] == "pending":
+            thumbnail_key = ThumbnailCache.make_key(file_info["sha256"])
+        task = asyncio.create_task(self._normalize(session_id, file_info["id"], file_info["path"], file_info["type"],
+                                                   blob_store.fragment_path(file_info["sha256"]), thumbnail_key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _normalize(self, session_id: str, file_id: str, file_path: str, file_type: str, fragment_path: Path,
+                         thumbnail_key: str = None):
+        thumbnail_jobs.start()
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wrap_future(render_governor.submit(
+                session_id, thumbnail_jobs.executor, normalize_job, Path(file_path), file_type,
+                fragment_path, thumbnail_key is not None
+            ))
+        except Exception as e:
+            print(f"❌ Normalizing {file_id} failed: {e}")
+            result = None
+        
+        fields = {}
+        if result:
+            # Counted even if the file is gone by now - the fragment stays until its blob goes
+            disk_ledger.record(fragment_bytes=result.pop("fragment_size"))
+            thumbnail = result.pop("thumbnail")
+            fields.update(result)
+        if thumbnail_key is not None:
+            if result and thumbnail:
+                await loop.run_in_executor(None, thumbnail_cache.put, thumbnail_key, thumbnail)
+                fields.update(thumbnail_key=thumbnail_key, thumbnail_status="ready")
+            else:
+                fields["thumbnail_status"] = "failed"
+        
+        # A no-op if the file or the whole session was removed meanwhile
+        fields["fragment_status"] = "ready" if result else "failed"
+        session_store.update_file(session_id, file_id, fields)
+    
+    def shutdown(self):
+        """Drop pending normalizations"""
+        for task in list(self.tasks):
+            task.cancel()
+
+fragment_jobs = FragmentJobs()
+
+class CombineJobs:
+    """Runs combine requests as background jobs with progress reporting and cancellation
+    
+    Job records live in the session store, so with several workers any of them can report
+    on or cancel a job; the worker running it syncs progress and picks up cancel requests
+    every JOB_SYNC_INTERVAL seconds.
+    """
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="combine")
+        self.jobs = {}
+        self.cancel_events = {}
+        self.last_sync = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, session_id: str, file_order: list, optimize: bool = False, linearize: bool = False) -> dict:
+        """Queue a combine of the given files and return the new job record"""
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "session_id": session_id,
+            "status": "queued",
+            "total_pages": 0,
+            "pages_processed": 0,
+            "estimated_bytes": 0,
+            "bytes_written": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "cached": False,
+            "low_memory": False,
+            "peak_rss_mb": None,
+            "optimization": None,
+            "linearized": False,
+            "cancel_requested": False,
+            "error": None
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self.cancel_events[job_id] = threading.Event()
+        session_store.add_job(session_id, job)
+        
+        self.executor.submit(self._run, job_id, list(file_order), optimize, linearize)
+        return job
+    
+    def _run(self, job_id: str, file_order: list, optimize: bool = False, linearize: bool = False):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            cancel_event = self.cancel_events.get(job_id)
+        if job is None or job["status"] != "queued":
+            # Cancelled while queued
+            with self.lock:
+                self.jobs.pop(job_id, None)
+                self.cancel_events.pop(job_id, None)
+            return
+        
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        self._sync(job_id, force=True)
+        try:
+            if cancel_event.is_set():
+                raise CombineCancelled()
+            output_path = FileManager(job["session_id"]).combine_files(
+                file_order, progress=lambda **fields: self._progress(job_id, fields), cancel_event=cancel_event,
+                optimize=optimize, linearize=linearize
+            )
+            if output_path:
+                job["status"] = "completed"
+            else:
+                job["status"] = "failed"
+                job["error"] = "Failed to combine files"
+        except CombineCancelled:
+            job["status"] = "cancelled"
+            print(f"🛑 Combine job {job_id[:8]}... cancelled")
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        job["finished_at"] = time.time()
+        self._sync(job_id, force=True)
+        
+        # Finished jobs are served from the store
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.cancel_events.pop(job_id, None)
+            self.last_sync.pop(job_id, None)
+    
+    def _progress(self, job_id: str, fields: dict):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+            self._sync(job_id)
+    
+    def _sync(self, job_id: str, force: bool = False):
+        """Write a running job's progress to the store and pick up cancel requests from other workers"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            cancel_event = self.cancel_events.get(job_id)
+            if job is None or (not force and time.time() - self.last_sync.get(job_id, 0) < JOB_SYNC_INTERVAL):
+                return
+            self.last_sync[job_id] = time.time()
+        
+        fields = {key: value for key, value in job.items() if key != "cancel_requested"}
+        stored = session_store.update_job(job_id, fields)
+        # A deleted record means the session was cleaned up
+        if stored is None or stored.get("cancel_requested"):
+            cancel_event.set()
+    
+    def cancel(self, job_id: str) -> bool:
+        """Ask a queued or running job to stop, whichever worker runs it"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            cancel_event = self.cancel_events.get(job_id)
+        if job is not None:
+            if job["status"] not in ("queued", "running"):
+                return False
+            cancel_event.set()
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+                job["finished_at"] = time.time()
+                session_store.update_job(job_id, {"status": "cancelled", "finished_at": job["finished_at"]})
+            return True
+        
+        stored = session_store.get_job(job_id)
+        if stored is None or stored["status"] not in ("queued", "running"):
+            return False
+        session_store.update_job(job_id, {"cancel_requested": True})
+        return True
+    
+    def get_status(self, job_id: str) -> dict:
+        """Job record with overall progress, ETA and (once finished) the download URL"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            status = dict(job) if job is not None else None
+        if status is None:
+            # Finished, or running on another worker
+            status = session_store.get_job(job_id)
+            if status is None:
+                return None
+        
+        # Adding pages and writing the output each count for half of the work
+        page_part = status["pages_processed"] / status["total_pages"] if status["total_pages"] else 0
+        byte_part = min(1.0, status["bytes_written"] / status["estimated_bytes"]) if status["estimated_bytes"] else 0
+        progress = 1.0 if status["status"] == "completed" else (page_part + byte_part) / 2
+        status["progress"] = round(progress, 3)
+        
+        status["eta_seconds"] = None
+        if status["status"] == "running" and 0 < progress < 1:
+            elapsed = time.time() - status["started_at"]
+            status["eta_seconds"] = round(elapsed * (1 - progress) / progress, 1)
+        if status["status"] == "completed":
+            status["download_url"] = f"/download/{status['session_id']}"
+        return status
+    
+    def purge_session(self, session_id: str, job_ids: List[str]):
+        """Cancel and forget all jobs of a session"""
+        for job_id in job_ids:
+            self.cancel(job_id)
+            # Workers running one of these see the record vanish on their next sync and stop
+            session_store.delete_job(job_id)
+    
+    def shutdown(self):
+        """Cancel this worker's running jobs and stop the worker threads"""
+        with self.lock:
+            job_ids = list(self.jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+combine_jobs = CombineJobs(COMBINE_WORKERS)
 
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+def check_content_length(request: Request):
+    """Refuse a multipart upload whose declared size is over MAX_REQUEST_SIZE before reading it"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE + MULTIPART_OVERHEAD:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Upload exceeds the {MAX_REQUEST_SIZE // (1024 * 1024)} MB request limit"
+        )
+
 @app.post("/upload")
-async def upload_files(files: List[UploadFile] = File(...), session_id: str = Form(...)):
-    """Upload multiple files"""
-    if session_id not in sessions:
-        SessionManager.create_session(session_id)
+async def upload_files(request: Request):
+    """Upload multiple files (multipart form: files, session_id)
     
+    The body is parsed as it arrives, so the size limits and the disk budget are enforced
+    while it streams in. Send session_id before the files to have the session quota
+    checked then too; otherwise it is checked once the files are in.
+    """
+    check_content_length(request)
+    budget = UploadBudget()
+    parser = UploadParser(request, budget)
+    try:
+        try:
+            form = await parser.parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        session_id = form.get("session_id")
+        if not isinstance(session_id, str) or not session_id:
+            raise HTTPException(status_code=400, detail="session_id is required")
+        if session_id == BLOB_DIR.name:
+            raise HTTPException(status_code=400, detail="Invalid session id")
+        if budget.session_id is None:
+            budget.bind(session_id)
+        uploads = [upload for upload in form.getlist("files") if not isinstance(upload, str) and upload.filename]
+        
+        # Cleanup and removals of this session wait until the upload is stored
+        async with session_locks.hold_async(session_id):
+            return await store_uploads(session_id, [upload.file for upload in uploads])
+    finally:
+        # Whatever wasn't stored (a limit was hit, the client went away, an empty file field)
+        parser.discard()
+        budget.release()
+
+async def store_uploads(session_id: str, sinks: List[UploadSink]) -> dict:
+    """Add the files of an upload request to the session"""
+    SessionManager.create_session(session_id)
     SessionManager.update_session_access(session_id)
     
     file_manager = FileManager(session_id)
+    loop = asyncio.get_running_loop()
     uploaded_files = []
+    try:
+        for sink in sinks:
+            # The blob store takes a cross-process lock - not on the event loop
+            uploaded_files.append(await loop.run_in_executor(None, file_manager.store_file, sink))
+    except BaseException:
+        for file_info in uploaded_files:
+            Path(file_info["path"]).unlink(missing_ok=True)
+            blob_store.release(file_info["sha256"])
+        raise
     
-    for file in files:
-        if file.filename:
-            file_info = file_manager.save_file(file)
-            sessions[session_id]["files"][file_info["id"]] = file_info
-            sessions[session_id]["order"].append(file_info["id"])
-            uploaded_files.append(file_info)
+    # Cached thumbnails are filled in before the files are stored; the rest update them when done
+    for file_info in uploaded_files:
+        thumbnail_jobs.submit(session_id, file_info)
+    session_store.add_files(session_id, uploaded_files)
+    disk_ledger.record(
+        session_id,
+        upload_bytes=sum(file_info["size"] for file_info in uploaded_files),
+        upload_files=len(uploaded_files)
+    )
+    for file_info in uploaded_files:
+        fragment_jobs.submit(session_id, file_info)
     
-    return {"files": uploaded_files}
+    # Return straight away - thumbnails are served by /thumbnail once rendered
+    return {"files": [FileManager.public_info(file_info) for file_info in uploaded_files]}
 
 @app.post("/reorder")
 async def reorder_files(session_id: str = Form(...), order: str = Form(...)):
-    """Reorder files"""
-    if session_id not in sessions:
+    """Reorder files, optionally picking and rotating pages of each"""
+    session = session_store.get(session_id)
+    if session is None:
         return {"error": "Session not found"}
     
     SessionManager.update_session_access(session_id)
     
     try:
-        new_order = json.loads(order)
-        sessions[session_id]["order"] = new_order
+        new_order = SessionManager.parse_order(json.loads(order), session["files"])
+        session_store.set_order(session_id, new_order)
         return {"success": True}
     except Exception as e:
         return {"error": str(e)}
@@ -443,79 +1989,384 @@ async def reorder_files(session_id: str = Form(...), order: str = Form(...)):
 @app.post("/remove")
 async def remove_file(session_id: str = Form(...), file_id: str = Form(...)):
     """Remove a file"""
-    if session_id not in sessions:
+    if not session_store.exists(session_id):
         return {"error": "Session not found"}
     
     SessionManager.update_session_access(session_id)
     
     try:
-        # Remove from files dict
-        if file_id in sessions[session_id]["files"]:
-            file_info = sessions[session_id]["files"][file_id]
-            # Delete physical file
-            try:
-                os.unlink(file_info["path"])
-            except:
-                pass
-            del sessions[session_id]["files"][file_id]
-        
-        # Remove from order
-        if file_id in sessions[session_id]["order"]:
-            sessions[session_id]["order"].remove(file_id)
+        async with session_locks.hold_async(session_id):
+            # Remove from files and order in one step
+            file_info = session_store.remove_file(session_id, file_id)
+            if file_info:
+                # Delete physical file and its blob if nothing else references it
+                try:
+                    os.unlink(file_info["path"])
+                except:
+                    pass
+                if file_info.get("sha256"):
+                    blob_store.release(file_info["sha256"])
+                disk_ledger.record(session_id, upload_bytes=-file_info.get("size", 0), upload_files=-1)
         
         return {"success": True}
     except Exception as e:
         return {"error": str(e)}
 
 @app.post("/combine")
-async def combine_pdf(session_id: str = Form(...)):
-    """Combine files into PDF"""
-    if session_id not in sessions:
+async def combine_pdf(session_id: str = Form(...), order: str = Form(None), optimize: bool = Form(OPTIMIZE_OUTPUT),
+                      linearize: bool = Form(LINEARIZE_OUTPUT)):
+    """Combine files into PDF (an order sent along replaces the session's order first)"""
+    session = session_store.get(session_id)
+    if session is None:
         return {"error": "Session not found"}
     
     SessionManager.update_session_access(session_id)
+    # May evict sessions to make room - not on the event loop
+    await asyncio.get_running_loop().run_in_executor(None, storage_budget.check_available)
     
-    file_manager = FileManager(session_id)
-    output_path = file_manager.combine_files(sessions[session_id]["order"])
+    if order is not None:
+        try:
+            session_store.set_order(session_id, SessionManager.parse_order(json.loads(order), session["files"]))
+        except Exception as e:
+            return {"error": str(e)}
+    
+    # Merge in the background - poll status_url for progress and the download URL
+    job = combine_jobs.submit(session_id, session_store.get(session_id)["order"], optimize=optimize,
+                              linearize=linearize)
+    return {"job_id": job["id"], "status_url": f"/jobs/{job['id']}"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get progress of a combine job"""
+    status = combine_jobs.get_status(job_id)
+    if status is None:
+        return {"error": "Job not found"}
+    
+    SessionManager.update_session_access(status["session_id"])
+    return status
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running combine job"""
+    if combine_jobs.cancel(job_id):
+        return {"success": True}
+    return {"error": "Job not found or already finished"}
+
+def parse_byte_range(range_header: str, size: int):
+    """(start, end) inclusive for a single "bytes=" range, None to send the whole file
     
-    if output_path:
-        return {"download_url": f"/download/{session_id}"}
-    else:
-        return {"error": "Failed to combine files"}
+    Raises HTTPException 416 when the range lies outside the file. Multiple ranges aren't
+    supported and get the whole file, which the spec allows.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
 
 @app.get("/download/{session_id}")
-async def download_pdf(session_id: str):
-    """Download combined PDF"""
+async def download_pdf(session_id: str, request: Request):
+    """Download combined PDF, resumable with HTTP Range requests"""
     file_path = Path(f"temp/combined_{session_id}.pdf")
-    if file_path.exists():
-        # Mark session as downloaded for faster cleanup
-        if session_id in sessions:
-            sessions[session_id]["downloaded"] = True
-            sessions[session_id]["last_accessed"] = time.time()
-        
-        return FileResponse(
-            file_path,
-            media_type="application/pdf",
-            filename="combined.pdf"
-        )
-    return {"error": "File not found"}
+    try:
+        # Opened first: a combine finishing meanwhile swaps in a new file, this one stays readable
+        pdf_file = await aiofiles.open(file_path, "rb")
+    except FileNotFoundError:
+        return {"error": "File not found"}
+    
+    # Mark session as downloaded for faster cleanup
+    session_store.touch(session_id, downloaded=True)
+    
+    stat = os.fstat(pdf_file.fileno())
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": 'attachment; filename="combined.pdf"'
+    }
+    
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("range")
+    # If-Range: resume only if the file is still the one the client started on
+    if range_header and request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except HTTPException:
+            await pdf_file.close()
+            raise
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    
+    async def send_file():
+        try:
+            await pdf_file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await pdf_file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await pdf_file.close()
+    
+    return StreamingResponse(send_file(), status_code=status_code, media_type="application/pdf", headers=headers)
+
+@app.get("/combine/{session_id}/stream")
+async def stream_combined_pdf(session_id: str):
+    """Combine files and stream the PDF to the client as it is produced"""
+    session = session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    sources = []
+    for entry in session["order"]:
+        file_info = session["files"].get(entry_file_id(entry))
+        if file_info is None:
+            continue
+        selection = entry if isinstance(entry, dict) else {}
+        pages = selection.get("pages")
+        if pages is not None:
+            try:
+                SessionManager.check_pages(file_info, pages, file_info.get("page_count"))
+            except PageSelectionError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            pages = [page - 1 for page in pages]
+        sources.append((file_info["path"], file_info["type"], pages, selection.get("rotate", 0),
+                        file_info.get("page_refs")))
+    if not sources:
+        raise HTTPException(status_code=400, detail="No files to combine")
+    
+    session_store.touch(session_id, downloaded=True)
+    
+    # Sync generator - starlette iterates it in the threadpool
+    return StreamingResponse(
+        iter_merged_pdf(sources),
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'attachment; filename="combined.pdf"'}
+    )
+
+def attachment_header(filename: str) -> str:
+    """Content-Disposition for a download (RFC 6266): an ASCII filename for old clients and
+    filename* with the UTF-8 name; control characters, quotes and directories are dropped"""
+    filename = "".join(char for char in os.path.basename(filename) if char.isprintable() and char not in '"\\')
+    filename = filename.strip() or "combined.pdf"
+    # Accents are dropped ("März" -> "Marz"), other non-ASCII characters become "_"
+    fallback = "".join(char if char.isascii() else "_"
+                       for char in unicodedata.normalize("NFKD", filename) if not unicodedata.combining(char))
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(filename, safe="")}'
+
+def parse_batch_manifest(manifest: dict, files: List[UploadFile]) -> list:
+    """Selections (path, kind, 0-based pages, rotate) for a /batch manifest's order
+    
+    files are the request's uploads, each streamed to an UploadSink. Order entries name an
+    upload by its index or filename, or are {"file", "pages", "rotate"} selections as in
+    /reorder. The order defaults to every upload as sent. Every upload the order uses is
+    opened here, so a broken one fails the request before the response starts. Raises ValueError.
+    """
+    names = {}
+    for index, upload in enumerate(files):
+        names.setdefault(upload.filename, str(index))
+    
+    def file_id(ref):
+        if isinstance(ref, int) and not isinstance(ref, bool) and 0 <= ref < len(files):
+            return str(ref)
+        if isinstance(ref, str) and ref in names:
+            return names[ref]
+        raise ValueError(f"Unknown file in manifest: {ref!r}")
+    
+    order = manifest.get("order", list(range(len(files))))
+    if not isinstance(order, list):
+        raise ValueError("Order must be a list")
+    order = [
+        {**entry, "file_id": file_id(entry.get("file"))} if isinstance(entry, dict) else file_id(entry)
+        for entry in order
+    ]
+    
+    batch_files = {}
+    for index, upload in enumerate(files):
+        kind = "pdf" if upload.filename.lower().endswith(".pdf") else "image"
+        batch_files[str(index)] = {"filename": upload.filename, "type": kind, "page_count": None}
+    for used in {entry_file_id(entry) for entry in order}:
+        upload = files[int(used)]
+        file_info = batch_files[used]
+        if not upload.file.size:
+            raise ValueError(f"{upload.filename} is empty")
+        try:
+            if file_info["type"] == "pdf":
+                # Also bounds the page selections
+                file_info["page_count"] = count_pages(upload.file.path)
+            else:
+                with Image.open(upload.file.path):
+                    pass
+        except Exception as e:
+            raise ValueError(f"{upload.filename} can't be read: {e}")
+    
+    selections = []
+    for entry in SessionManager.parse_order(order, batch_files):
+        file_id = entry_file_id(entry)
+        selection = entry if isinstance(entry, dict) else {}
+        pages = selection.get("pages")
+        if pages is not None:
+            pages = [page - 1 for page in pages]
+        selections.append((str(files[int(file_id)].file.path), batch_files[file_id]["type"], pages,
+                           selection.get("rotate", 0), None))
+    return selections
+
+@app.post("/batch")
+async def batch_combine(request: Request):
+    """Combine uploaded files in one request and stream the PDF back, without a session
+    
+    Multipart form: files, and an optional manifest, JSON: {"order": [...], "optimize": bool,
+    "linearize": bool, "filename": str} (see parse_batch_manifest). The files stream to
+    temporary files under the same limits and disk budget as /upload, and are removed once
+    the response has been sent; only optimize or linearize merge into a temporary file first.
+    """
+    check_content_length(request)
+    budget = UploadBudget()
+    parser = UploadParser(request, budget)
+    
+    def discard():
+        parser.discard()
+        budget.release()
+    
+    try:
+        try:
+            form = await parser.parse()
+        except MultiPartException as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        files = [upload for upload in form.getlist("files") if not isinstance(upload, str) and upload.filename]
+        manifest = form.get("manifest")
+        if not files:
+            raise HTTPException(status_code=400, detail="No files to combine")
+        if manifest is not None and not isinstance(manifest, str):
+            raise HTTPException(status_code=400, detail="Manifest must be a form field, not a file")
+        # Opening the PDFs and any optimize or linearize pass read files - not on the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, batch_response, files, manifest, discard)
+    except BaseException:
+        discard()
+        raise
+
+def batch_response(files: List[UploadFile], manifest: str, discard) -> StreamingResponse:
+    """The /batch response for uploads that are on disk; discard() drops them once they're read"""
+    try:
+        options = json.loads(manifest) if manifest else {}
+        if not isinstance(options, dict):
+            raise ValueError("Manifest must be a JSON object")
+        sources = parse_batch_manifest(options, files)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not sources:
+        raise HTTPException(status_code=400, detail="No files to combine")
+    
+    def on_error(path, error):
+        # Sources were all opened above; one that still fails part way aborts the response
+        # instead of sending a PDF without it
+        raise error
+    
+    headers = {"Content-Disposition": attachment_header(str(options.get("filename") or "combined.pdf"))}
+    optimize = bool(options.get("optimize", OPTIMIZE_OUTPUT))
+    linearize = bool(options.get("linearize", LINEARIZE_OUTPUT))
+    if not (optimize or linearize):
+        def send_merged():
+            try:
+                yield from iter_merged_pdf(sources, on_error=on_error)
+            finally:
+                discard()
+        
+        # Sync generator - starlette iterates it in the threadpool
+        return StreamingResponse(send_merged(), media_type="application/pdf", headers=headers)
+    
+    storage_budget.check_available()
+    temp_path = Path("temp") / f"batch_{uuid.uuid4().hex}.tmp"
+    temp_path.parent.mkdir(exist_ok=True)
+    try:
+        with open(temp_path, 'wb') as output_file:
+            for chunk in iter_merged_pdf(sources, on_error=on_error):
+                output_file.write(chunk)
+        discard()
+        if optimize:
+            FileManager.optimize_output(temp_path, report=lambda **_: None, check_cancelled=lambda: None)
+        if linearize:
+            FileManager.linearize_output(temp_path, report=lambda **_: None)
+        pdf_file = open(temp_path, 'rb')
+    finally:
+        # Unlinked straight away - the open handle keeps the data readable until it is sent
+        temp_path.unlink(missing_ok=True)
+    headers["Content-Length"] = str(os.fstat(pdf_file.fileno()).st_size)
+    
+    def send_file():
+        with pdf_file:
+            while chunk := pdf_file.read(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+    
+    return StreamingResponse(send_file(), media_type="application/pdf", headers=headers)
+
+@app.get("/thumbnail/{session_id}/{file_id}")
+async def get_thumbnail(session_id: str, file_id: str, request: Request):
+    """Get the thumbnail of an uploaded file (202 while it is still rendering)"""
+    file_info = (session_store.get(session_id) or {}).get("files", {}).get(file_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    SessionManager.update_session_access(session_id)
+    
+    if file_info.get("thumbnail_status") == "pending":
+        return JSONResponse(status_code=202, content={"status": "pending"}, headers={"Cache-Control": "no-store"})
+    cache_key = file_info.get("thumbnail_key")
+    if not cache_key:
+        raise HTTPException(status_code=404, detail="Thumbnail not available")
+    
+    # The key is derived from the file content, so it doubles as a strong ETag
+    etag = f'"{cache_key}"'
+    headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    thumbnail = thumbnail_cache.get(cache_key)
+    if thumbnail is None:
+        # Evicted from the cache since it was rendered
+        thumbnail = await thumbnail_jobs.render(file_info["path"], cache_key, session_id)
+        if not thumbnail:
+            raise HTTPException(status_code=404, detail="Thumbnail not available")
+    
+    media_type = f"image/{cache_key.rsplit('_', 1)[-1]}"
+    return Response(content=thumbnail, media_type=media_type, headers=headers)
 
 @app.get("/files/{session_id}")
 async def get_files(session_id: str):
     """Get files for session"""
-    if session_id not in sessions:
+    session_data = session_store.get(session_id)
+    if session_data is None:
         return {"files": [], "order": []}
     
     SessionManager.update_session_access(session_id)
     
-    session_data = sessions[session_id]
     ordered_files = []
     
-    for file_id in session_data["order"]:
+    for file_id in dict.fromkeys(entry_file_id(entry) for entry in session_data["order"]):
         if file_id in session_data["files"]:
-            ordered_files.append(session_data["files"][file_id])
+            ordered_files.append(FileManager.public_info(session_data["files"][file_id]))
     
-    return {"files": ordered_files}
+    # order carries the page selections, if any
+    return {"files": ordered_files, "order": session_data["order"]}
 
 # Secured Debug endpoints for testing session management
 @app.get("/debug/sessions")
@@ -524,7 +2375,7 @@ async def debug_sessions(auth: HTTPAuthorizationCredentials = Depends(verify_deb
     current_time = time.time()
     session_info = {}
     
-    for session_id, session_data in sessions.items():
+    for session_id, session_data in session_store.items():
         age = current_time - session_data["created_at"]
         inactive = current_time - session_data["last_accessed"]
         
@@ -536,11 +2387,12 @@ async def debug_sessions(auth: HTTPAuthorizationCredentials = Depends(verify_deb
             "created_ago_seconds": int(age),
             "inactive_seconds": int(inactive),
             "downloaded": session_data.get("downloaded", False),
-            "expires_in_seconds": int(SESSION_TIMEOUT - inactive) if inactive < SESSION_TIMEOUT else 0
+            "expires_in_seconds": max(0, int(session_store.expires_at(session_data) - current_time))
         }
     
     return {
-        "total_sessions": len(sessions),
+        "total_sessions": session_store.count(),
+        "session_store": session_store.name,
         "session_timeout": SESSION_TIMEOUT,
         "cleanup_interval": CLEANUP_INTERVAL,
         "debug_mode": DEBUG_MODE,
@@ -550,14 +2402,16 @@ async def debug_sessions(auth: HTTPAuthorizationCredentials = Depends(verify_deb
 @app.post("/debug/cleanup")
 async def debug_cleanup(auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
     """Debug endpoint to manually trigger cleanup - REQUIRES AUTHENTICATION"""
-    SessionManager.cleanup_expired_sessions()
-    return {"message": "Cleanup triggered", "remaining_sessions": len(sessions)}
+    # Cleanup takes session locks and deletes files - run it in a thread, not on the event loop
+    await asyncio.get_running_loop().run_in_executor(None, SessionManager.cleanup_expired_sessions)
+    return {"message": "Cleanup triggered", "remaining_sessions": session_store.count()}
 
 @app.post("/debug/cleanup-session/{session_id}")
 async def debug_cleanup_session(session_id: str, auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
     """Debug endpoint to manually cleanup a specific session - REQUIRES AUTHENTICATION"""
-    if session_id in sessions:
-        SessionManager.cleanup_session(session_id)
+    if session_store.exists(session_id):
+        # Waits for the session's lock, which an upload may hold for a while
+        await asyncio.get_running_loop().run_in_executor(None, SessionManager.cleanup_session, session_id)
         return {"message": f"Session {session_id[:8]}... cleaned up"}
     return {"error": "Session not found"}
 
@@ -572,13 +2426,29 @@ async def debug_filesystem(auth: HTTPAuthorizationCredentials = Depends(verify_d
             "cleanup_interval": CLEANUP_INTERVAL,
             "debug_mode": DEBUG_MODE,
             "orphaned_files_detected": stats["orphaned_uploads"] + stats["orphaned_pdfs"]
-        }
+        },
+        "storage_budget": storage_budget.get_stats()
     }
 
+@app.get("/debug/thumbnail-cache")
+async def debug_thumbnail_cache(auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
+    """Debug endpoint to view thumbnail cache statistics - REQUIRES AUTHENTICATION"""
+    return {"thumbnail_cache": thumbnail_cache.get_stats()}
+
+@app.get("/debug/render-stats")
+async def debug_render_stats(auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
+    """Debug endpoint to view how PDF thumbnails were rendered - REQUIRES AUTHENTICATION"""
+    return {"render_paths": render_stats.get_stats(), "render_queue": render_governor.get_stats()}
+
+@app.get("/debug/combine-cache")
+async def debug_combine_cache(auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
+    """Debug endpoint to view combine cache hit rates and bytes saved - REQUIRES AUTHENTICATION"""
+    return {"combine_cache": combine_cache.get_stats()}
+
 @app.post("/debug/cleanup-orphaned")
 async def debug_cleanup_orphaned(auth: HTTPAuthorizationCredentials = Depends(verify_debug_access)):
     """Debug endpoint to manually trigger orphaned file cleanup - REQUIRES AUTHENTICATION"""
-    orphaned_count = SessionManager.cleanup_orphaned_files()
+    orphaned_count = await asyncio.get_running_loop().run_in_executor(None, SessionManager.cleanup_orphaned_files)
     return {
         "message": "Orphaned file cleanup triggered",
         "files_cleaned": orphaned_count,
@@ -588,5 +2458,8 @@ async def debug_cleanup_orphaned(auth: HTTPAuthorizationCredentials = Depends(ve
 # Note: Background cleanup task is now handled by the lifespan event handler above
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import sys
+    # Hand over to uvicorn's own entry point, serving the app from the web_app module: spawned
+    # thumbnail workers import the main module, and this file as __main__ is the whole web app
+    os.execv(sys.executable, [sys.executable, "-m", "uvicorn", "web_app:app", "--host", "0.0.0.0",
+                              "--port", "8000", "--workers", str(WEB_WORKERS)])
\ No newline at end of file